@@ -5,75 +5,475 @@ from pathlib import Path
 import time
 import os
 import logging
+import fcntl
+import threading
+import json
+import sys
+import re
 
+# Where the GPU lock queues live
+LOCK_DIR = Path("/tmp")
 
-def get_gpus():
-    "Return a dict of GPU types and devices"
-    devs = {}
-    if shutil.which("nvidia-smi") is not None:
-        for dev in Path("/dev").glob("nvidia[0-9]"):
-            if 'nvidia' not in devs:
-                devs['nvidia'] = []
-            devs['nvidia'].append(str(dev.absolute()))
-    # TODO: there should be checks for AMD and Intel GPUs
-    return devs
+# Where the probes look for devices and their sysfs information.  These can
+# be pointed at a fake directory tree for testing.
+DEVICE_DIR = Path("/dev")
+SYS_DIR = Path("/sys")
+PROC_DIR = Path("/proc")
 
+# PCI vendor ids for the DRI render nodes
+PCI_VENDORS = {'0x1002': 'amd', '0x8086': 'intel', '0x10de': 'nvidia'}
 
-def has_gpu(vendor=None):
-    "Determine if a GPU (of an optional vendor) is on this system"
-    devs = get_gpus()
+# The vendors whose GPUs the MGMs can compute on, which are the ones has_gpu()
+# looks for when it isn't given a vendor.  The other vendors' render nodes 
+# (such as an Intel iGPU) are found by get_gpus but don't count.
+COMPUTE_VENDORS = ('nvidia',)
+
+# vendor -> function returning a list of device paths
+_probes = {}
+_gpu_cache = {}
+_gpu_cache_lock = threading.Lock()
+
+
+def register_probe(vendor, probe):
+    """Register a function which returns a list of the devices for a GPU 
+       vendor.  It replaces any existing probe for the vendor"""
+    _probes[vendor] = probe
+    with _gpu_cache_lock:
+        _gpu_cache.clear()
+
+
+def _device_sort_key(dev):
+    "Sort devices by their numeric suffix, so nvidia10 comes after nvidia9"
+    digits = re.search(r'(\d+)$', Path(dev).name)
+    return (Path(dev).name.rstrip('0123456789'), int(digits.group(1)) if digits else -1)
+
+
+def probe_nvidia():
+    "Find the nvidia devices, if the nvidia driver utilities are installed"
+    if shutil.which("nvidia-smi") is None:
+        return []
+    return [str(x.absolute()) for x in DEVICE_DIR.glob("nvidia*") if re.fullmatch(r'nvidia\d+', x.name)]
+
+
+def probe_dri(vendor):
+    "Return a probe which finds the DRI render nodes for a vendor"
+    def probe():
+        devs = []
+        for dev in (DEVICE_DIR / "dri").glob("renderD*"):
+            try:
+                pci_vendor = (SYS_DIR / "class/drm" / dev.name / "device/vendor").read_text().strip()
+            except OSError:
+                continue
+            if PCI_VENDORS.get(pci_vendor) == vendor:
+                devs.append(str(dev.absolute()))
+        return devs
+    return probe
+
+
+register_probe('nvidia', probe_nvidia)
+register_probe('amd', probe_dri('amd'))
+register_probe('intel', probe_dri('intel'))
+
+
+def get_gpus(refresh=False):
+    """Return a dict of GPU types and devices.  The probes are only run the 
+       first time unless refresh is set"""
+    key = (DEVICE_DIR, SYS_DIR)
+    with _gpu_cache_lock:
+        if refresh or key not in _gpu_cache:
+            devs = {}
+            for vendor, probe in _probes.items():
+                try:
+                    found = probe()
+                except Exception as e:
+                    logging.warning(f"GPU probe for {vendor} failed: {e}")
+                    continue
+                if found:
+                    devs[vendor] = sorted(found, key=_device_sort_key)
+            _gpu_cache[key] = devs
+        return {k: list(v) for k, v in _gpu_cache[key].items()}
+
+
+def has_gpu(vendor=None, refresh=False):
+    "Determine if a compute GPU (or any GPU of an optional vendor) is on this system"
+    devs = get_gpus(refresh)
     if vendor:
         return vendor in devs
     else:
-        return len(devs) > 0
+        return any(x in devs for x in COMPUTE_VENDORS)
     
 
 class ExclusiveGPU:
-    def __init__(self, vendor, device=None, timeout=60*60*24*365, period=10):
+    def __init__(self, vendor, device=None, timeout=60*60*24*365, period=10, slots=1, devices=None):
         """Wait for exclusive access to a GPU device.  if the device is none 
-           then the first available will be used.  The name can be found
-           via the .name property"""
-        gpus = get_gpus()
-        if vendor not in gpus:
-            raise ModuleNotFoundError(f"There are no gpus with vendor {vendor}")
+           then the first free device will be used, or if none are free, 
+           whichever one comes free first:  the waiter gets in line for all of
+           them and leaves the other lines when it gets one.  The device can 
+           be found via the .name property and its index via the .index 
+           property (for nvidia, the CUDA index in PCI bus order).
+           
+           slots is the number of jobs allowed to use a device at once, either
+           as a number or a dict of device -> number.  devices overrides the 
+           list of devices found for the vendor.
+
+           Waiters are served in the order they arrived.  The lock is a
+           flock, so the kernel releases it if the holder dies.  Waiting
+           doesn't poll:  it blocks in flock until the device is handed over.
+           A waiter logs that it is still waiting every period seconds."""
+        if devices is None:
+            gpus = get_gpus()
+            if vendor not in gpus:
+                raise ModuleNotFoundError(f"There are no gpus with vendor {vendor}")
+            devices = gpus[vendor]
+        devices = [str(x) for x in devices]
         
-        if device is None:
-            # determine if there's a free device.  
-            # TODO: pick a free device.  in the mean time we're just going to pick the first device.
-            device = gpus[vendor][0]
-        elif device not in gpus[vendor]:
-            raise FileNotFoundError(f"No GPU with device name {device}")
+        if device is not None:
+            if str(device) not in devices:
+                raise FileNotFoundError(f"No GPU with device name {device}")
+            devices = [str(device)]
         
-        device = Path(device)
-        if not device.exists():
-            raise FileNotFoundError(f"GPU device at {device!s} doesn't exist")                
-        self.lockfile = Path("/tmp", "gpu-" + device.name + ".lock")
+        for d in devices:
+            if not Path(d).exists():
+                raise FileNotFoundError(f"GPU device at {d!s} doesn't exist")                
+
+        # lay out the slots so all of the devices' first slots are tried
+        # before doubling up on any of them.
+        if not isinstance(slots, dict):
+            slots = {d: slots for d in devices}
+        nslots = {d: slots.get(d, 1) for d in devices}
+        self.slots = [(Path(d), s) for s in range(max(nslots.values())) for d in devices if s < nslots[d]]
+
+        self.vendor = vendor
+        self.queue = None
         self.timeout = timeout
         self.period = period
-        self.name = device
+        self.name = Path(devices[0]) if len(devices) == 1 else None
+        self.index = None
+        self.slot = None
 
 
     def __enter__(self):        
-        timeout = time.time() + self.timeout
-        while time.time() < timeout:
-            try:
-                logging.debug(f"Attempting to lock {self.lockfile!s}")
-                fd = os.open(self.lockfile, os.O_CREAT | os.O_EXCL | os.O_RDWR)
-                os.write(fd, str(os.getpid()).encode("utf-8"))
-                os.close(fd)
-                logging.debug("Lock successful")
-                break
-            except Exception:
-                logging.debug(f"Can't lock.  Waiting for {self.period} seconds")
-                time.sleep(self.period)
-        else:
-            # we didn't break out of the loop -- so we timed out
+        deadline = time.time() + self.timeout
+        queues = [self._queue(device, slot) for device, slot in self.slots]
+        queue = None
+        try:
+            for q in queues:
+                q.enqueue()
+            queue = _wait_any(queues, deadline, self.period)
+        finally:
+            for q in queues:
+                if q is not queue:
+                    q.release()
+        if queue is None:
             raise TimeoutError(f"GPU never became available in {self.timeout} seconds")
+        device, slot = self.slots[queues.index(queue)]
+
+        self.queue = queue
+        self.name = device
+        self.slot = slot
+        if self.vendor == 'nvidia':
+            self.index = cuda_index(device)
+        else:
+            digits = re.search(r'(\d+)$', device.name)
+            self.index = int(digits.group(1)) if digits else None
+        logging.debug(f"Lock successful for {device!s}, slot {slot}")
         return self
 
     def __exit__(self, exc_type, exc_value, exc_traceback):
-        if self.lockfile.exists():
-            self.lockfile.unlink()
+        self.queue.release()
+
+    def environment(self):
+        "Return the environment variables needed to restrict a process to the locked device"
+        if self.vendor == 'nvidia' and self.index is not None:
+            # the index was mapped to PCI bus order by cuda_index
+            return {'CUDA_DEVICE_ORDER': 'PCI_BUS_ID', 'CUDA_VISIBLE_DEVICES': str(self.index)}
+        return {}
+
+    @staticmethod
+    def _queue(device, slot):
+        return GPUQueue(LOCK_DIR / f"gpu-{device.name}.{slot}.queue")
+
+
+class GPUQueue:
+    """A FIFO queue of processes waiting for a device.
+
+       Each waiter takes a sequence number and creates a queue entry file
+       named by it, which it holds a flock on until it is done.  A waiter
+       owns the device when there are no entries before it, and until then
+       it blocks in a flock on the entry just before it.  When that entry is
+       released (or its process dies) the waiter removes it and looks again.
+       Entries left behind by crashed processes aren't locked, so they're 
+       cleaned up by the next waiter (or skipped, if they belong to another
+       user and the sticky queue directory doesn't let us remove them).
+       
+       Each entry holds the pid and MGM name of the waiter along with when
+       it was queued and when it acquired the device.  When the device is
+       released the wait and hold times are appended to the queue's stats
+       file."""
+    # the stats file is trimmed to the most recent half when it gets this big
+    MAX_STATS_SIZE = 256 * 1024
+
+    def __init__(self, queue_dir: Path):
+        self.queue_dir = Path(queue_dir)
+        self.entry = None
+        self.fd = None
+        self.info = None
+        self.stale = set()
+
+    def acquire(self, deadline, period=10):
+        "Wait for the device until the deadline.  Returns the queue entry, or None if it timed out"
+        self.enqueue()
+        try:
+            if _wait_any([self], deadline, period) is None:
+                self.release()
+                return None
+            return self.entry
+        except BaseException:
+            self.release()
+            raise
+
+    def poll(self):
+        """Check whether we're at the front of the queue, cleaning up after the
+           predecessors which are done.  Returns True if we own the device"""
+        if not self._advance(False):
+            return False
+        self._acquired()
+        return True
+
+    def _advance(self, block, abandoned=None):
+        """Clean up after the predecessors which are done until we're at the
+           front of the queue, returning True.  If block is set this waits
+           for each predecessor in turn, and stops (returning False) once 
+           abandoned is set.  Otherwise it returns False if a predecessor is
+           still busy.  This doesn't touch our own entry, so it can be run 
+           in another thread while the entry is released"""
+        while abandoned is None or not abandoned.is_set():
+            predecessors = [x for x in self.entries() if x[0] < self.seq and x[1] not in self.stale]
+            if not predecessors:
+                return True
+            pred = predecessors[-1][1]
+            try:
+                # flock doesn't need write access, and the entry may belong to another user
+                pfd = os.open(pred, os.O_RDONLY)
+            except FileNotFoundError:
+                # it went away while we were looking.
+                continue
+            try:
+                try:
+                    fcntl.flock(pfd, fcntl.LOCK_EX if block else fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return False
+                # it's done (or died), so clean up after it.
+                try:
+                    pred.unlink()
+                except FileNotFoundError:
+                    pass
+                except PermissionError:
+                    # another user's leftover entry, so just ignore it.
+                    self.stale.add(pred)
+            finally:
+                os.close(pfd)
+        return False
+
+    def _acquired(self):
+        "Record in our entry when we got the device"
+        if 'acquired' not in self.info:
+            self.info['acquired'] = time.time()
+            os.ftruncate(self.fd, 0)
+            os.pwrite(self.fd, json.dumps(self.info).encode('utf-8'), 0)
+
+    def release(self):
+        "Leave the queue, waking up the next waiter"
+        if self.fd is not None:
+            try:
+                self.entry.unlink()
+            except FileNotFoundError:
+                pass
+            os.close(self.fd)
+            self.fd = None
+            if 'acquired' in self.info:
+                released = time.time()
+                self._record({'pid': self.info['pid'], 'mgm': self.info['mgm'], 'released': released,
+                              'wait': self.info['acquired'] - self.info['queued'],
+                              'hold': released - self.info['acquired']})
+
+    def status(self):
+        """Return the current holders and waiters for the queue, and the wait
+           and hold time statistics from the stats file"""
+        holders = []
+        waiters = []
+        for seq, entry in self.entries():
+            try:
+                with open(entry) as f:
+                    try:
+                        fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                        # nobody has it locked, so it's left over from a dead process
+                        continue
+                    except BlockingIOError:
+                        pass
+                    info = json.loads(f.read() or '{}')
+            except (FileNotFoundError, ValueError):
+                continue
+            (holders if 'acquired' in info else waiters).append(info)
+
+        history = []
+        try:
+            with open(self.queue_dir / "stats") as f:
+                for line in f:
+                    try:
+                        history.append(json.loads(line))
+                    except ValueError:
+                        pass
+        except FileNotFoundError:
+            pass
+        stats = {'jobs': len(history)}
+        for k in ('wait', 'hold'):
+            values = sorted([x[k] for x in history])
+            stats[k] = {'average': sum(values) / len(values) if values else 0,
+                        'median': values[len(values) // 2] if values else 0,
+                        'max': values[-1] if values else 0}
+        return {'holders': holders, 'waiters': waiters, 'stats': stats}
+
+    def entries(self):
+        "Return a sorted list of (sequence, path) for the entries in the queue"
+        entries = []
+        for f in self.queue_dir.glob("*.lock"):
+            try:
+                entries.append((int(f.name.split('.')[0]), f))
+            except ValueError:
+                pass
+        return sorted(entries)
+
+    def enqueue(self):
+        "Take a sequence number and create our entry in the queue"
+        if not self.queue_dir.exists():
+            self.queue_dir.mkdir(parents=True, exist_ok=True)
+            try:
+                # all users need to be able to queue
+                self.queue_dir.chmod(0o1777)
+            except OSError:
+                pass
+        sfd = os.open(self.queue_dir / "sequence", os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            _share(sfd)
+            fcntl.flock(sfd, fcntl.LOCK_EX)
+            self.seq = int(os.read(sfd, 32) or 0) + 1
+            os.lseek(sfd, 0, os.SEEK_SET)
+            os.ftruncate(sfd, 0)
+            os.write(sfd, str(self.seq).encode('utf-8'))
+            # the entry has to be created while we have the sequence lock, 
+            # otherwise a later waiter may not see it.
+            self.entry = self.queue_dir / f"{self.seq:012d}.{os.getpid()}.lock"
+            self.fd = os.open(self.entry, os.O_CREAT | os.O_EXCL | os.O_RDWR, 0o644)
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        finally:
+            os.close(sfd)
+        self.info = {'pid': os.getpid(), 
+                     'mgm': Path(sys.argv[0]).name if sys.argv and sys.argv[0] else 'python',
+                     'queued': time.time()}
+        os.write(self.fd, json.dumps(self.info).encode('utf-8'))
+
+    def _record(self, data):
+        "Append a record to the stats file"
+        try:
+            fd = os.open(self.queue_dir / "stats", os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o666)
+        except OSError as e:
+            logging.debug(f"Cannot record GPU statistics: {e}")
+            return
+        try:
+            _share(fd)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            os.write(fd, (json.dumps(data) + "\n").encode('utf-8'))
+            size = os.fstat(fd).st_size
+            if size > self.MAX_STATS_SIZE:
+                os.lseek(fd, size // 2, os.SEEK_SET)
+                keep = os.read(fd, size).split(b"\n", 1)[-1]
+                os.ftruncate(fd, 0)
+                os.write(fd, keep)
+        finally:
+            os.close(fd)
+
+
+def gpu_status():
+    "Return the status of every GPU queue, keyed by the queue name"
+    return {q.name[4:-6]: GPUQueue(q).status() for q in sorted(LOCK_DIR.glob("gpu-*.queue"))}
+
+
+def _wait_any(queues, deadline, period):
+    """Wait until we own one of the (enqueued) queues, returning it, or None
+       at the deadline.  A helper thread for each queue blocks in flock on the
+       entry ahead of ours, and wakes this one through a condition, so nothing 
+       polls, it works in any thread, and the caller's signals and timers are
+       left alone.  Still waiting is logged every period seconds.
+
+       A helper blocked on a busy entry when we stop waiting only finishes
+       once that entry is released;  it then exits without touching our own
+       entry, which will be gone by then."""
+    for queue in queues:
+        if queue.poll():
+            return queue
+
+    ready = threading.Condition()
+    front = []
+    abandoned = threading.Event()
+    def wait(queue):
+        try:
+            if not queue._advance(True, abandoned):
+                return
+            result = queue
+        except Exception as e:
+            result = e
+        with ready:
+            front.append(result)
+            ready.notify()
+
+    for queue in queues:
+        threading.Thread(target=wait, args=(queue,), name=f"wait-{queue.queue_dir.name}", daemon=True).start()
+    try:
+        with ready:
+            while not front:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                if not ready.wait(min(remaining, period)):
+                    logging.debug(f"Still waiting for {', '.join(q.queue_dir.name for q in queues)}")
+            queue = front[0]
+    finally:
+        abandoned.set()
+    if isinstance(queue, Exception):
+        raise queue
+    queue._acquired()
+    return queue
+
 
+def cuda_index(device):
+    """Return the CUDA index of an nvidia device node, for use with 
+       CUDA_DEVICE_ORDER=PCI_BUS_ID.  The N in /dev/nvidiaN is the driver's
+       minor number, which isn't necessarily in PCI bus order, so it's mapped
+       through the bus ids in /proc/driver/nvidia/gpus.  If the driver doesn't
+       say, the minor number is assumed to be in bus order."""
+    digits = re.search(r'(\d+)$', Path(device).name)
+    if not digits:
+        return None
+    minor = int(digits.group(1))
+    buses = {}
+    for info in (PROC_DIR / "driver/nvidia/gpus").glob("*/information"):
+        try:
+            for line in info.read_text().splitlines():
+                if line.startswith("Device Minor:"):
+                    buses[int(line.split(":", 1)[1])] = info.parent.name.lower()
+        except (OSError, ValueError):
+            continue
+    if minor not in buses:
+        logging.debug(f"No PCI bus id for {device!s}, assuming the minor number is the CUDA index")
+        return minor
+    return sorted(buses.values()).index(buses[minor])
 
 
+def _share(fd):
+    "Make a file we created usable by all users, since the umask will have removed the write bits"
+    try:
+        if os.fstat(fd).st_uid == os.geteuid():
+            os.fchmod(fd, 0o666)
+    except OSError:
+        pass
@@ -0,0 +1,137 @@
+"Persistent state for long-running remote jobs"
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from amp.config import get_amp_data
+
+# Job status values are the LWLW return codes
+OK = 0
+ERROR = 1
+WAIT = 255
+
+
+class JobStore:
+    """A sqlite database of remote jobs, keyed by a stable job key (such as
+       one from cloudutils.generate_persistent_name).  It records the remote
+       job id, when it was submitted, when it was last checked, and its status.
+
+       It is safe to use from many threads and processes at once:  each thread
+       gets its own connection and the database is in WAL mode."""
+    def __init__(self, path=None):
+        if path is None:
+            path = Path(get_amp_data(), "work", "lwlw_jobs.db")
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        with self._db() as db:
+            db.execute("""create table if not exists jobs (
+                              key text primary key,
+                              mgm text,
+                              remote_id text,
+                              status integer,
+                              submitted real,
+                              last_check real,
+                              checks integer default 0,
+                              finished real,
+                              data text)""")
+            db.execute("create index if not exists jobs_status on jobs (status, last_check)")
+            db.execute("create index if not exists jobs_finished on jobs (finished)")
+
+    def _db(self):
+        "Get the connection for this thread"
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(str(self.path), timeout=60)
+            db.row_factory = sqlite3.Row
+            db.execute("pragma journal_mode=wal")
+            db.execute("pragma synchronous=normal")
+            self._local.db = db
+        return db
+
+    def get(self, key):
+        "Return the job's record as a dict, or None if it isn't known"
+        row = self._db().execute("select * from jobs where key = ?", (key,)).fetchone()
+        return self._row(row) if row else None
+
+    def submitted(self, key, remote_id=None, mgm=None, status=WAIT, data=None):
+        "Record that a job has been submitted, replacing any earlier record"
+        now = time.time()
+        with self._db() as db:
+            db.execute("insert or replace into jobs (key, mgm, remote_id, status, submitted, last_check, checks, finished, data) " +
+                       "values (?, ?, ?, ?, ?, ?, 0, ?, ?)",
+                       (key, mgm, None if remote_id is None else str(remote_id), status, now, now,
+                        None if status == WAIT else now, json.dumps(data)))
+
+    def checked(self, key, status):
+        "Record the result of checking a job"
+        now = time.time()
+        with self._db() as db:
+            db.execute("update jobs set status = ?, last_check = ?, checks = checks + 1, " +
+                       "finished = case when ? = ? then null else coalesce(finished, ?) end where key = ?",
+                       (status, now, status, WAIT, now, key))
+
+    def remove(self, key):
+        "Forget a job"
+        with self._db() as db:
+            db.execute("delete from jobs where key = ?", (key,))
+
+    def jobs(self, status=None, mgm=None):
+        "Return the records for all of the jobs, optionally with the given status and/or mgm"
+        query = "select * from jobs where 1 = 1"
+        args = []
+        if status is not None:
+            query += " and status = ?"
+            args.append(status)
+        if mgm is not None:
+            query += " and mgm = ?"
+            args.append(mgm)
+        return [self._row(x) for x in self._db().execute(query + " order by submitted", args)]
+
+    def stuck(self, age=24 * 3600, unchecked=None):
+        """Return the jobs which are still waiting and were submitted more than
+           age seconds ago, or (if unchecked is given) haven't been checked in
+           that many seconds"""
+        now = time.time()
+        query = "select * from jobs where status = ? and (submitted < ?"
+        args = [WAIT, now - age]
+        if unchecked is not None:
+            query += " or last_check < ?"
+            args.append(now - unchecked)
+        return [self._row(x) for x in self._db().execute(query + ") order by submitted", args)]
+
+    def cleanup(self, age=7 * 24 * 3600):
+        "Remove the jobs which finished more than age seconds ago, returning how many were removed"
+        with self._db() as db:
+            count = db.execute("delete from jobs where finished < ?", (time.time() - age,)).rowcount
+        logging.debug(f"Removed {count} finished jobs from {self.path!s}")
+        return count
+
+    def close(self):
+        "Close this thread's connection"
+        db = getattr(self._local, 'db', None)
+        if db is not None:
+            db.close()
+            self._local.db = None
+
+    @staticmethod
+    def _row(row):
+        data = dict(row)
+        data['data'] = json.loads(data['data']) if data['data'] else None
+        return data
+
+
+_default_store = None
+_default_store_lock = threading.Lock()
+
+
+def default_store():
+    "Return the shared job store in the AMP data directory"
+    global _default_store
+    with _default_store_lock:
+        if _default_store is None:
+            _default_store = JobStore()
+        return _default_store
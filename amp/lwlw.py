@@ -1,47 +1,226 @@
+import asyncio
 import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
 from time import sleep
+from amp.jobstore import default_store
 
-class LWLW:
+
+class FixedPolling:
+    "Check the job every pause seconds"
+    def __init__(self, pause=10):
+        self.pause = pause
+
+    def delay(self, checks, elapsed):
+        "Return how long to wait before the next check"
+        return self.pause
+
+
+class BackoffPolling:
+    """Check the job quickly at first and then less often, multiplying the
+       delay by factor after each check up to maximum.  Each delay is
+       randomized by +/- jitter (as a fraction) so that many jobs started
+       together don't check in lockstep"""
+    def __init__(self, initial=1, factor=1.5, maximum=120, jitter=0.2):
+        self.initial = initial
+        self.factor = factor
+        self.maximum = maximum
+        self.jitter = jitter
+
+    def delay(self, checks, elapsed):
+        "Return how long to wait before the next check"
+        delay = min(self.initial * self.factor ** max(checks - 1, 0), self.maximum)
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+class _Poller:
+    "Track the polling state for one synchronous run"
+    def __init__(self, job, polling, deadline):
+        self.job = job
+        self.polling = polling
+        self.deadline = None if deadline is None else time.time() + deadline
+        self.submitted = time.time()
+        self.checks = 0
+
+    def next_delay(self):
+        """Return how long to wait before checking the job again, or None if
+           the deadline has passed.  A retry_after set by the job during the
+           last check takes precedence over the polling strategy"""
+        now = time.time()
+        if self.deadline is not None and now >= self.deadline:
+            return None
+        delay = getattr(self.job, 'retry_after', None)
+        self.job.retry_after = None
+        if delay is None:
+            delay = self.polling.delay(self.checks, now - self.submitted)
+        if self.deadline is not None:
+            delay = min(delay, self.deadline - now)
+        return max(delay, 0)
+
+    def report(self, metrics, mode, rc, timed_out=False, latency=-1):
+        """Send the run's metrics to the metrics hook.  The latency defaults
+           to the time since the poller was created"""
+        if latency == -1:
+            latency = time.time() - self.submitted
+        data = {'job': type(self.job).__name__, 'mode': mode, 'rc': rc, 'checks': self.checks,
+                'latency': latency, 'timed_out': timed_out}
+        logging.debug(f"LWLW metrics: {data}")
+        if metrics is not None:
+            try:
+                metrics(data)
+            except Exception as e:
+                logging.warning(f"LWLW metrics hook failed: {e}")
+
+
+class _JobState:
+    """The job store bookkeeping shared by LWLW and AsyncLWLW.
+
+       If a subclass sets job_key to a stable key for the job (such as one
+       from cloudutils.generate_persistent_name) the job's state is kept in
+       the job store across invocations, and exists() and cleanup() don't 
+       need to be supplied.  submit() should set remote_id to the remote 
+       service's identifier for the job, and exists() restores it."""
+    job_key = None
+    job_store = None
+    remote_id = None
+
+    def _store(self):
+        "Get the job store, or None if this job isn't tracked"
+        if self.job_key is None:
+            return None
+        if self.job_store is None:
+            self.job_store = default_store()
+        return self.job_store
+
+    def _record(self, event, rc):
+        "Record a submission or check, returning the job's record"
+        store = self._store()
+        if store is None:
+            return None
+        if event == 'submit':
+            store.submitted(self.job_key, self.remote_id, type(self).__name__, rc)
+        else:
+            store.checked(self.job_key, rc)
+        return store.get(self.job_key)
+
+    def _stored_id(self):
+        "Return the stored identifier for the job, or None"
+        job = self._store().get(self.job_key)
+        if job is None:
+            return None
+        self.remote_id = job['remote_id']
+        return self.remote_id or self.job_key
+
+    def _forget(self):
+        "Remove the job from the store"
+        store = self._store()
+        if store is not None:
+            store.remove(self.job_key)
+
+    @staticmethod
+    def _latency(job, rc, poller):
+        "Get the submit-to-done latency for the LWLW protocol from the job's record"
+        if job is None:
+            return None
+        poller.checks = job['checks']
+        return time.time() - job['submitted'] if rc != LWLW.WAIT else None
+
+
+def _protocol(job, pre_cleanup, post_cleanup, lwlw, pause, polling, deadline, metrics):
+    """The LWLW run protocol, shared by LWLW.run and AsyncLWLW.run.  This is a
+       generator which yields the steps for the run to carry out, and is sent
+       each step's result:  ('job', method) to call one of the job's methods,
+       ('store', function) for the job store bookkeeping, and ('sleep', 
+       seconds).  It returns the final rc"""
+    if not lwlw:
+        logging.debug("Using synchronous protocol")
+        if polling is None:
+            polling = FixedPolling(pause) if pause is not None else BackoffPolling()
+        if (yield 'job', job.exists) and pre_cleanup:
+            yield 'job', job.cleanup
+            yield 'store', job._forget
+        poller = _Poller(job, polling, deadline)
+        rc = yield 'job', job.submit
+        yield 'store', lambda: job._record('submit', rc)
+        logging.debug(f"Job submission return rc={rc}")
+        while rc == LWLW.WAIT:
+            delay = poller.next_delay()
+            if delay is None:
+                logging.error(f"Job did not finish within {deadline} seconds")
+                rc = LWLW.ERROR
+                poller.report(metrics, 'sync', rc, timed_out=True)
+                break
+            yield 'sleep', delay
+            rc = yield 'job', job.check
+            yield 'store', lambda: job._record('check', rc)
+            poller.checks += 1
+            logging.debug(f"Check job returned rc={rc}")
+        else:
+            poller.report(metrics, 'sync', rc)
+        if post_cleanup:
+            yield 'job', job.cleanup
+            yield 'store', job._forget
+
+    else:
+        logging.debug("Using LWLW protocol")
+        poller = _Poller(job, polling, None)
+        if not (yield 'job', job.exists):
+            if pre_cleanup:
+                yield 'job', job.cleanup
+                yield 'store', job._forget
+            rc = yield 'job', job.submit
+            record = yield 'store', lambda: job._record('submit', rc)
+        else:
+            rc = yield 'job', job.check
+            record = yield 'store', lambda: job._record('check', rc)
+            poller.checks += 1
+        # the submission happened in an earlier invocation, so the
+        # latency is only known if the job is in the job store
+        poller.report(metrics, 'lwlw', rc, latency=job._latency(record, rc, poller))
+        if rc == LWLW.OK and post_cleanup:
+            yield 'job', job.cleanup
+            yield 'store', job._forget
+
+    return rc
+
+
+class LWLW(_JobState):
     OK = 0
     ERROR = 1
     WAIT = 255
 
-    def run(self, pre_cleanup=False, post_cleanup=True, lwlw=True, pause=10):
-        "Run a LWLW MGM.  If serial is specified, loop to completion"
-        if not lwlw:
-            logging.debug("Using synchronous protocol")
-            if self.exists() and pre_cleanup:
-                self.cleanup()
-            rc = self.submit()
-            logging.debug(f"Job submission return rc={rc}")
-            while rc == LWLW.WAIT:
-                rc = self.check()
-                logging.debug(f"Check job returned rc={rc}")
-                if rc == LWLW.WAIT:
-                    sleep(pause)
-            if post_cleanup:
-                self.cleanup()
+    # a subclass can set this during check() when the remote service
+    # suggests when to try again, and it will be used for the next delay
+    retry_after = None
 
-        else:
-            logging.debug("Using LWLW protocol")
-            if not self.exists():
-                if pre_cleanup:
-                    self.cleanup()
-                rc = self.submit()
-            else:
-                rc = self.check()
-            if rc == LWLW.OK and post_cleanup:
-                self.cleanup()
-        
-        return rc
+    def run(self, pre_cleanup=False, post_cleanup=True, lwlw=True, pause=None, polling=None, deadline=None, metrics=None):
+        """Run a LWLW MGM.  If lwlw is false, loop to completion.
+
+           When looping, the delay between checks comes from the polling
+           strategy (exponential backoff with jitter by default, or a fixed
+           pause if one is given).  If deadline (in seconds) passes before
+           the job finishes, ERROR is returned.  metrics is called with a
+           dict of the run's rc, number of checks, and submit-to-done latency
+           (which is None in the LWLW protocol)"""
+        steps = _protocol(self, pre_cleanup, post_cleanup, lwlw, pause, polling, deadline, metrics)
+        result = None
+        while True:
+            try:
+                step, call = steps.send(result)
+            except StopIteration as e:
+                return e.value
+            result = sleep(call) if step == 'sleep' else call()
 
     def exists(self, *args, **kwargs):
         "Get the identifier for this job if it exists, otherwise None"
-        raise NotImplementedError("The exists method must be supplied by the subclass")
+        if self.job_key is None:
+            raise NotImplementedError("The exists method must be supplied by the subclass")
+        return self._stored_id()
 
 
     def submit(self, *args, **kwargs):
-        """Submit the job for processing.  
+        """Submit the job for processing.
            Returns LWLW Status values"""
         raise NotImplementedError("The submit method must be supplied by the subclass")
 
@@ -50,8 +229,131 @@ class LWLW:
         """Check if the job has completed.
         Returns LWLW Status values"""
         raise NotImplementedError("The check method must be supplied by the subclass")
-    
+
     def cleanup(self, *args, **kwargs):
-        """Cleanup a job's resources"""
-        raise NotImplementedError("The cleanup method must be supplied by the subclass")    
-    
\ No newline at end of file
+        """Cleanup a job's resources.  There's nothing to do by default for a
+           job in the job store:  run() forgets it after the cleanup"""
+        if self.job_key is None:
+            raise NotImplementedError("The cleanup method must be supplied by the subclass")
+
+
+class AsyncLWLW(_JobState):
+    """An asyncio version of LWLW, so many jobs can be driven from one event
+       loop.  Subclasses supply coroutines for exists, submit, check and
+       cleanup, and run() follows the same protocol as LWLW.run.  The job
+       store is used from the executor's threads (the default executor if 
+       it is None)"""
+    OK = LWLW.OK
+    ERROR = LWLW.ERROR
+    WAIT = LWLW.WAIT
+
+    retry_after = None
+    executor = None
+
+    async def run(self, pre_cleanup=False, post_cleanup=True, lwlw=True, pause=None, polling=None, deadline=None, metrics=None):
+        "Run a LWLW MGM.  The arguments are the same as LWLW.run"
+        loop = asyncio.get_running_loop()
+        steps = _protocol(self, pre_cleanup, post_cleanup, lwlw, pause, polling, deadline, metrics)
+        result = None
+        while True:
+            try:
+                step, call = steps.send(result)
+            except StopIteration as e:
+                return e.value
+            if step == 'sleep':
+                result = await asyncio.sleep(call)
+            elif step == 'job':
+                result = await call()
+            else:
+                # sqlite can block for a long time when the database is busy,
+                # so keep it off of the event loop
+                result = await loop.run_in_executor(self.executor, call)
+
+    async def exists(self):
+        "Get the identifier for this job if it exists, otherwise None"
+        if self.job_key is None:
+            raise NotImplementedError("The exists method must be supplied by the subclass")
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self._stored_id)
+
+    async def submit(self):
+        "Submit the job for processing.  Returns LWLW Status values"
+        raise NotImplementedError("The submit method must be supplied by the subclass")
+
+    async def check(self):
+        "Check if the job has completed.  Returns LWLW Status values"
+        raise NotImplementedError("The check method must be supplied by the subclass")
+
+    async def cleanup(self):
+        "Cleanup a job's resources.  As with LWLW, run() forgets the job afterwards"
+        if self.job_key is None:
+            raise NotImplementedError("The cleanup method must be supplied by the subclass")
+
+
+class ThreadedLWLW(AsyncLWLW):
+    """Adapt a synchronous LWLW job to AsyncLWLW by running its methods in a
+       thread pool, so the existing subclasses can be used with LWLWRunner"""
+    def __init__(self, job, executor=None):
+        self.job = job
+        self.executor = executor
+
+    def _store(self):
+        return self.job._store()
+
+    def _record(self, event, rc):
+        return self.job._record(event, rc)
+
+    def _forget(self):
+        self.job._forget()
+
+    async def _call(self, method):
+        rc = await asyncio.get_running_loop().run_in_executor(self.executor, method)
+        # pass along any retry_after the job set
+        self.retry_after, self.job.retry_after = self.job.retry_after, None
+        return rc
+
+    async def exists(self):
+        return await self._call(self.job.exists)
+
+    async def submit(self):
+        return await self._call(self.job.submit)
+
+    async def check(self):
+        return await self._call(self.job.check)
+
+    async def cleanup(self):
+        return await self._call(self.job.cleanup)
+
+
+class LWLWRunner:
+    """Drive many LWLW jobs concurrently from one process.  At most 
+       concurrency jobs are running at once, and synchronous LWLW jobs make
+       their calls from a pool of threads threads"""
+    def __init__(self, concurrency=50, threads=8):
+        self.concurrency = concurrency
+        self.threads = threads
+
+    async def run_all(self, jobs, **kwargs):
+        """Run the jobs to completion, returning a list of their return codes.
+           The keyword arguments are passed to each job's run().  A job which
+           raises an exception gets ERROR"""
+        semaphore = asyncio.Semaphore(self.concurrency)
+        with ThreadPoolExecutor(self.threads) as executor:
+            async def run_one(job):
+                if isinstance(job, LWLW):
+                    job = ThreadedLWLW(job, executor)
+                async with semaphore:
+                    try:
+                        return await job.run(lwlw=False, **kwargs)
+                    except Exception as e:
+                        logging.exception(f"{type(getattr(job, 'job', job)).__name__} job failed: {e}")
+                        return LWLW.ERROR
+            return await asyncio.gather(*[run_one(job) for job in jobs])
+
+    def run(self, jobs, **kwargs):
+        "Run the jobs to completion in a new event loop, returning their return codes"
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self.run_all(jobs, **kwargs))
+        finally:
+            loop.close()
+
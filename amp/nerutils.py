@@ -1,5 +1,8 @@
 
 import logging
+import re
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ProcessPoolExecutor
 from amp.schema.entity_extraction import EntityExtraction, EntityExtractionMedia
 from amp.schema.speech_to_text import SpeechToText
 from amp.fileutils import read_json_file, write_json_file
@@ -9,101 +12,172 @@ from amp.fileutils import read_json_file, write_json_file
 # Preprocess before submitting inputs to NER MGM: extract ignore types, parse input AMP Transcript, and initialize AMP Entity output.
 # If input transcript is empty, complete the process with empty output entities; otherwise return data needed by following process.
 def initialize_amp_entities(amp_transcript, amp_entities, ignore_types):
+    job = prepare_amp_entities(amp_transcript, ignore_types)
+
+    # If input AMP transcript is empty, don't error, instead, output AMP Entity JSON with empty entity list and complete the whole process
+    if job.empty:
+        write_json_file(job.entities, amp_entities)
+        exit(0)
+
+    # otherwise return the intermediate results of the preprocess
+    return [job.transcript, job.entities, job.ignore_types]
+
+
+class NerJob:
+    """The prepared inputs and outputs for one NER job:  the parsed transcript,
+    the AMP entities object to fill in, and the list of entity types to
+    ignore.  empty is True if the transcript has no text.  After the job has
+    run, stats has the counts from populate_amp_entities."""
+    def __init__(self, transcript, entities, ignore_types):
+        self.transcript = transcript
+        self.entities = entities
+        self.ignore_types = ignore_types
+        self.empty = len(transcript.results.transcript) == 0
+        self.stats = None
+        self.error = None
+
+
+# Prepare a NER job without exiting or writing anything.  amp_transcript can be the name of an AMP Transcript JSON
+# file, its parsed JSON, or a SpeechToText object.  ignore_types is a comma separated string or a list.  filename is
+# recorded as the media filename for the entities, and defaults to the transcript's file name.
+def prepare_amp_entities(amp_transcript, ignore_types, filename=None):
     # get a list of entity types to ignore when outputting entity list
-    ignore_types_list = extract_ignore_types(ignore_types)
-    logging.info(f"Ignore types: {ignore_types_list}")    
+    if isinstance(ignore_types, str):
+        ignore_types = extract_ignore_types(ignore_types)
+    else:
+        ignore_types = [clean_type(x) for x in ignore_types]
+    logging.info(f"Ignore types: {ignore_types}")
 
     # parse input AMP Transcript JSON file into amp_transcript object
-    try:
-        amp_transcript_obj = SpeechToText().from_json(read_json_file(amp_transcript))
-    except Exception:
-        logging.exception(f"Exception while parsing AMP Transcript {amp_transcript}:")
-        raise
-        
+    if isinstance(amp_transcript, SpeechToText):
+        amp_transcript_obj = amp_transcript
+    else:
+        try:
+            data = amp_transcript if isinstance(amp_transcript, dict) else read_json_file(amp_transcript)
+            amp_transcript_obj = SpeechToText.from_json(data)
+        except Exception:
+            logging.exception(f"Exception while parsing AMP Transcript {amp_transcript if not isinstance(amp_transcript, dict) else ''}:")
+            raise
+        if filename is None and not isinstance(amp_transcript, dict):
+            filename = str(amp_transcript)
+
     # initialize the amp_entities object with media information
     amp_entities_obj = EntityExtraction()
-    mediaLength = len(amp_transcript_obj.results.transcript)
-    amp_entities_obj.media = EntityExtractionMedia(mediaLength, amp_transcript)
+    amp_entities_obj.media = EntityExtractionMedia(len(amp_transcript_obj.results.transcript), filename or "")
+    job = NerJob(amp_transcript_obj, amp_entities_obj, ignore_types)
+    if job.empty:
+        logging.warning(f"Warning: Input AMP Transcript has empty transcript, will output AMP NER Json with empty entities list.")
+    return job
 
-    # If input AMP transcript is empty, don't error, instead, output AMP Entity JSON with empty entity list and complete the whole process
-    if mediaLength == 0:
-        logging.warning(f"Warning: Input AMP Transcript Json file has empty transcript, will output AMP NER Json with empty entities list.")
-        write_json_file(amp_entities_obj, amp_entities)
-        exit(0)
 
-    # otherwise return the intermediate results of the preprocess
-    return [amp_transcript_obj, amp_entities_obj, ignore_types_list]
+# Run NER for a batch of (amp_transcript, amp_entities, ignore_types) jobs in this process, so a NER model only has to
+# be loaded once.  amp_transcript is anything prepare_amp_entities accepts and amp_entities is the output file name, or
+# None to not write it.  ner is a callable taking the transcript text and returning its entities (see chunked_ner for
+# running it on long transcripts).  A job which fails doesn't stop the rest.  Returns the list of NerJobs, with the
+# error set on the failed ones.
+def process_amp_entities(jobs, ner):
+    results = []
+    for amp_transcript, amp_entities, ignore_types in jobs:
+        job = None
+        try:
+            job = prepare_amp_entities(amp_transcript, ignore_types)
+            if not job.empty:
+                job.stats = populate_amp_entities(job.transcript, ner(job.transcript.results.transcript), job.entities, job.ignore_types)
+            if amp_entities is not None:
+                write_json_file(job.entities, amp_entities)
+        except Exception as e:
+            logging.error(f"NER job for {amp_transcript if not isinstance(amp_transcript, (dict, SpeechToText)) else 'transcript'} failed: {e}")
+            if job is None:
+                job = NerJob(SpeechToText(), EntityExtraction(), [])
+            job.error = e
+        results.append(job)
+    failed = len([x for x in results if x.error is not None])
+    logging.info(f"Processed {len(results)} NER jobs, {failed} failed.")
+    return results
 
 
 # Populate entities in output AMP entities object, based on the input AMP transcript object, the output NER entities list, and the ignored categories.
+# Each entity is matched to the word containing its begin offset (even if it starts mid-word) by a binary search of a
+# sorted offset index, and its end time comes from the last word it covers.  Only a summary and any entities which
+# raise an exception are logged.
 def populate_amp_entities(amp_transcript_obj, ner_entities_list, amp_entities_obj, ignore_types_list):
-    words = amp_transcript_obj.results.words
-    lenw = len(words)
+    index = WordIndex(amp_transcript_obj.results.words)
     lene = len(ner_entities_list)
-    last = -1  # index of last matched word in AMP Transcript words list
-    ignored = 0 # count of ignored entities
+    stats = {'ignored': 0, 'unmatched': 0, 'mismatched': 0, 'errors': 0}
     mgm = "NER" # initialize for AWS/Spacy in case ner_entities_list is empty 
+    lena = len(amp_entities_obj.entities)
     
     # go through entities from NER output
     for entity in ner_entities_list:
         try:
-            if isinstance(entity, dict):
-                mgm = "AWS"
-                type = entity["Type"]
-                text = entity["Text"]
-                beginOffset = entity["BeginOffset"] - 1
-                endOffset = entity["EndOffset"] - 1
-                scoreType = "relevance"
-                scoreValue = entity["Score"]
-            else: 
-                mgm = "Spacy"
-                type = entity.label_
-                text = entity.text
-                beginOffset = entity.start_char
-                endOffset = entity.end_char
-                scoreType = None
-                scoreValue = None
-            end = None
-            logging.info(f"Entity {mgm}: {type} '{text}'@{beginOffset}-{endOffset}")
+            mgm, type, text, beginOffset, endOffset, scoreType, scoreValue = entity_fields(entity)
             # skip entity in the ignore categories
             if clean_type(type) in ignore_types_list:
-                ignored = ignored + 1
-                logging.info(f"Ignoring entity {text} of type {type}.")
+                stats['ignored'] += 1
                 continue
     
-            # find the word in words list matching the offset of entity, starting from last matched word, as
-            # we can assume that both AMP Transcript words and NER Entities are sorted in the time/offset order        
-            for i in range(last+1, lenw):
-                # find a match by offset
-                logging.info(f"Word {i}: '{words[i].text}'@{words[i].offset}")
-                if words[i].offset == beginOffset:
-                    textamp = words[i].text
-                    # check if text match, note that entity could be multi-words, so we need to check if it starts with the matching word
-                    # if not, something is wrong; will still take it as a match 
-                    if not text.startswith(clean_word(textamp)):
-                        logging.warning(f"Warning: output {mgm} Entity {text} does not start with input AMP Transcript words[{i}] = {textamp}, even though both start at offset {beginOffset}.")
-                    last = i
-                    break
-            # reached the end of words list, match not found
-            else:
-                last = lenw
-                
-            # if reached end of words list and no matched word is found for current entity, no need to match the rest of entities
-            if last == lenw:
-                logging.warning(f"Warning: Reaching the end of AMP Transcript words list with some {mgm} entities remaining unmatched.")
-                break
-            # otherwise a match is found, add a new entity for it to entities list
-            else:               
-                start = words[last].start
-                amp_entities_obj.addEntity(type, text, beginOffset, endOffset, start, end, scoreType, scoreValue)
-        except Exception:
+            first = index.find(beginOffset, endOffset)
+            if first is None:
+                stats['unmatched'] += 1
+                logging.debug(f"No {mgm} word for entity {text} at offset {beginOffset}")
+                continue
+            word = index.words[first]
+            # check if text match, note that entity could be multi-words, so we need to check if it starts with the matching word
+            # if not, something is wrong; will still take it as a match 
+            if word.offset == beginOffset and not text.startswith(clean_word(word.text)):
+                stats['mismatched'] += 1
+                logging.debug(f"{mgm} Entity {text} does not start with input AMP Transcript word {word.text}, even though both start at offset {beginOffset}.")
+            last = index.last(first, endOffset)
+            amp_entities_obj.addEntity(type, text, beginOffset, endOffset, word.start, index.words[last].end, scoreType, scoreValue)
+        except Exception as e:
             # in case of exception, most likely due to missing fields, skip the entity in error and continue with the rest
-            logging.exception("Error: Exception while processing {mgm} entity {text} at offset {begineOffset}")
-            
+            stats['errors'] += 1
+            logging.warning(f"Exception while processing entity {entity}: {e}", exc_info=True)
+
+    lena = len(amp_entities_obj.entities) - lena
+    logging.info(f"Among all {lene} {mgm} entities, {lena} are successfully populated into AMP Entities, {stats['ignored']} are ignored, {stats['unmatched']} are unmatched, {stats['errors']} had errors.")
+    if stats['mismatched']:
+        logging.warning(f"{stats['mismatched']} {mgm} entities don't start with the text of the AMP Transcript word at their offset.")
+    stats['populated'] = lena
+    return stats
+
+
+class WordIndex:
+    "A sorted index of the transcript words' offsets, for finding the words covered by a range of characters"
+    def __init__(self, words):
+        indexed = sorted((w.offset, i) for i, w in enumerate(words) if w.offset is not None)
+        self.words = [words[i] for _, i in indexed]
+        self.offsets = [o for o, _ in indexed]
+        self.ends = [o + len(w.text or '') for o, w in zip(self.offsets, self.words)]
+
+    def find(self, begin, end=None):
+        """Return the index of the word containing the begin offset, or the
+        next word if begin is between words and that word starts before end.
+        Returns None if there isn't one"""
+        i = bisect_right(self.offsets, begin) - 1
+        if i >= 0 and begin < max(self.ends[i], self.offsets[i] + 1):
+            # use the first of any words sharing the offset
+            return bisect_left(self.offsets, self.offsets[i])
+        i += 1
+        if i < len(self.offsets) and (end is None or self.offsets[i] < end):
+            return i
+        return None
+
+    def last(self, first, end):
+        "Return the index of the last word starting before the end offset, which is at least first"
+        return max(first, bisect_left(self.offsets, end) - 1)
+
+
+# Return the MGM name, type, text, begin and end offsets, and score type and value of an entity from AWS or Spacy.
+def entity_fields(entity):
+    # This code absolutely belongs in the MGM in question, not in a
+    # utilities library.  
+    if isinstance(entity, dict):
+        return ("AWS", entity["Type"], entity["Text"], entity["BeginOffset"] - 1, entity["EndOffset"] - 1,
+                "relevance", entity["Score"])
+    else:
+        return ("Spacy", entity.label_, entity.text, entity.start_char, entity.end_char, None, None)
 
-    lena = len(amp_entities_obj.entities)
-    logging.info(f"Among all {lene} {mgm} entities, {lena} are successfully populated into AMP Entities, {ignored} are ignored, {lene-lena-ignored} are unmatched.")
-    
 
 # Populate entities in output AMP entities object, based on the input AMP transcript object, the output NER entities list, and the ignored categories.
 # THIS is a rewrite since the other one does really weird things.
@@ -155,6 +229,104 @@ def populate_amp_entities2(amp_transcript_obj, ner_entities_list, amp_entities_o
  
 
 
+# Run a NER callable over a long text by splitting it into chunks at sentence boundaries, optionally in a pool of processes.
+# The ner callable takes a string and returns a list of entities, either AWS-style dicts or spaCy-style objects
+# (with label_, text, start_char and end_char), and it has to be picklable if processes is more than 1.  Neighboring
+# chunks overlap by about overlap characters for context, and each overlap is split at its midpoint between the two
+# chunks:  only the entities starting in the part a chunk owns are kept, and any of those overlapping an entity kept
+# from the previous chunk are dropped, so a model which sees the overlap differently from each side can't report the
+# same entity twice.  An entity shorter than half the overlap is always seen whole by the chunk keeping it.
+# Returns the entities with their offsets in the full text, sorted by offset:  AWS dicts are copied with the offsets
+# changed, and other entities are returned as NamedEntity objects.
+def chunked_ner(text, ner, max_chars=20000, overlap=200, processes=1, initializer=None, initargs=()):
+    chunks = chunk_text(text, max_chars, overlap)
+    logging.info(f"Running NER on {len(text)} characters in {len(chunks)} chunks with {processes} processes")
+    if processes > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(processes, initializer=initializer, initargs=initargs) as pool:
+            results = list(pool.map(_chunk_ner, [ner] * len(chunks), [x[2] for x in chunks]))
+    else:
+        if initializer is not None:
+            initializer(*initargs)
+        results = [_chunk_ner(ner, x[2]) for x in chunks]
+
+    # the midpoints of the overlaps between neighboring chunks
+    bounds = [0] + [(chunks[i + 1][0] + chunks[i][1]) // 2 for i in range(len(chunks) - 1)] + [len(text)]
+    entities = []
+    kept_end = 0
+    for i, ((start, _, _), found) in enumerate(zip(chunks, results)):
+        owned = []
+        for begin_char, end_char, entity in found:
+            begin_char += start
+            if bounds[i] <= begin_char < bounds[i + 1] and begin_char >= kept_end:
+                owned.append((begin_char, end_char + start, _shift_entity(entity, start)))
+        owned.sort(key=lambda x: x[0:2])
+        entities.extend(x[2] for x in owned)
+        kept_end = max([kept_end] + [x[1] for x in owned])
+    return entities
+
+
+# Split text into (start, end, chunk) tuples of at most max_chars characters, at sentence ends if possible and
+# otherwise at whitespace.  Each chunk but the first starts about overlap characters before the previous one ends.
+def chunk_text(text, max_chars=20000, overlap=200):
+    if overlap >= max_chars // 2:
+        raise ValueError("The overlap must be less than half of the chunk size")
+    sentence_ends = [m.end() for m in re.finditer(r'[.!?]+["\')\]]*\s+', text)]
+    chunks = []
+    start = 0
+    while True:
+        limit = start + max_chars
+        if limit >= len(text):
+            chunks.append((start, len(text), text[start:]))
+            break
+        # cut after the last sentence in the chunk, after the overlap
+        i = bisect_right(sentence_ends, limit) - 1
+        cut = sentence_ends[i] if i >= 0 and sentence_ends[i] > start + overlap else None
+        if cut is None:
+            space = text.rfind(' ', start + overlap, limit)
+            cut = space + 1 if space >= 0 else limit
+        chunks.append((start, cut, text[start:cut]))
+        # start the next chunk at a word boundary in the overlap
+        start = cut - overlap
+        space = text.find(' ', start, cut)
+        start = space + 1 if space >= 0 else cut
+    return chunks
+
+
+class NamedEntity:
+    "A picklable spaCy-style entity, as returned by chunked_ner"
+    def __init__(self, label_, text, start_char, end_char):
+        self.label_ = label_
+        self.text = text
+        self.start_char = start_char
+        self.end_char = end_char
+
+    def __repr__(self):
+        return f"NamedEntity({self.label_!r}, {self.text!r}, {self.start_char}, {self.end_char})"
+
+
+# Run the NER callable on one chunk, returning (begin, end, entity) tuples with picklable entities.
+def _chunk_ner(ner, text):
+    results = []
+    for entity in ner(text):
+        if isinstance(entity, dict):
+            # AWS offsets are one more than the character offset, as in populate_amp_entities
+            results.append((entity["BeginOffset"] - 1, entity["EndOffset"] - 1, entity))
+        else:
+            results.append((entity.start_char, entity.end_char,
+                            NamedEntity(entity.label_, entity.text, entity.start_char, entity.end_char)))
+    return results
+
+
+# Return a copy of the entity with its offsets moved by delta.
+def _shift_entity(entity, delta):
+    if isinstance(entity, dict):
+        entity = dict(entity)
+        entity["BeginOffset"] += delta
+        entity["EndOffset"] += delta
+        return entity
+    return NamedEntity(entity.label_, entity.text, entity.start_char + delta, entity.end_char + delta)
+
+
 # Extract a list of cleaned entity types from the given comma separated ignore_types string. 
 def extract_ignore_types(ignore_types):    
     return list(map(clean_type, ignore_types.split(',')))
@@ -14,6 +14,9 @@ import os
 import shutil
 import re
 import fcntl
+import hashlib
+import mmap
+from concurrent.futures import ThreadPoolExecutor
 
 # Packages are simple tarballs with these properties:
 # * Top level directory that matches the package name
@@ -25,8 +28,12 @@ import fcntl
 #   * install_path: Installation directory, relative to the AMP root
 #   * hooks:  hook -> script mapping for different packing actions
 #   * metapackage:  true if there's no payload, just hooks and configuration
+#   * manifest: (optional) name of the payload manifest file in <base>
 # * A data directory which contains the payload (for non-metapackages)
 # * A hooks directory for any hook scripts
+# * A manifest in <base>/amp_manifest.yaml which has the sha256 and size of
+#   every regular file in the payload, relative to the data directory.  When 
+#   installed, it is stored in data/package_manifests/<base>.yaml
 # * If user defaults are supplied, a "user_defaults.yaml" file will be
 #   installed in data/default_config/<base>.user_defaults
 # * If system defaults are supplied, a "system_defaults.yaml" file will be
@@ -40,17 +47,26 @@ import fcntl
 #   stop = called when the package needs to be stopped
 # when installed config, start, and stop hook scripts are stored in data/package_hooks,
 # named as <package name>__<hook_name>
+#
+# Reproducible packages:
+# If the package is created in reproducible mode (or SOURCE_DATE_EPOCH is set in
+# the environment), the members are added in sorted order and the timestamps,
+# ownership, and build_date are normalized to SOURCE_DATE_EPOCH (or 0) so identical 
+# inputs produce byte-identical packages.
 
 
 REQUIRED_META = {'format', 'name', 'version', 'build_date', 'install_path', 'arch', 'metapackage'}
 ALL_HOOKS = {'pre', 'post', 'config', 'start', 'stop'}
+MANIFEST_FILE = "amp_manifest.yaml"
+HASH_THREADS = min(8, os.cpu_count() or 1)
 
 def create_package(name: str, version: str, install_path: str,
                    destination_dir: Path, payload_dir: Path, 
                    hooks: dict=None, system_defaults=None, user_defaults=None, 
-                   arch_specific=False, depends_on=None, src_path=None) -> Path:
+                   arch_specific=False, depends_on=None, src_path=None, reproducible=None) -> Path:
     """Create a new package from the content in payload_dir, returning the package Path.  
-       metadata keywords will go into amp_package.yaml"""
+       metadata keywords will go into amp_package.yaml.  If reproducible is None,
+       reproducible mode is used when SOURCE_DATE_EPOCH is set"""
     if not destination_dir.is_dir():
         raise NotADirectoryError(f"Destination directory needs to be a directory: {destination_dir!s}")
     if payload_dir and not payload_dir.is_dir():
@@ -66,17 +82,29 @@ def create_package(name: str, version: str, install_path: str,
             src_path = os.getcwd()
         # any other places?
 
+    # the timestamp used for everything in the package.
+    if reproducible is None:
+        reproducible = 'SOURCE_DATE_EPOCH' in os.environ
+    if reproducible:
+        build_time = int(os.environ.get('SOURCE_DATE_EPOCH', 0))
+        build_date = datetime.utcfromtimestamp(build_time).strftime("%Y%m%d_%H%M%S")
+    else:
+        build_time = int(time.time())
+        build_date = datetime.now().strftime("%Y%m%d_%H%M%S")
+
     # store the core metadata
     metadata = {
         'format': 1,
         'name': name, 
         'version': version,
-        'build_date': datetime.now().strftime("%Y%m%d_%H%M%S"),
+        'build_date': build_date,
         'build_revision': "Cannot find source path" if src_path is None else git_info(src_path),
         'install_path': install_path,
         'arch': platform.machine() if arch_specific else 'noarch',
         'metapackage': payload_dir is None,
     }
+    if payload_dir:
+        metadata['manifest'] = MANIFEST_FILE
 
     # we need to make sure the name doesn't contain any weird characters
     if not re.match(r'^[\w\-]+$', metadata['name']):
@@ -105,10 +133,19 @@ def create_package(name: str, version: str, install_path: str,
     logging.info(f"Creating package for {metadata['name']} with version {metadata['version']} in {destination_dir}")
     basename = metadata['name'] + "__" + metadata['version'] + "__" + metadata['arch']
     pkgfile = Path(destination_dir, basename + ".tar")
-    with tarfile.TarFile(pkgfile, "w") as tfile:
+
+    def normalize(tinfo):
+        # strip anything that depends on when or by whom the package was built
+        if reproducible:
+            tinfo.mtime = build_time
+            tinfo.uid = tinfo.gid = 0
+            tinfo.uname = tinfo.gname = ""
+        return tinfo
+
+    with tarfile.TarFile(pkgfile, "w", format=tarfile.PAX_FORMAT if reproducible else tarfile.DEFAULT_FORMAT) as tfile:
         # create base directory
         base_info = tarfile.TarInfo(name=basename)
-        base_info.mtime = int(time.time())
+        base_info.mtime = build_time
         base_info.type = tarfile.DIRTYPE
         base_info.mode = 0o755
         tfile.addfile(base_info, None)                    
@@ -117,32 +154,60 @@ def create_package(name: str, version: str, install_path: str,
         metafile = tarfile.TarInfo(name=f"{basename}/amp_package.yaml")
         metafile_data = yaml.safe_dump(metadata, default_flow_style=False).encode('utf-8')
         metafile.size = len(metafile_data)
-        metafile.mtime = int(time.time())
+        metafile.mtime = build_time
         metafile.mode = 0o644
         tfile.addfile(metafile, io.BytesIO(metafile_data))
 
-        # grab the payload
+        # grab the payload, hashing the files in the background while
+        # they're being added to the tarball.
         logging.debug(f"Pushing data from {payload_dir!s} to data in tarball")
         if payload_dir:
-            tfile.add(payload_dir, f"{basename}/data", recursive=True)
+            digests = {}
+            with ThreadPoolExecutor(HASH_THREADS) as hash_pool:
+                for root, dirs, files in os.walk(payload_dir):
+                    for n in files:
+                        f = Path(root, n)
+                        if f.is_file() and not f.is_symlink():
+                            digests[f.relative_to(payload_dir).as_posix()] = hash_pool.submit(hash_file, f)
+                if reproducible:
+                    # walk the tree ourselves so the order doesn't depend on the filesystem
+                    tfile.add(payload_dir, f"{basename}/data", recursive=False, filter=normalize)
+                    for root, dirs, files in os.walk(payload_dir):
+                        dirs.sort()
+                        relroot = Path(root).relative_to(payload_dir)
+                        for n in sorted(dirs + files):
+                            tfile.add(Path(root, n), f"{basename}/data/{(relroot / n).as_posix()}", 
+                                      recursive=False, filter=normalize)
+                else:
+                    tfile.add(payload_dir, f"{basename}/data", recursive=True)
+
+            # write the manifest once all of the hashes are in
+            manifest = {'algorithm': 'sha256', 
+                        'files': {k: dict(zip(('sha256', 'size'), digests[k].result())) for k in digests}}
+            manifest_info = tarfile.TarInfo(name=f"{basename}/{MANIFEST_FILE}")
+            manifest_data = yaml.safe_dump(manifest, default_flow_style=False).encode('utf-8')
+            manifest_info.size = len(manifest_data)
+            manifest_info.mtime = build_time
+            manifest_info.mode = 0o644
+            tfile.addfile(manifest_info, io.BytesIO(manifest_data))
 
         # grab any hooks
         if hooks:
             hooks_dir = tarfile.TarInfo(name=basename + "/hooks")
-            hooks_dir.mtime = int(time.time())
+            hooks_dir.mtime = build_time
             hooks_dir.type = tarfile.DIRTYPE
             hooks_dir.mode = 0o755
             tfile.addfile(hooks_dir, None)                    
             # add each of the hooks
-            for h in ALL_HOOKS:
+            for h in sorted(ALL_HOOKS):
                 if h in hooks:
-                    tfile.add(hookfiles[h], basename + "/hooks/" + Path(hooks[h]).name)
+                    tfile.add(hookfiles[h], basename + "/hooks/" + Path(hooks[h]).name, filter=normalize)
 
         # copy the defaults into the package
         if user_defaults:
-            tfile.add(user_defaults, basename + "/user_defaults.yaml")
+            tfile.add(user_defaults, basename + "/user_defaults.yaml", filter=normalize)
         if system_defaults:
-            tfile.add(system_defaults, basename + "/system_defaults.yaml")
+            tfile.add(system_defaults, basename + "/system_defaults.yaml", filter=normalize)
 
     return pkgfile
 
@@ -171,6 +236,9 @@ def validate_package(package_file: Path) -> dict:
             if not metadata.get('metapackage', False) and basename + "/data" not in pkgfiles:
                 raise ValueError("Package doesn't have a payload directory")
 
+            if 'manifest' in metadata and f"{basename}/{metadata['manifest']}" not in pkgfiles:
+                raise ValueError("Package doesn't contain the manifest file")
+
         else:
             raise IOError(f"Unsupported package format {metadata['format']}")
 
@@ -219,6 +287,19 @@ def install_package(package, amp_root):
                 if defaults_file.exists():
                     shutil.copyfile(defaults_file, defaults_name)
 
+            # keep the payload manifest so the installation can be verified later
+            manifest_name = Path(amp_root, f"data/package_manifests/{metadata['name']}.yaml")
+            manifest_name.parent.mkdir(parents=True, exist_ok=True)
+            if manifest_name.exists():
+                manifest_name.unlink()
+            if 'manifest' in metadata and (pkgroot / metadata['manifest']).exists():
+                with open(pkgroot / metadata['manifest']) as f:
+                    manifest = yaml.safe_load(f)
+                # the files in the manifest are relative to the install path
+                manifest['install_path'] = metadata['install_path']
+                with open(manifest_name, "w") as f:
+                    yaml.safe_dump(manifest, f, default_flow_style=False)
+
             # copy the post-installation hook scripts to the data/package_hooks directory
             hook_dir = Path(amp_root, "data/package_hooks")
             
@@ -266,6 +347,50 @@ def newer_version(old, new):
     return new >= old
 
 
+def hash_file(file):
+    "Return the (sha256 hexdigest, size) of a file"
+    h = hashlib.sha256()
+    with open(file, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size:
+            # hashlib releases the GIL for big buffers, so mapping the whole 
+            # file lets multiple threads hash in parallel.
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                h.update(m)
+    return h.hexdigest(), size
+
+
+def verify_manifest(manifest, install_path, threads=HASH_THREADS):
+    """Compare the files under install_path against a package manifest.
+       Returns a dict with lists of 'missing' and 'modified' files, a dict
+       of 'errors' for files which couldn't be read, and the number of 'files' 
+       and 'bytes' that were checked"""
+    results = {'missing': [], 'modified': [], 'errors': {}, 'files': 0, 'bytes': 0}
+
+    def check(name):
+        try:
+            return name, hash_file(Path(install_path, name))
+        except FileNotFoundError:
+            return name, None
+        except OSError as e:
+            return name, e
+
+    with ThreadPoolExecutor(threads) as pool:
+        for name, actual in pool.map(check, sorted(manifest['files'])):
+            expected = manifest['files'][name]
+            if actual is None:
+                results['missing'].append(name)
+                continue
+            if isinstance(actual, OSError):
+                results['errors'][name] = actual
+                continue
+            results['files'] += 1
+            results['bytes'] += actual[1]
+            if actual != (expected['sha256'], expected['size']):
+                results['modified'].append(name)
+    return results
+
+
 def dependency_order(dbfile):
     "Go through the package database and return a list with the least-to-most package dependency order"
     deps = {}
@@ -288,41 +413,104 @@ def dependency_order(dbfile):
     return order
 
 
-def git_info(repopath):
-    "Get the git information for a given repository"
-    here = os.getcwd()
-    os.chdir(repopath)    
-    if Path(".git").exists():
-        p = subprocess.run(['git', 'branch', '--show-current'], stdout=subprocess.PIPE, encoding='utf-8')
-        branch = p.stdout.strip()
-        p = subprocess.run(['git', 'log', "--pretty=format:'%h'", '-n', '1'], stdout=subprocess.PIPE, encoding='utf-8')
-        commit = p.stdout.replace("'", '').strip()
-        p = subprocess.run(['git', 'diff', '--name-only'], stdout=subprocess.PIPE, encoding='utf-8')
+_git_info_cache = {}
+
+def git_info(repopath, refresh=False):
+    """Get the git information for a given repository.  The branch and commit
+       are read directly from the .git directory so the process cwd is never
+       changed, and the result is cached per repository path unless refresh
+       is specified"""
+    repopath = Path(repopath).resolve()
+    if not refresh and repopath in _git_info_cache:
+        return _git_info_cache[repopath]
+
+    gitdir = _find_git_dir(repopath)
+    if gitdir is None:
+        info = "Not a git repo"
+    else:
+        branch, commit = _read_git_head(gitdir)
+        # the dirty check needs the index and the work tree, so we let git
+        # handle that one.
+        p = subprocess.run(['git', 'diff', '--name-only'], cwd=repopath, 
+                           stdout=subprocess.PIPE, encoding='utf-8')
         # package-lock.json gets updated on every build so we just ignore it.
         changed = len(p.stdout.replace('package-lock.json', '').strip()) != 0
         info = f"Branch: {branch}, Commit: {commit}{'' if not changed else ', Uncommited Changes'}"
-    
-    else:
-        info = "Not a git repo"
 
-    os.chdir(here)
+    _git_info_cache[repopath] = info
     return info
 
 
+def _find_git_dir(repopath: Path):
+    "Return the git directory for a repository, or None if it isn't one"
+    dotgit = repopath / ".git"
+    if dotgit.is_dir():
+        return dotgit
+    if dotgit.is_file():
+        # submodules and worktrees have a .git file that points to
+        # the real git directory
+        text = dotgit.read_text().strip()
+        if text.startswith("gitdir:"):
+            gitdir = Path(text[7:].strip())
+            if not gitdir.is_absolute():
+                gitdir = repopath / gitdir
+            return gitdir.resolve()
+    return None
+
+
+def _read_git_head(gitdir: Path):
+    "Return the (branch, short commit) for the HEAD of the git directory"
+    head = (gitdir / "HEAD").read_text().strip()
+    if not head.startswith("ref:"):
+        # detached head
+        return "", head[0:7]
+    ref = head[4:].strip()
+    branch = ref[11:] if ref.startswith("refs/heads/") else ref
+
+    # worktrees keep their refs in the common directory
+    commondir = gitdir
+    if (gitdir / "commondir").exists():
+        commondir = (gitdir / (gitdir / "commondir").read_text().strip()).resolve()
+
+    for d in (gitdir, commondir):
+        reffile = d / ref
+        if reffile.is_file():
+            return branch, reffile.read_text().strip()[0:7]
+
+    # loose ref not found, so look in the packed refs.
+    for d in (gitdir, commondir):
+        packed = d / "packed-refs"
+        if packed.is_file():
+            with open(packed) as f:
+                for line in f:
+                    if line.startswith(('#', '^')):
+                        continue
+                    parts = line.split()
+                    if len(parts) == 2 and parts[1] == ref:
+                        return branch, parts[0][0:7]
+
+    # a new repo without any commits
+    return branch, ""
+
+
 class PackageDB:
     "Manage the PackageDB file which tracks package installation information"
-    def __init__(self, dbfile):
+    def __init__(self, dbfile, readonly=False):
+        "Open the database.  A readonly database takes a shared lock and isn't written back"
         self.dbfile = dbfile
+        self.readonly = readonly
 
     def __enter__(self):
         # open the file and get the lock
         try:
-            self.file = open(self.dbfile, "r+")
-            fcntl.lockf(self.file, fcntl.LOCK_EX)            
+            self.file = open(self.dbfile, "r" if self.readonly else "r+")
+            fcntl.lockf(self.file, fcntl.LOCK_SH if self.readonly else fcntl.LOCK_EX)
             self.data = yaml.safe_load(self.file)   
             if '__PACKAGE_DATABASE__' not in self.data or self.data['__PACKAGE_DATABASE__'].get('VERSION', 0) != 1:
                 raise ValueError(f"Package database file {self.dbfile!s} is invalid")
         except FileNotFoundError:
+            if self.readonly:
+                raise
             self.file = open(self.dbfile, "w+")
             fcntl.lockf(self.file, fcntl.LOCK_EX)
             self.data = {'__PACKAGE_DATABASE__': {'NOTICE': 'Do not modify this file, it is programatically maintained',
@@ -333,9 +521,10 @@ class PackageDB:
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         # write the current data back to the disk
-        self.file.seek(0, os.SEEK_SET)
-        self.file.write(yaml.safe_dump(self.data, default_flow_style=False))        
-        self.file.truncate()
+        if not self.readonly:
+            self.file.seek(0, os.SEEK_SET)
+            self.file.write(yaml.safe_dump(self.data, default_flow_style=False))        
+            self.file.truncate()
         fcntl.lockf(self.file, fcntl.LOCK_UN)
         self.file.close()
 
@@ -0,0 +1,179 @@
+"Client for the AMP REST API"
+
+import http.client
+import json
+import socket
+import logging
+import queue
+import threading
+import time
+import base64
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, quote
+
+
+class AmpRest:
+    """A small client for the AMP REST interface.  Connections are kept alive
+       and reused from a pool, and the JWT token is cached until it is about
+       to expire, so it is cheap to make many requests.  It is thread-safe."""
+    def __init__(self, url_base, username, password, pool_size=4, timeout=60):
+        url = urlsplit(url_base)
+        if url.scheme not in ('http', 'https'):
+            raise ValueError(f"Unsupported URL scheme for {url_base}")
+        self.url_base = url_base.rstrip('/')
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self._conn_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+        self._netloc = url.netloc
+        self._prefix = url.path.rstrip('/')
+        self._pool = queue.LifoQueue()
+        self._token = None
+        self._token_expires = 0
+        self._token_lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config, **kwargs):
+        "Create a client from an AMP configuration"
+        return cls(f"http://{config['amp']['host']}:{config['amp']['port']}",
+                   config['rest']['admin_username'], config['rest']['admin_password'], **kwargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def close(self):
+        "Close all of the pooled connections"
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+    def request(self, method, path, data=None, auth=True):
+        """Make a request to the REST service, returning the decoded JSON response
+           (or None if there isn't a body).  Raises IOError for error responses.
+           The request is only resent if a pooled connection was dropped
+           before any of the response arrived"""
+        headers = {'Accept': 'application/json'}
+        body = None
+        if data is not None:
+            body = json.dumps(data).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        if auth:
+            headers['Authorization'] = f"Bearer {self.token()}"
+
+        try:
+            conn = self._pool.get_nowait()
+            pooled = True
+        except queue.Empty:
+            conn = self._connect()
+            pooled = False
+
+        while True:
+            try:
+                conn.request(method, self._prefix + path, body=body, headers=headers)
+                res = conn.getresponse()
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                # the server may have closed an idle keep-alive connection, so
+                # try again with a fresh one.  A new connection failing before
+                # the response could mean the server got the request, so it
+                # isn't retried.
+                conn.close()
+                if not pooled:
+                    raise
+                conn = self._connect()
+                pooled = False
+                continue
+            except Exception:
+                conn.close()
+                raise
+            try:
+                rdata = res.read()
+            except Exception:
+                conn.close()
+                raise
+            break
+
+        if res.will_close or self._pool.qsize() >= self.pool_size:
+            conn.close()
+        else:
+            self._pool.put(conn)
+
+        logging.debug(f"{method} {path}: {res.status}")
+        if res.status >= 400:
+            raise IOError(f"{method} {path} failed: {res.status} {res.reason}: {rdata[0:200]!r}")
+        return json.loads(rdata) if rdata else None
+
+    def _connect(self):
+        "Create a new connection"
+        conn = self._conn_class(self._netloc, timeout=self.timeout)
+        conn.connect()
+        # http.client sends the headers and body separately, so don't let
+        # Nagle's algorithm hold the body back.
+        conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return conn
+
+    def token(self):
+        "Get the JWT token, authenticating if it isn't cached or is about to expire"
+        with self._token_lock:
+            if self._token is None or time.time() > self._token_expires - 30:
+                rdata = self.request('POST', "/rest/account/authenticate",
+                                     {'username': self.username, 'password': self.password}, auth=False)
+                self._token = rdata['token']
+                self._token_expires = _jwt_expiration(self._token)
+            return self._token
+
+    def find_unit(self, name):
+        "Return the unit with the given name, or None"
+        rdata = self.request('GET', "/rest/units/search/findByName?name=" + quote(name))
+        units = rdata['_embedded']['units']
+        return units[0] if units else None
+
+    def create_unit(self, name):
+        "Create a unit and return it"
+        return self.request('POST', "/rest/units", {'name': name})
+
+    def ensure_unit(self, name):
+        "Create a unit if it doesn't exist, returning True if it was created"
+        if self.find_unit(name) is not None:
+            return False
+        self.create_unit(name)
+        return True
+
+    def create_collection(self, unit, name, description="", **kwargs):
+        "Create a collection in a unit (which is a unit returned from find_unit)"
+        data = {'name': name, 'description': description, 'unit': unit['_links']['self']['href']}
+        data.update(kwargs)
+        return self.request('POST', "/rest/collections", data)
+
+    def ensure_units(self, names):
+        "Create any of the units which don't already exist, returning a dict of name -> created"
+        return dict(zip(names, self._batch(self.ensure_unit, [(x,) for x in names])))
+
+    def create_collections(self, unit_name, collections):
+        """Create many collections in a unit.  Collections is a list of dicts with
+           at least a name and any other collection fields"""
+        unit = self.find_unit(unit_name)
+        if unit is None:
+            raise ValueError(f"Unit {unit_name} doesn't exist")
+        return self._batch(lambda c: self.create_collection(unit, **c), [(x,) for x in collections])
+
+    def _batch(self, func, arglist):
+        "Run func over a list of argument tuples, using the pooled connections concurrently"
+        self.token()
+        with ThreadPoolExecutor(self.pool_size) as pool:
+            return list(pool.map(lambda args: func(*args), arglist))
+
+
+def _jwt_expiration(token):
+    "Get the expiration time from a JWT token, or assume an hour if it can't be found"
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return int(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+    except Exception:
+        return time.time() + 3600
@@ -1,26 +1,55 @@
 from datetime import datetime
+from functools import lru_cache
 import time
+from amp.timeutils import hhmmss2microseconds
 # This is only used by the scoring tools and they really should be using
 # the functions in timeutils
 
+DEFAULT_FORMAT = '%H:%M:%S.%f'
+
+
 def convertToTime(timestamp, format):
     try:
         timeobj = datetime.strptime(timestamp, format)
-    except:
+    except ValueError:
         timestamp = timestamp + '.0'
         timeobj = datetime.strptime(timestamp, format)
     return timeobj
 
-def convertToSeconds(timestamp, format='%H:%M:%S.%f'):
+
+@lru_cache(maxsize=None)
+def _zerotime(format):
+    "The zero time reference for a format"
+    return convertToTime('0:00:00.000', format)
+
+
+def convertToSeconds(timestamp, format=DEFAULT_FORMAT):
     """Convert timestamp to seconds if not already in seconds"""
     if ':' in timestamp:
+        if format == DEFAULT_FORMAT:
+            # the usual case doesn't need strptime at all
+            us = hhmmss2microseconds(timestamp)
+            if us is not None:
+                return us / 10**6
         timeobj = convertToTime(timestamp, format)
-        zerotime = convertToTime('0:00:00.000', format)
-        timeinseconds = float((timeobj - zerotime).total_seconds())
+        timeinseconds = float((timeobj - _zerotime(format)).total_seconds())
     else:
         timeinseconds = float(timestamp)
     return timeinseconds
 
+
+def convertColumnToSeconds(timestamps, format=DEFAULT_FORMAT):
+    "Convert a column of timestamps (as in convertToSeconds) to a list of seconds"
+    if format != DEFAULT_FORMAT:
+        return [convertToSeconds(x, format) for x in timestamps]
+    results = []
+    append = results.append
+    for timestamp in timestamps:
+        us = hhmmss2microseconds(timestamp) if ':' in timestamp else None
+        append(us / 10**6 if us is not None else convertToSeconds(timestamp))
+    return results
+
+
 def convertSecondsToTimestamp(seconds):
     timestamp = time.strftime('%H:%M:%S', time.gmtime(seconds))
     return timestamp
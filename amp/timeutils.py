@@ -1,16 +1,55 @@
 # Utilities related to time
 
-from datetime import datetime
+import re
 from math import floor
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 def timestamp2hhmmss(timestamp):
     "Get a unix epoch timestamp and convert it to hh:mm:ss.sss"
-    hours = int(timestamp / 3600)
-    timestamp -= hours * 3600
-    minutes = int(timestamp / 60)
-    seconds = timestamp - minutes * 60
-    return f"{hours:02d}:{minutes:02d}:{seconds:06.3f}"
+    # round to the millisecond first so 59.9996 doesn't become 00:00:60.000
+    ms = int(timestamp * 1000 + 0.5) if timestamp > 0 else 0
+    seconds, ms = divmod(ms, 1000)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}.{ms:03d}"
+
+
+class TimestampFormatter:
+    """Format timestamps as hh:mm:ss.sss the same way as timestamp2hhmmss, 
+    but faster when there are many of them:  the hh:mm:ss part is cached for
+    recent whole seconds and the milliseconds come from a table."""
+    MILLISECONDS = ["%03d" % x for x in range(1000)]
+
+    def __init__(self, cache_size=4096):
+        self.cache_size = cache_size
+        self._seconds = {}
+
+    def __call__(self, timestamp):
+        ms = int(timestamp * 1000 + 0.5) if timestamp > 0 else 0
+        whole, ms = divmod(ms, 1000)
+        prefix = self._seconds.get(whole)
+        if prefix is None:
+            if len(self._seconds) >= self.cache_size:
+                # timestamps usually come in order, so keep the cache from
+                # growing with the number of them
+                self._seconds.clear()
+            minutes, seconds = divmod(whole, 60)
+            hours, minutes = divmod(minutes, 60)
+            prefix = self._seconds[whole] = "%02d:%02d:%02d." % (hours, minutes, seconds)
+        return prefix + self.MILLISECONDS[ms]
+
+
+def timestamps2hhmmss(timestamps):
+    "Convert a sequence (or NumPy array) of timestamps to a list of hh:mm:ss.sss strings"
+    if numpy is not None and isinstance(timestamps, numpy.ndarray):
+        timestamps = timestamps.tolist()
+    # the cache is only kept for this call, so it doesn't need a limit
+    return list(map(TimestampFormatter(len(timestamps)), timestamps))
 
 
 def hhmmss2timestamp(hhmmss):
@@ -29,36 +68,56 @@ def hhmmss2timestamp(hhmmss):
         raise ValueError(f"Can't recognize format of {hhmmss}")
 
 
+def hhmmss2timestamps(values):
+    """Convert a sequence of hh:mm:ss.sss (or mm:ss, or seconds) strings to a
+    list of timestamps, with the same results as hhmmss2timestamp"""
+    results = []
+    append = results.append
+    # the usual case is a fixed-width hh:mm:ss.sss, and there are only a
+    # few distinct "hh:mm:" prefixes, so their seconds are cached.
+    prefixes = {}
+    for hhmmss in values:
+        prefix = hhmmss[:6]
+        base = prefixes.get(prefix)
+        if base is None:
+            parts = prefix.split(':')
+            if len(parts) != 3 or parts[2] != '':
+                append(hhmmss2timestamp(hhmmss))
+                continue
+            base = prefixes[prefix] = int(parts[0]) * 3600 + int(parts[1]) * 60
+        append(base + float(hhmmss[6:]))
+    return results
+
+
+# H:MM:SS with an optional fraction, with the same field rules as strptime's
+# %H:%M:%S.%f (seconds 60 and 61 are left out since datetime rejects them).
+# The digits are spelled out since \d would also take non-ASCII digits, which
+# strptime rejects.
+HHMMSS_PATTERN = re.compile(r'(2[0-3]|[0-1][0-9]|[0-9]):([0-5][0-9]|[0-9]):([0-5][0-9]|[0-9])(?:\.([0-9]{1,6}))?')
+
+
+def hhmmss2microseconds(hhmmss):
+    """Convert H:MM:SS[.ffffff] to an integer number of microseconds, or
+    return None if it isn't in that format"""
+    m = HHMMSS_PATTERN.fullmatch(hhmmss)
+    if m is None:
+        return None
+    hours, minutes, seconds, fraction = m.groups()
+    us = ((int(hours) * 60 + int(minutes)) * 60 + int(seconds)) * 1000000
+    if fraction:
+        us += int(fraction.ljust(6, '0'))
+    return us
+
+
 def timestampToSecond(timestamp):
     "Convert the given timestamp in the format of HH:MM:SS.fff to total seconds."
     return hhmmss2timestamp(timestamp)
-    
-    ts = timestamp.split(".")
-    
-    # no microsecond section    
-    if len(ts) == 1: 
-        t = datetime.strptime(timestamp, "%H:%M:%S")
-    # handle microsecond
-    else: 
-        lms = len(ts[1])
-         # strptime can handle at most 6 digits on microsecond, strip off the extra digits
-        if lms > 6:
-            timestamp = timestamp[:6-lms]
-        t = datetime.strptime(timestamp, "%H:%M:%S.%f")
-        
-    delta = t - datetime(1900, 1, 1)
-    second = delta.total_seconds()
-    return second 
 
 
 def secondToTimestamp(second): 
     "Convert the given second to timestamp in the format of HH:MM:SS.fff"
     return timestamp2hhmmss(second)
 
-    dt = datetime.utcfromtimestamp(second)
-    timestamp = dt.strftime("%H:%M:%S.%f")[:-3] 
-    return timestamp
-
 
 def secondToFrame(second, fps):
     "Convert the given start time in seconds (float number) to frame index based on the given frame rate."
@@ -73,3 +132,19 @@ def frameToSecond(nframe, fps):
     second = nframe / fps
     return second
 
+
+def secondsToFrames(seconds, fps):
+    """Convert a sequence of times in seconds to frame indexes, as secondToFrame.
+    A NumPy array gets a NumPy array of indexes, otherwise a list is returned"""
+    if numpy is not None and isinstance(seconds, numpy.ndarray):
+        return numpy.floor(seconds * fps).astype(numpy.int64)
+    return [floor(x * fps) for x in seconds]
+
+
+def framesToSeconds(frames, fps):
+    """Convert a sequence of frame indexes to start times in seconds, as 
+    frameToSecond.  A NumPy array gets a NumPy array of times, otherwise a list
+    is returned"""
+    if numpy is not None and isinstance(frames, numpy.ndarray):
+        return frames / fps
+    return [x / fps for x in frames]
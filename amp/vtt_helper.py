@@ -1,7 +1,6 @@
 import time
-from .timeutils import timestamp2hhmmss
-from statistics import median
-import logging
+from itertools import groupby
+from .timeutils import TimestampFormatter
 
 def gen_vtt(subtitles: list) -> str:
     """Generate VTT text based on the list subtitles given. 
@@ -14,45 +13,202 @@ def gen_vtt(subtitles: list) -> str:
     
     Returns a string which is the VTT file
     """
-    result = "WEBVTT\n\n"
+    return "".join(iter_vtt(subtitles))
+
+
+def write_vtt(subtitles, out, notes=None, styles=None):
+    """Write VTT for an iterable of subtitles (as in gen_vtt) to the file-like
+    object out, returning the number of cues written.  The subtitles are 
+    written as they're consumed, so the whole file is never in memory."""
+    writer = VTTWriter(out, notes=notes, styles=styles)
+    writer.write_cues(subtitles)
+    return writer.cues
+
+
+def iter_vtt(subtitles, notes=None, styles=None, batch=1000):
+    """Generate VTT for an iterable of subtitles (as in gen_vtt) as a series
+    of text chunks of up to batch cues each."""
+    chunks = []
+    writer = VTTWriter(chunks, notes=notes, styles=styles)
     for s in subtitles:
-        result += f"{timestamp2hhmmss(s['start'])} --> {timestamp2hhmmss(s['end'])}\n"        
-        speaker = s.get('speaker', None)
-        if speaker:
-            result += f"<v {speaker}>"
-        result += f"{s['text']}\n\n"
-    return result
+        writer.write_cue(s)
+        if len(chunks) >= batch:
+            yield "".join(chunks)
+            chunks.clear()
+    if writer.cues == 0 and not chunks:
+        # make sure the header comes out for an empty file
+        writer.write_header()
+    if chunks:
+        yield "".join(chunks)
+
+
+class VTTWriter:
+    """Write a WebVTT file one cue at a time.  out is either a file-like
+    object or a list that the text is appended to.
+
+    notes and styles are lists of NOTE comments and STYLE blocks (CSS) to put
+    in the header.  More notes can be added between cues with note(), but 
+    styles have to come before the first cue."""
+    def __init__(self, out, notes=None, styles=None):
+        self._write = out.append if isinstance(out, list) else out.write
+        self.header_written = False
+        self.cues = 0
+        self._notes = list(notes or [])
+        self._styles = list(styles or [])
+        self.timestamp = TimestampFormatter()
+
+    def write_header(self):
+        "Write the WEBVTT header and any styles and notes"
+        if self.header_written:
+            return
+        self._write("WEBVTT\n\n")
+        self.header_written = True
+        for style in self._styles:
+            self._write(f"STYLE\n{_block_text(style)}\n\n")
+        for note in self._notes:
+            self.note(note)
+
+    def note(self, text):
+        "Write a NOTE comment"
+        self.write_header()
+        self._write(f"NOTE {_block_text(text)}\n\n")
+
+    def style(self, css):
+        "Add a STYLE block.  It has to be done before any cues are written"
+        if self.header_written:
+            raise ValueError("STYLE blocks have to come before the cues")
+        self._styles.append(css)
+
+    def write_cue(self, cue):
+        "Write a cue (a dict with start, end, text, and optionally speaker)"
+        if not self.header_written:
+            self.write_header()
+        speaker = cue.get('speaker', None)
+        self._write(self.timestamp(cue['start']) + " --> " + self.timestamp(cue['end']) + "\n" +
+                    (f"<v {speaker}>" if speaker else "") + f"{cue['text']}\n\n")
+        self.cues += 1
+
+    def write_cues(self, cues):
+        "Write all of the cues from an iterable"
+        self.write_header()
+        for cue in cues:
+            self.write_cue(cue)
+
+
+def _block_text(text):
+    "Blank lines would end a NOTE or STYLE block, so remove them"
+    return "\n".join([x for x in str(text).splitlines() if x.strip()])
 
 
 def alignwords(words: list) -> list:
     """If there are words in the list which have a zero duration, provide a
-       reasonable start/end value so they can be timed correctly elsewhere."""
+       reasonable start/end value so they can be timed correctly elsewhere.
+
+       A zero duration word gets an even share of the time between the end of
+       the previous word and the start of the next real word (one longer than
+       0.02s), and any later words with the same start are moved to its new
+       end."""
+    starts = [w['start'] for w in words]
+    ends = [w['end'] for w in words]
+    align_times(starts, ends)
+    for w, start, end in zip(words, starts, ends):
+        w['start'] = start
+        w['end'] = end
+
+
+def align_times(starts, ends):
+    """The alignwords repair for separate sequences of word start and end
+       times, which are updated in place.
+
+       This is done in a single pass:  the words are bucketed by their
+       current start so the moves don't rescan the list, and the next real
+       word is found with a path-compressed skip list."""
     # find the median duration of the words.  We don't want to use the average
     # since sometimes whisper will include non-verbal bits in the timing and
     # skew it long, as in "AHHHHHHHHHHHHHHHHHHHHHHHHHHHHHHHHHHHHHHHH" for 29
     # seconds.    
     #med_duration = median([x['end'] - x['start'] for x in words if x['end'] - x['start'] > 0])
     med_duration = 0.2
+    n = len(starts)
+
+    # skip[k] leads toward the first real word at or after k.  Words which
+    # aren't real (or stop being real because they were moved) point past
+    # themselves.
+    skip = [k if e - s > 0.02 else k + 1 for k, (s, e) in enumerate(zip(starts, ends))]
+    skip.append(n)
+
+    def next_real(k):
+        root = k
+        while skip[root] != root:
+            root = skip[root]
+        while skip[k] != root:
+            skip[k], k = root, skip[k]
+        return root
+
+    # the words which haven't been processed yet, grouped by their current
+    # start.  A bucket is [start, indexes, real indexes, moved].  Once a 
+    # bucket is moved all of its words start and end at its start.
+    buckets = {}
+    bucket_of = [None] * n
+    for k, s in enumerate(starts):
+        b = buckets.get(s)
+        if b is None:
+            b = buckets[s] = [s, set(), set(), False]
+        b[1].add(k)
+        if skip[k] == k:
+            b[2].add(k)
+        bucket_of[k] = b
+
     last_end = 0
-    for i, w in enumerate(words):
-        if w['end'] - w['start'] == 0:
+    for i in range(n):
+        b = bucket_of[i]
+        b[1].discard(i)
+        b[2].discard(i)
+        if not b[1] and buckets.get(b[0]) is b:
+            del buckets[b[0]]
+        if b[3]:
+            starts[i] = ends[i] = b[0]
+
+        if ends[i] - starts[i] == 0:
             # find the next word with a valid duration.
-            nduration = 0
-            for j, x in enumerate(words[i:]):
-                if x['end'] - x['start'] > 0.02:
-                    logging.debug(f"Found next real word for {i}, {w} at: {j + i}, {x}, {last_end}")
-                    nduration = (x['start'] - last_end) / j
-                    break
+            k = next_real(i)
+            if k < n:
+                nduration = (starts[k] - last_end) / (k - i)
             else:
-                logging.debug(f"Cannot find a next real word...so just use median duration {med_duration}")
                 nduration = med_duration
+            ends[i] = starts[i] + nduration
 
-            w['end'] = w['start'] + nduration
-            for j, x in enumerate(words[i + 1:]):
-                if x['start'] == w['start']:                    
-                    x['end'] = x['start'] = w['end']
-            logging.debug(f"New word: {w}")
-        last_end = w['end']
+            # move the rest of the words with the same start to the new end.
+            # they aren't real words any more.
+            source = buckets.pop(starts[i], None)
+            if source is not None:
+                for k in source[2]:
+                    skip[k] = k + 1
+                source[2] = set()
+                target = buckets.get(ends[i])
+                if target is None:
+                    source[0] = ends[i]
+                    source[3] = True
+                    buckets[ends[i]] = source
+                elif target[3]:
+                    # both are moved buckets, so merge the smaller one into
+                    # the larger one
+                    if len(source[1]) > len(target[1]):
+                        source, target = target, source
+                        target[0] = ends[i]
+                        target[3] = True
+                        buckets[ends[i]] = target
+                    for k in source[1]:
+                        bucket_of[k] = target
+                    target[1].update(source[1])
+                else:
+                    # the target has words which are where they started, so
+                    # move these words explicitly and join them.
+                    for k in source[1]:
+                        starts[k] = ends[k] = ends[i]
+                        bucket_of[k] = target
+                    target[1].update(source[1])
+        last_end = ends[i]
 
 
 def words2phrases(words: list, phrase_gap: float=1.5, max_duration: float=3) -> list:
@@ -70,74 +226,53 @@ def words2phrases(words: list, phrase_gap: float=1.5, max_duration: float=3) ->
     Returns a list of phrases, each consisting of start, stop, and text, suitable
     for sending through gen_vtt
     """
-    # Group words together into phrases based on the phrase gap and speaker.
-    phrases = []
-    buffer = []
-    last_end = None
-    last_speaker = None
-    #alignwords(words)
-    #for word in sorted(words, key=lambda x: x['start']):
-    for word in words:
+    return list(iter_phrases(words, phrase_gap, max_duration))
+
+
+def iter_phrases(words, phrase_gap: float=1.5, max_duration: float=3):
+    """Generate the phrases for words2phrases from any iterable of words.  The
+    words are consumed lazily and each phrase is yielded as soon as it is
+    final, so only the words for the current phrase are held in memory."""
+    for (_, speaker), group in groupby(words, key=_phrase_key(phrase_gap)):
+        for r in _splitwords(_timed(group), max_duration):
+            yield {'start': r[0]['start'],
+                   'end': r[-1]['end'],
+                   'text': renderwords(r),
+                   'speaker': speaker}
+
+
+def write_phrases(words, out, phrase_gap: float=1.5, max_duration: float=3, notes=None, styles=None):
+    """Write the phrases for an iterable of words as VTT to the file-like
+    object out as they're found, returning the number of cues written"""
+    return write_vtt(iter_phrases(words, phrase_gap, max_duration), out, notes=notes, styles=styles)
+
+
+def _phrase_key(phrase_gap):
+    """Return a key function for groupby which changes when the speaker 
+    changes or there's a gap of at least phrase_gap between words"""
+    state = {'phrase': 0, 'last_end': None, 'last_speaker': None}
+    def key(word):
         speaker = word.get('speaker', None)
-        if speaker != last_speaker:
-            # we have to split on speaker, regardless of the length
-            if not buffer:
-                # first word in the buffer for this speaker
-                buffer.append(word)
-            else:
-                phrases.append({'start': buffer[0]['start'],
-                                'end': buffer[-1]['end'],
-                                'phrase': buffer,
-                                'speaker': last_speaker})
-                buffer = [word]
-        else:
-            if last_end == None or (word['start'] - last_end) < phrase_gap:
-                # append to the current phrase
-                buffer.append(word)
-            else:
-                # the gap's too big so start a new buffer
-                phrases.append({'start': buffer[0]['start'],
-                                'end': buffer[-1]['end'],
-                                'phrase': buffer,
-                                'speaker': last_speaker})
-                buffer = [word]
-        last_end = word['end']
-        last_speaker = speaker
-    # catch any leftover words in the buffer
-    if buffer:
-        phrases.append({'start': buffer[0]['start'],
-                        'end': buffer[-1]['end'],
-                        'phrase': buffer,
-                        'speaker': last_speaker})
-
-    # Now that we have a list of phrases, we need to rephrase them to be 
-    # usable chunks
-    results = []
-    for p in phrases:
-        logging.debug(p)
-        results.extend([{'start': x['start'],
-                         'end': x['end'],
-                         'text': renderwords(x['phrase']),
-                         'speaker': x['speaker']} for x in splitphrase(p, max_duration)])
-        logging.debug(results)
-    return results
+        if state['last_end'] is not None:
+            if speaker != state['last_speaker'] or not (word['start'] - state['last_end']) < phrase_gap:
+                state['phrase'] += 1
+        state['last_end'] = word['end']
+        state['last_speaker'] = speaker
+        return (state['phrase'], speaker)
+    return key
 
 
 def renderwords(words: list) -> str:
     """Given a list of words concatenate them together in a way that is
     pleasing."""
-    text = ""    
+    parts = []
     for w in [x['word'] for x in words]:
-        if not text:
-            text = w
-        else:
-            if w[0] in '-%,':
-                # these characters are directly appended to the previous
-                # word.
-                text += w
-            else:
-                text += " " + w
-    return text
+        if parts and w[0] not in '-%,':
+            # everything but these characters are separated from the
+            # previous word by a space
+            parts.append(" ")
+        parts.append(w)
+    return "".join(parts)
 
 
 def splitphrase(phrase: dict, max_duration: float) -> list:
@@ -148,57 +283,56 @@ def splitphrase(phrase: dict, max_duration: float) -> list:
     (semi-)complete thought.  If that's not possible, then we have to split it
     where it falls because we don't want to overrun the reader's brain.
     """
-    results = []
-    start = duration = 0
+    return [{'start': r[0]['start'],
+             'end': r[-1]['end'],
+             'speaker': phrase['speaker'],
+             'phrase': r} for r in _splitwords(_timed(phrase['phrase']), max_duration)]
+
+
+def _timed(words):
+    "Turn word dicts into the (start, end, punctuated, word) tuples for _splitwords"
+    return ((w['start'], w['end'], w['word'][-1] in '.,?!', w) for w in words)
+
+
+def _splitwords(words, max_duration: float):
+    """Generate the lists of words for splitphrase from an iterable of 
+    (start, end, ends with punctuation, word) tuples.  The index of the last
+    punctuated word in the buffer is kept as the words are added, so an 
+    overrun doesn't have to search back for it."""
+    start = 0
     buffer = []
-    #logging.debug(f"Phrase: {phrase['phrase']}")
-    for word in phrase['phrase']:
+    starts = []
+    last_punct = -1
+    for word_start, word_end, punctuated, word in words:
         # add the next word to the buffer
         if not buffer:
-            buffer.append(word)
-            start = word['start']
-            duration = word['end'] - word['start']
-        else:
-            duration = word['end'] - start
-            buffer.append(word)
-        # check the duration...
-        if duration < 0.01:
-            logging.debug(f"Found zero duration word: {word}")
+            start = word_start
+        duration = word_end - start
+        buffer.append(word)
+        starts.append(word_start)
+        if punctuated:
+            last_punct = len(buffer) - 1
         if duration > max_duration:
-            if buffer[-1]['word'][-1] in '.,?!':
-                # if the last word ends in punctuation, we'll let it
-                # slide and start a new phrase.
-                results.append(buffer)
+            if last_punct == len(buffer) - 1 or last_punct < 2:
+                # if the last word ends in punctuation, we'll let it slide
+                # and start a new phrase.  Otherwise there isn't a usable
+                # punctuated word to back up to (the first two words are
+                # never used), so we'll just split it here.
+                yield buffer
                 buffer = []
+                starts = []
             else:
-                # we need to back up a bit to find the last punctuated word
-                for i in range(1, len(buffer) - 1):
-                    if buffer[-i]['word'][-1] in '.,?!':
-                        # found punctation word, so push all of the words up to
-                        # that one and reset the buffer to contain the rest.
-                        results.append(buffer[0 : -i + 1])
-                        buffer = buffer[-(i - 1):]
-                        duration = buffer[-1]['end'] - buffer[0]['start']
-                        start = buffer[0]['start']
-                        break
-                else:
-                    # we didn't find a puncutated word, so we'll just split it here.
-                    results.append(buffer)
-                    buffer = []
+                # push all of the words up to the last punctuated word and 
+                # keep the rest, which don't have any punctuation.
+                yield buffer[:last_punct + 1]
+                del buffer[:last_punct + 1]
+                del starts[:last_punct + 1]
+                start = starts[0]
+            last_punct = -1
 
     # pick up anything that's leftover
     if buffer:
-        results.append(buffer)
-
-    # convert the results into phases....
-    phrases = []
-    for r in results:
-        phrases.append({'start': r[0]['start'],
-                        'end': r[-1]['end'],
-                        'speaker': phrase['speaker'],
-                        'phrase': r})
-    
-    return phrases
+        yield buffer
 
 
 #
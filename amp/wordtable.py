@@ -0,0 +1,272 @@
+"Compact column-oriented storage for transcript words"
+
+from array import array
+from operator import sub
+from amp.vtt_helper import align_times, write_vtt, _splitwords
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+NAN = float('nan')
+
+
+class WordTable:
+    """A transcript's words stored as columns rather than as millions of small
+    objects:
+
+    * start, end:  array('d') of times in seconds (NaN if unknown)
+    * text:  all of the word texts joined into one string, with word i
+      being text[bounds[i]:bounds[i + 1]]
+    * speaker, type, score_type:  array('i') of ids into the interned
+      speakers, types, and score_types lists (-1 for None)
+    * offset:  array('q') of transcript offsets (-1 if unknown)
+    * score:  array('d') of score values (NaN if there isn't a score)
+
+    The time operations use NumPy when it's installed, and otherwise run
+    column-at-a-time over the arrays.  The alignment repair and the splitting
+    of overlong phrases are sequential (each word depends on the ones before
+    it), so those still run word by word, but only where they're needed."""
+    def __init__(self):
+        self.start = array('d')
+        self.end = array('d')
+        self.text = ""
+        self.bounds = array('q', [0])
+        self.speaker = array('i')
+        self.type = array('i')
+        self.offset = array('q')
+        self.score = array('d')
+        self.score_type = array('i')
+        self.speakers = []
+        self.types = []
+        self.score_types = []
+        self.transcript = None
+
+    def __len__(self):
+        return len(self.start)
+
+    def word(self, i):
+        "Return the text of word i"
+        return self.text[self.bounds[i]:self.bounds[i + 1]]
+
+    def words(self):
+        "Return a list of the word texts"
+        text = self.text
+        bounds = self.bounds
+        return [text[bounds[i]:bounds[i + 1]] for i in range(len(self))]
+
+    def speaker_name(self, i):
+        "Return the speaker of word i, or None"
+        return self.speakers[self.speaker[i]] if self.speaker[i] >= 0 else None
+
+    @classmethod
+    def from_words(cls, words):
+        "Create a table from word dicts as used by vtt_helper (start, end, word, and optionally speaker)"
+        table = cls()
+        texts = []
+        intern = _Interner(table.speakers)
+        for w in words:
+            table.start.append(w['start'])
+            table.end.append(w['end'])
+            texts.append(w['word'])
+            table.speaker.append(intern(w.get('speaker', None)))
+        table._set_texts(texts)
+        n = len(texts)
+        table.type = array('i', [-1]) * n
+        table.offset = array('q', [-1]) * n
+        table.score = array('d', [NAN]) * n
+        table.score_type = array('i', [-1]) * n
+        return table
+
+    @classmethod
+    def from_speech_to_text(cls, stt):
+        """Create a table from a SpeechToText object or an AMP transcript
+        JSON dict"""
+        if isinstance(stt, dict):
+            results = stt['results']
+            transcript = results.get('transcript', "")
+            words = results['words']
+            fields = lambda w: (w.get('start'), w.get('end'), w['text'], w['type'], w.get('offset'),
+                                w.get('score', {}).get('type'), w.get('score', {}).get('value'))
+        else:
+            transcript = stt.results.transcript
+            words = stt.results.words
+            fields = lambda w: (w.start, w.end, w.text, w.type, w.offset,
+                                w.score.type if w.score is not None else None,
+                                w.score.value if w.score is not None else None)
+        table = cls()
+        table.transcript = transcript
+        texts = []
+        types = _Interner(table.types)
+        score_types = _Interner(table.score_types)
+        for w in words:
+            start, end, text, wtype, offset, score_type, score = fields(w)
+            table.start.append(NAN if start is None else start)
+            table.end.append(NAN if end is None else end)
+            texts.append(text)
+            table.type.append(types(wtype))
+            table.offset.append(-1 if offset is None else offset)
+            table.score.append(NAN if score is None else score)
+            table.score_type.append(score_types(score_type))
+        table._set_texts(texts)
+        table.speaker = array('i', [-1]) * len(texts)
+        return table
+
+    def _set_texts(self, texts):
+        "Set the text column from a list of word texts"
+        self.text = "".join(texts)
+        bounds = array('q', [0])
+        total = 0
+        for t in texts:
+            total += len(t)
+            bounds.append(total)
+        self.bounds = bounds
+
+    def iter_words(self):
+        "Generate word dicts as used by vtt_helper"
+        for i, (start, end, speaker) in enumerate(zip(self.start, self.end, self.speaker)):
+            w = {'start': start, 'end': end, 'word': self.word(i)}
+            if speaker >= 0:
+                w['speaker'] = self.speakers[speaker]
+            yield w
+
+    def to_words(self):
+        "Return a list of word dicts as used by vtt_helper"
+        return list(self.iter_words())
+
+    def to_json_words(self):
+        "Return the words as AMP transcript JSON word dicts"
+        words = []
+        for i in range(len(self)):
+            w = {'type': self.types[self.type[i]] if self.type[i] >= 0 else None,
+                 'text': self.word(i)}
+            if self.offset[i] >= 0:
+                w['offset'] = self.offset[i]
+            if self.start[i] == self.start[i]:
+                w['start'] = self.start[i]
+            if self.end[i] == self.end[i]:
+                w['end'] = self.end[i]
+            if self.score[i] == self.score[i]:
+                w['score'] = {'type': self.score_types[self.score_type[i]] if self.score_type[i] >= 0 else None,
+                              'value': self.score[i]}
+            words.append(w)
+        return words
+
+    def to_speech_to_text(self, media=None):
+        "Return a SpeechToText object for the table"
+        from amp.schema.speech_to_text import SpeechToText, SpeechToTextResult, SpeechToTextWord
+        words = [SpeechToTextWord.from_json(w) for w in self.to_json_words()]
+        return SpeechToText(media, SpeechToTextResult(words, self.transcript or ""))
+
+    def durations(self):
+        "Return the duration of each word"
+        if numpy is not None:
+            return array('d', (numpy.frombuffer(self.end) - numpy.frombuffer(self.start)).tobytes())
+        return array('d', map(sub, self.end, self.start))
+
+    def gaps(self):
+        "Return the gap between each word and the word before it (the first word has no gap)"
+        if numpy is not None:
+            return array('d', (numpy.frombuffer(self.start)[1:] - numpy.frombuffer(self.end)[:-1]).tobytes())
+        return array('d', map(sub, self.start[1:], self.end[:-1]))
+
+    def phrase_starts(self, phrase_gap: float=1.5):
+        """Return the indexes of the words which start a phrase:  the first
+        word, and any word after a gap of at least phrase_gap or where the
+        speaker changes"""
+        if not len(self):
+            return []
+        if numpy is not None:
+            start = numpy.frombuffer(self.start)
+            end = numpy.frombuffer(self.end)
+            speaker = numpy.frombuffer(self.speaker, dtype=numpy.int32)
+            breaks = ~((start[1:] - end[:-1]) < phrase_gap) | (speaker[1:] != speaker[:-1])
+            return [0] + (numpy.flatnonzero(breaks) + 1).tolist()
+        speaker = self.speaker
+        return [0] + [i for i, gap, s0, s1 in zip(range(1, len(self)), self.gaps(), speaker, speaker[1:])
+                      if not gap < phrase_gap or s0 != s1]
+
+    def punctuated(self):
+        "Return a list of whether each word ends with punctuation"
+        text = self.text
+        bounds = self.bounds
+        return [b > a and text[b - 1] in '.,?!' for a, b in zip(bounds, bounds[1:])]
+
+    def align(self):
+        """Repair the times of zero duration words, as vtt_helper.alignwords
+        does.  Nothing is done if there aren't any"""
+        if numpy is not None:
+            if not (numpy.frombuffer(self.end) == numpy.frombuffer(self.start)).any():
+                return
+        elif not any(map(float.__eq__, self.end, self.start)):
+            return
+        starts = self.start.tolist()
+        ends = self.end.tolist()
+        align_times(starts, ends)
+        self.start = array('d', starts)
+        self.end = array('d', ends)
+
+    def phrases(self, phrase_gap: float=1.5, max_duration: float=3):
+        "Generate the phrases for subtitling, as vtt_helper.words2phrases does"
+        punctuated = None
+        breaks = self.phrase_starts(phrase_gap)
+        short = self._short_phrases(breaks, max_duration)
+        breaks.append(len(self))
+        for a, b, fits in zip(breaks, breaks[1:], short):
+            speaker = self.speaker_name(a)
+            if fits:
+                # it can't overrun max_duration, so there's nothing to split
+                yield {'start': self.start[a], 'end': self.end[b - 1], 'text': self.render(a, b), 'speaker': speaker}
+                continue
+            if punctuated is None:
+                punctuated = self.punctuated()
+            for r in _splitwords(zip(self.start[a:b], self.end[a:b], punctuated[a:b], range(a, b)), max_duration):
+                yield {'start': self.start[r[0]],
+                       'end': self.end[r[-1]],
+                       'text': self.render(r[0], r[-1] + 1),
+                       'speaker': speaker}
+
+    def _short_phrases(self, breaks, max_duration):
+        """Return whether each phrase starting at breaks is short enough that
+        no word ends more than max_duration after the phrase starts"""
+        if not breaks:
+            return []
+        if numpy is None:
+            start = self.start
+            end = self.end
+            return [max(end[a:b]) - start[a] <= max_duration for a, b in zip(breaks, breaks[1:] + [len(self)])]
+        longest = numpy.maximum.reduceat(numpy.frombuffer(self.end), breaks) - numpy.frombuffer(self.start)[breaks]
+        return (longest <= max_duration).tolist()
+
+    def render(self, first, last):
+        "Render words first to last - 1 as text, as vtt_helper.renderwords does"
+        text = self.text
+        bounds = self.bounds
+        parts = [text[bounds[first]:bounds[first + 1]]]
+        for i in range(first + 1, last):
+            word = text[bounds[i]:bounds[i + 1]]
+            if word[0] not in '-%,':
+                parts.append(" ")
+            parts.append(word)
+        return "".join(parts)
+
+    def write_vtt(self, out, phrase_gap: float=1.5, max_duration: float=3, notes=None, styles=None):
+        "Write the phrases as VTT to the file-like object out, returning the number of cues"
+        return write_vtt(self.phrases(phrase_gap, max_duration), out, notes=notes, styles=styles)
+
+
+class _Interner:
+    "Map values to ids in a list of unique values, with None as -1"
+    def __init__(self, values):
+        self.values = values
+        self.ids = {v: i for i, v in enumerate(values)}
+
+    def __call__(self, value):
+        if value is None:
+            return -1
+        i = self.ids.get(value)
+        if i is None:
+            i = self.ids[value] = len(self.values)
+            self.values.append(value)
+        return i
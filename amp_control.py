@@ -7,6 +7,7 @@ import argparse
 import yaml
 from pathlib import Path
 import sys
+import time
 import subprocess
 import urllib.request
 from datetime import datetime
@@ -67,6 +68,13 @@ def main():
 
     p = subp.add_parser('version', help="List installed package versions")
 
+    p = subp.add_parser('verify', help="Verify installed package files against their manifests")
+    p.add_argument("--threads", type=int, default=HASH_THREADS, help=f"Number of hashing threads (default {HASH_THREADS})")
+    p.add_argument("package", nargs="*", help="Package(s) to verify (default all)")
+
+    p = subp.add_parser('gpu-status', help="Show GPU lock holders, waiters, and wait/hold times")
+    p.add_argument("--json", default=False, action="store_true", help="Print the status as JSON")
+
 
     args = parser.parse_args()
     logging.basicConfig(format="%(asctime)s [%(levelname)-8s] (%(filename)s:%(lineno)d)  %(message)s",
@@ -77,7 +85,7 @@ def main():
     amp.environment.setup()
 
     try:        
-        if args.action in ('init', 'download', 'install', 'configure'):
+        if args.action in ('init', 'download', 'install', 'configure', 'verify', 'gpu-status'):
             # these don't need a valid config
             config = {}
         else:
@@ -86,7 +94,7 @@ def main():
         # call the appropriate action function
         check_prereqs(runtime_prereqs)
             
-        globals()["action_" + args.action](config, args)
+        globals()["action_" + args.action.replace('-', '_')](config, args)
         
     except Exception as e:
         logging.exception(f"Program exception {e}")
@@ -100,7 +108,7 @@ def action_init(config, args):
     "Create the directories needed for AMP to do it's thing"    
     # create a bunch of directories we can populate later...
     for n in ('packages', 'data', 'data/symlinks', 'data/config', 'data/default_config',              
-              'data/package_hooks', 'data/package_config', 'data/work'):
+              'data/package_hooks', 'data/package_config', 'data/package_manifests', 'data/work'):
         d = amp_root / n
         if not d.exists():
             logging.info(f"Creating {d!s}")
@@ -322,11 +330,66 @@ def action_version(config, args):
             print()
 
 
+def action_verify(config, args):
+    "Verify the installed files for packages against their manifests"
+    failed = False
+    # only hold the (shared) database lock long enough to see what's installed
+    with PackageDB(packagedb, readonly=True) as pdb:
+        installed = {pkg: pdb.info(pkg) is not None for pkg in (args.package if args.package else pdb.packages())}
+
+    for pkg in sorted(installed):
+        if not installed[pkg]:
+            logging.error(f"Package {pkg} is not installed")
+            failed = True
+            continue
+        manifest_file = amp_root / f"data/package_manifests/{pkg}.yaml"
+        if not manifest_file.exists():
+            logging.info(f"Skipping {pkg}: no manifest was installed with the package")
+            continue
+        with open(manifest_file) as f:
+            manifest = yaml.safe_load(f)
+
+        install_path = amp_root / manifest.get('install_path', '.')
+        start = datetime.now()
+        results = verify_manifest(manifest, install_path, args.threads)
+        elapsed = max((datetime.now() - start).total_seconds(), 0.001)
+        logging.info(f"{pkg}: checked {results['files']} files, {results['bytes'] / 1048576:0.1f} MB " +
+                     f"in {elapsed:0.2f}s ({results['bytes'] / 1048576 / elapsed:0.1f} MB/s)")
+        for f in results['missing']:
+            logging.warning(f"{pkg}: missing {install_path / f}")
+        for f in results['modified']:
+            logging.warning(f"{pkg}: modified {install_path / f}")
+        for f, e in results['errors'].items():
+            logging.warning(f"{pkg}: cannot read {install_path / f}: {e}")
+        if results['missing'] or results['modified'] or results['errors']:
+            failed = True
+
+    if failed:
+        exit(1)
 
 
+def action_gpu_status(config, args):
+    "Show who is holding and waiting for the GPUs"
+    import amp.gpu
+    import json
+    status = amp.gpu.gpu_status()
+    if args.json:
+        print(json.dumps(status, indent=2))
+        return
+    if not status:
+        print("No GPU locks have been used")
+        return
+    now = time.time()
+    print(f"{'device':20s} {'holder':28s} {'held':>8s} {'waiting':>7s} {'jobs':>6s} {'avg wait':>9s} {'max wait':>9s} {'avg hold':>9s} {'max hold':>9s}")
+    for device, s in status.items():
+        holders = [f"{x['mgm']}[{x['pid']}]" for x in s['holders']]
+        held = max([now - x['acquired'] for x in s['holders']], default=0)
+        st = s['stats']
+        print(f"{device:20s} {', '.join(holders) or '-':28s} {held:8.1f} {len(s['waiters']):7d} {st['jobs']:6d} " +
+              f"{st['wait']['average']:9.1f} {st['wait']['max']:9.1f} {st['hold']['average']:9.1f} {st['hold']['max']:9.1f}")
+        for w in s['waiters']:
+            print(f"{'':20s}   waiting: {w['mgm']}[{w['pid']}] for {now - w['queued']:0.1f}s")
 
-    
-    
 
 if __name__ == "__main__":
     main()
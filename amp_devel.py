@@ -48,6 +48,8 @@ def main():
     p.add_argument("repos", nargs='*', help="Repos to build (default all)")
     p.add_argument("--dest", type=str, default=str(amp_root / 'packages'), 
                    help=f"Alternate destination dir (default: {amp_root / 'packages'!s})")
+    p.add_argument("--reproducible", default=False, action="store_true",
+                   help="Build reproducible packages, timestamped with each repo's last commit")
     
     p = subp.add_parser('shell', help="Start an interactive shell with the proper environment")
 
@@ -105,6 +107,10 @@ def action_build(args):
             logging.warning(f"Skipping {repo!s} since it doesn't appear to be a valid repo")
             continue
         os.environ['AMP_SRC_DIR'] = str(repo.absolute())
+        if args.reproducible:
+            # create_package normalizes everything to SOURCE_DATE_EPOCH when it's set
+            p = subprocess.run(['git', 'log', '-1', '--pretty=%ct'], cwd=repo, stdout=subprocess.PIPE, encoding='utf-8')
+            os.environ['SOURCE_DATE_EPOCH'] = p.stdout.strip() or "0"
         here = os.getcwd()
         os.chdir(repo)
         logging.info(f"Building packages for {repo.name}")
@@ -5,11 +5,9 @@
 
 import argparse
 import amp_control
+import amp.environment
 import logging
-from urllib.request import Request, urlopen
-from urllib.parse import quote
-
-import json
+from amp.rest import AmpRest
 
 def main():
     parser = argparse.ArgumentParser()
@@ -18,42 +16,21 @@ def main():
     args = parser.parse_args()
     logging.basicConfig(format="%(asctime)s [%(levelname)-8s] (%(filename)s:%(lineno)d)  %(message)s",
                         level=logging.DEBUG if args.debug else logging.INFO)
-    config = amp_control.load_config(args.config)
-
-    url_base = f"http://{config['amp']['host']}:{config['amp']['port']}"
-    amp_user = config['rest']['admin_username']
-    amp_pass = config['rest']['admin_password']
+    amp.environment.setup()
+    config = amp_control.load_amp_config(user_config=args.config)
+    create_default_unit(config)
 
-    # get the token from the interface.
-    req = Request(url_base + "/rest/account/authenticate", 
-                  data=bytes(json.dumps({'username': amp_user, 'password': amp_pass}), encoding='utf-8'),
-                  headers={'Content-Type': 'application/json'},
-                  method="POST")
-    with urlopen(req) as res:
-        rdata = json.loads(res.read())
-        amp_token = rdata['token']
 
-    # see if the default unit is present
+def create_default_unit(config, client=None):
+    "Create the default unit if it doesn't already exist"
+    if client is None:
+        client = AmpRest.from_config(config)
     default_unit = config['ui']['unit']
-    req = Request(url_base + "/rest/units/search/findByName?name=" + quote(default_unit),
-                  headers={'Authorization': f"Bearer {amp_token}"})
-    with urlopen(req) as res:
-        rdata = json.loads(res.read())
-        
-    if len(rdata['_embedded']['units']) == 0:
-        # create the unit
-        req = Request(url_base + "/rest/units",
-                      headers={'Authorization': f"Bearer {amp_token}",
-                               'Content-Type': 'application/json'},
-                      data=bytes(json.dumps({'name': default_unit}), encoding="utf-8"),
-                      method="POST")
-        with urlopen(req) as res:
-            print(res.status)
+    if client.ensure_unit(default_unit):
+        logging.info(f"Created unit {default_unit}")
     else:
-        print("Unit already exists")
-                                 
+        logging.info("Unit already exists")
 
 
-   
 if __name__ == "__main__":
     main()
\ No newline at end of file
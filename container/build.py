@@ -7,9 +7,18 @@ import shutil
 import tarfile
 from pathlib import Path
 import sys
+import os
+import fcntl
+import hashlib
+import json
 
 DEFAULT_MIRROR = "https://dlib.indiana.edu/AMP-packages/current"
 DEFAULT_TAG = "amp:test"
+# ioctl to clone a file's extents (reflink) on btrfs/xfs
+FICLONE = 0x40049409
+# Docker images are limited to about 127 layers, so beyond this many 
+# packages they're grouped into shared layers.
+MAX_PACKAGE_LAYERS = 100
 
 def main():
     parser = argparse.ArgumentParser()
@@ -39,46 +48,138 @@ def main():
     dynresource_dir.mkdir(exist_ok=True)
 
     bootstrap_dir = Path(sys.path[0], "..").resolve()
-    logging.info(f"Creating bootstrap tarball from {bootstrap_dir!s}")
     Path(sys.path[0], "packages").mkdir(exist_ok=True)
     # The packages directory can't be empty or the Dockerfile will puke.
-    Path(sys.path[0], "packages/placeholder").touch()
-    with tarfile.open(Path(sys.path[0], "dynamic-resources/amp_bootstrap.tar"), "w") as t:
-        for file in bootstrap_dir.glob("*"):            
-            if file.is_file():
-                if file.name.startswith('.'):
-                    continue
-                if file.name == "amp.yaml":
-                    # do not copy the local configuration
-                    continue
+    placeholder = Path(sys.path[0], "packages/placeholder")
+    if not placeholder.exists():
+        placeholder.touch()
+    
+    # only rebuild the bootstrap tarball if something has changed since the last
+    # time, otherwise the new tarball will invalidate the image cache.
+    bootstrap_files = [x for x in sorted(bootstrap_dir.glob("*")) 
+                       if x.is_file() and not x.name.startswith('.') and x.name != "amp.yaml"]
+    bootstrap_tar = dynresource_dir / "amp_bootstrap.tar"
+    bootstrap_inputs = dynresource_dir / "amp_bootstrap.tar.inputs"
+    fingerprint = hashlib.sha256()
+    for file in bootstrap_files:
+        s = file.stat()
+        fingerprint.update(f"{file.name}:{s.st_size}:{s.st_mtime_ns}:{s.st_mode}\n".encode('utf-8'))
+    fingerprint = fingerprint.hexdigest()
+    if bootstrap_tar.exists() and bootstrap_inputs.exists() and bootstrap_inputs.read_text() == fingerprint:
+        logging.info("Bootstrap tarball is up to date")
+    else:
+        logging.info(f"Creating bootstrap tarball from {bootstrap_dir!s}")
+        with tarfile.open(bootstrap_tar, "w") as t:
+            for file in bootstrap_files:
+                # the local configuration (amp.yaml) is not copied
                 logging.debug(f"Adding {file!s} as {file.name}")
                 t.add(file, file.name)
+        bootstrap_inputs.write_text(fingerprint)
 
 
     # Docker is really irritating about how it only allows files within the
     # build tree to be copied to the container.  So to use any local packages
-    # they have to be copied here and then copied into the container.
-    # There are optimizations (like hard linking) that I may include in the
-    # future.  These local mirror specifications must start with file:/// or /
+    # they have to be staged here and then copied into the container.  
+    # Staging uses hard links or reflinks when possible so multi-gigabyte
+    # packages don't have to be copied.
+    # These local mirror specifications must start with file:/// or /
     if args.mirror.startswith('file:///'):
         args.mirror = args.mirror.replace('file:///', '/')
     if args.mirror.startswith('/'):
-        # this is a local mirror, so I need to copy things.                
+        # this is a local mirror, so I need to stage things.                
         for file in Path(args.mirror).glob("*"):            
             if file.is_file():
                 destfile = Path(sys.path[0], 'packages', file.name)
                 if not destfile.exists() or destfile.stat().st_mtime < file.stat().st_mtime:
-                    logging.debug(f"Copying package file {file.name}")
-                    shutil.copyfile(file, destfile)
+                    logging.debug(f"Staging package file {file.name}")
+                    stage_file(file, destfile)
         # fixup args.mirror so it knows to use the ones in the packages directory
         args.mirror = "NONE"
 
-
-
+    dockerfile = write_dockerfile(dynresource_dir / "Dockerfile")
 
     logging.info("Starting build")
-    subprocess.run([args.docker, 'build', '-t', args.tag, '--build-arg',f"AMP_MIRROR={args.mirror}", "."])
-
+    subprocess.run([args.docker, 'build', '-t', args.tag, '-f', str(dockerfile),
+                    '--build-arg',f"AMP_MIRROR={args.mirror}", "."])
+
+
+def stage_file(src: Path, dst: Path):
+    "Put src at dst, using a hard link or reflink if possible, falling back to a copy"
+    if dst.exists():
+        dst.unlink()
+    try:
+        os.link(src, dst)
+        return
+    except OSError as e:
+        logging.debug(f"Cannot hard link {src!s}: {e}")
+    try:
+        with open(src, "rb") as s, open(dst, "wb") as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        shutil.copystat(src, dst)
+        return
+    except OSError as e:
+        logging.debug(f"Cannot reflink {src!s}: {e}")
+    shutil.copy2(src, dst)
+
+
+def write_dockerfile(dockerfile: Path) -> Path:
+    """Generate the Dockerfile with the packages copied in independently of
+       each other.  Each package (or, if there are too many for the layer 
+       limit, each group of packages) gets its own stage named by the package
+       names and hashes, and is copied into the image with COPY --link so its layer 
+       doesn't depend on the layers before it.  Changing one package only 
+       invalidates its own layer and the install step."""
+    packages = sorted(Path(sys.path[0], "packages").glob("*"))
+    hashes = package_hashes(packages, dockerfile.parent / "package_hashes.json")
+    if len(packages) <= MAX_PACKAGE_LAYERS:
+        groups = [[x] for x in packages]
+    else:
+        # group by the name so the groups are stable from build to build
+        groups = [[] for x in range(MAX_PACKAGE_LAYERS)]
+        for p in packages:
+            groups[int(hashlib.sha256(p.name.encode('utf-8')).hexdigest(), 16) % MAX_PACKAGE_LAYERS].append(p)
+        groups = [x for x in groups if x]
+
+    stages = []
+    copies = []
+    for group in groups:
+        stage = "pkg-" + hashlib.sha256("".join([f"{x.name}:{hashes[x.name]}\n" for x in group]).encode('utf-8')).hexdigest()[0:16]
+        stages.append(f"FROM scratch AS {stage}")
+        stages.extend([f"COPY packages/{x.name} /" for x in group])
+        copies.append(f"COPY --link --from={stage} / /srv/amp/packages/")
+
+    template = Path(sys.path[0], "Dockerfile").read_text()
+    if "COPY packages/* /srv/amp/packages/" not in template:
+        raise ValueError("Dockerfile doesn't contain the package COPY instruction")
+    dockerfile.write_text("# syntax=docker/dockerfile:1\n" +
+                          "# Package stages, named by the package hashes\n" + "\n".join(stages) + "\n\n" +
+                          template.replace("COPY packages/* /srv/amp/packages/", "\n".join(copies)))
+    return dockerfile
+
+
+def package_hashes(packages: list, cachefile: Path) -> dict:
+    """Return a dict of package name -> sha256 for the package files.  The 
+       hashes are cached in cachefile by name, size, and mtime so unchanged 
+       packages aren't hashed again"""
+    try:
+        cache = json.loads(cachefile.read_text())
+    except (OSError, ValueError):
+        cache = {}
+    hashes = {}
+    new_cache = {}
+    for p in packages:
+        s = p.stat()
+        key = f"{p.name}:{s.st_size}:{s.st_mtime_ns}"
+        if key not in cache:
+            logging.debug(f"Hashing package file {p.name}")
+            h = hashlib.sha256()
+            with open(p, "rb") as f:
+                for block in iter(lambda: f.read(1024 * 1024), b""):
+                    h.update(block)
+            cache[key] = h.hexdigest()
+        hashes[p.name] = new_cache[key] = cache[key]
+    cachefile.write_text(json.dumps(new_cache, indent=2))
+    return hashes
 
 
 if __name__ == "__main__":
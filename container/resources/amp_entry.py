@@ -12,11 +12,32 @@ import shutil
 import random
 import subprocess
 import time
+import signal
+import select
+import errno
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import urlopen
+from urllib.error import HTTPError
 import amp_control
+import amp.environment
+from amp.config import get_config_value
+from amp.rest import AmpRest
+import bootstrap_rest_unit
 
 AMP_ROOT=Path("/srv/amp")
 DATA_ROOT=Path("/srv/amp-data")
 
+# What to do when a service dies:
+#  exit:  shut down the container (so the container runtime can restart it)
+#  restart: restart the service, up to max_restarts times, then exit
+#  ignore: log it and stop watching the service
+# These can be overridden in the configuration with container.restart_policy.<service>
+# and container.max_restarts
+DEFAULT_RESTART_POLICY = {'galaxy': 'exit', 'tomcat': 'exit', 'postgres': 'exit'}
+DEFAULT_MAX_RESTARTS = 3
+
 
 def main():
     if not DATA_ROOT.exists():
@@ -44,21 +65,13 @@ def main():
         #with open(DATA_ROOT / "amp.yaml") as f:
         #    config = yaml.safe_load(f)
 
-        config = amp_control.load_config()
-
-        # start OS daemons
-        start_daemons(config)
-
-        # start/configure postgres
-        start_postgres(config)
+        amp.environment.setup()
+        config = amp_control.load_amp_config()
 
-        # Set up our symlinks if we need to
-        setup_symlinks(config)
+        # Bring up everything
+        start_amp(config)
 
-        # Configure amp
-        configure_amp(config)
-
-        # Start/run amp
+        # Watch amp
         run_amp(config)
 
 
@@ -99,6 +112,105 @@ def test_config():
     exit(0)
 
 
+def start_amp(config):
+    """Start all of the services, starting independent ones concurrently
+       and waiting for them to actually be ready rather than just started."""
+    timeline = Timeline()
+    with ThreadPoolExecutor(3) as pool:
+        # OS daemons, postgres, and the symlinks don't depend on each other
+        steps = [pool.submit(timeline.run, 'postfix', start_daemons, config),
+                 pool.submit(timeline.run, 'postgres', start_postgres, config),
+                 pool.submit(timeline.run, 'symlinks', setup_symlinks, config)]
+        for step in steps:
+            step.result()
+
+        # configuration needs all of that to be in place
+        timeline.run('configure', configure_amp, config)
+
+        # and galaxy and tomcat just need the configuration
+        steps = [pool.submit(timeline.run, 'galaxy', start_galaxy, config),
+                 pool.submit(timeline.run, 'tomcat', start_tomcat, config)]
+        for step in steps:
+            step.result()
+
+    # special case:  we have to bootstrap the amp default unit if we haven't done it yet.
+    if not (DATA_ROOT / ".default_unit").exists():
+        try:
+            timeline.run('default unit', create_default_unit, config)
+            (DATA_ROOT / ".default_unit").touch()
+        except TimeoutError:
+            logging.error("Could not set up the default unit. Restart the container OR")
+            logging.error(f"Connect to the container and run {AMP_ROOT}/amp_bootstrap/bootstrap_rest_unit.py manually")
+            logging.error(f"and touch {DATA_ROOT}/.default_unit")
+
+    timeline.log()
+
+
+class Timeline:
+    "Record when each startup step ran, so the container cold-start time can be tracked"
+    def __init__(self):
+        self.start = time.monotonic()
+        self.steps = []
+        self.lock = threading.Lock()
+
+    def run(self, name, func, *args):
+        "Run a step, recording its start and end times"
+        start = time.monotonic()
+        logging.info(f"Startup step {name} started at {start - self.start:0.1f}s")
+        try:
+            return func(*args)
+        finally:
+            end = time.monotonic()
+            logging.info(f"Startup step {name} finished at {end - self.start:0.1f}s")
+            with self.lock:
+                self.steps.append((name, start - self.start, end - self.start))
+
+    def log(self):
+        "Log the startup timeline"
+        logging.info("Startup timeline:")
+        for name, start, end in sorted(self.steps, key=lambda x: x[1]):
+            logging.info(f"  {name:<15} {start:7.1f}s -> {end:7.1f}s  ({end - start:0.1f}s)")
+        logging.info(f"AMP started in {time.monotonic() - self.start:0.1f}s")
+
+
+def wait_for(probe, description, timeout=300, delay=0.25, max_delay=10):
+    "Call probe until it returns True, backing off exponentially.  Raises TimeoutError if it never does"
+    deadline = time.monotonic() + timeout
+    while True:
+        if probe():
+            logging.debug(f"{description} is ready")
+            return
+        if time.monotonic() + delay > deadline:
+            raise TimeoutError(f"{description} was not ready in {timeout} seconds")
+        logging.debug(f"Waiting {delay:0.2f}s for {description}")
+        time.sleep(delay)
+        delay = min(delay * 2, max_delay)
+
+
+def port_accepting(host, port):
+    "Return a probe for a TCP port accepting connections"
+    def probe():
+        try:
+            with socket.create_connection((host, port), timeout=2):
+                return True
+        except OSError:
+            return False
+    return probe
+
+
+def http_answering(url):
+    "Return a probe for a HTTP server answering requests.  Any HTTP response counts."
+    def probe():
+        try:
+            with urlopen(url, timeout=5):
+                return True
+        except HTTPError:
+            return True
+        except Exception:
+            return False
+    return probe
+
+
 def start_daemons(config):
     "Start operating system daemons"
     # postfix
@@ -133,6 +245,7 @@ host   all  all       ::1/128        md5
     # was /usr/pgsql-12/bin/pg_ctl
     subprocess.run(f"runuser --user postgres -- /usr/bin/pg_ctl -D {DATA_ROOT}/postgres -l {DATA_ROOT}/postgres/logfile start",
                    shell=True, check=True)
+    wait_for(port_accepting('localhost', 5432), "Postgres")
 
     logging.info("Creating schema & user (if necessary)")
     with open(f"{DATA_ROOT}/db.sql", "w") as f:
@@ -189,78 +302,206 @@ def configure_amp(config):
     logging.info("AMP has been configured.")
 
 
-def run_amp(config):
-    """
-    This function is the main amp manager.  It won't return until
-    galaxy, postgres, or tomcat shut down
-    """
-    # start galaxy and wait for the initialization to finish
+def start_galaxy(config):
+    "Start galaxy and wait until it answers HTTP requests"
     subprocess.run([AMP_ROOT / "amp_bootstrap/amp_control.py", "start", "galaxy"], check=True)
+    # galaxy runs at the base port + 2
+    wait_for(http_answering(f"http://localhost:{config['amp']['port'] + 2}/"), "Galaxy")
     logging.info("Galaxy started.")
 
+
+def start_tomcat(config):
+    "Start tomcat and wait until it answers HTTP requests"
     subprocess.run([AMP_ROOT / "amp_bootstrap/amp_control.py", "start", "tomcat"], check=True)
+    wait_for(http_answering(f"http://localhost:{config['amp']['port']}/"), "Tomcat")
     logging.info("Tomcat started")
 
-    # special case:  we have to bootstrap the amp default unit if we haven't done it yet.
-    if not (DATA_ROOT / ".default_unit").exists():
-        logging.info("Creating the default unit")
-        # let tomcat settle down so we can do this.
-        tries = 10
-        while tries > 0:
-            tries -= 1
-            p = subprocess.run([AMP_ROOT / "amp_bootstrap/bootstrap_rest_unit.py"])
-            if p.returncode == 0:
-                logging.info("Default unit created")
-                (DATA_ROOT / ".default_unit").touch()
-                break
-            else:
-                time.sleep(10)
-        else:
-            logging.error("Could not set up the default unit. Restart the container OR")
-            logging.error(f"Connect to the container and run {AMP_ROOT}/amp_bootstrap/bootstrap_rest_unit.py manually")
-            logging.error(f"and touch {DATA_ROOT}/.default_unit")
-
 
-    # Everything should be up and running.  Wait for a service to die and then exit
-    while(True):
-        time.sleep(10)
+def create_default_unit(config):
+    "Create the default unit, retrying until the REST service is willing"
+    logging.info("Creating the default unit")
+    client = AmpRest.from_config(config)
+    def probe():
+        try:
+            bootstrap_rest_unit.create_default_unit(config, client)
+            return True
+        except Exception as e:
+            logging.debug(f"Default unit creation failed: {e}")
+            return False
+    try:
+        wait_for(probe, "Default unit creation", timeout=120, delay=1)
+    finally:
+        client.close()
+    logging.info("Default unit created")
 
-        # we're init, so let's act like it: reap any children
-        # that come our way.
-        pid = 1
-        while pid > 0:
-            pid, status = os.waitpid(-1, os.WNOHANG)
-            if pid > 0:
-                logging.debug(f"Reaped pid {pid}: {status}")
 
-        # Galaxy's PID is in galaxy/galaxy.pid
-        with open(AMP_ROOT / "galaxy/galaxy.pid") as f:
-            pid = f.readline().strip()
-            if not Path(f"/proc/{pid}").exists():
-                logging.error(f"Galaxy with PID {pid} has died")
+def run_amp(config):
+    """
+    This function is the main amp manager.  It won't return until
+    galaxy, postgres, or tomcat shut down
+    """
+    # Everything should be up and running.  Wait for a service to die and then
+    # do what the restart policy says.
+    supervisor = Supervisor(get_config_value(config, ['container', 'max_restarts'], DEFAULT_MAX_RESTARTS))
+    policy = dict(DEFAULT_RESTART_POLICY)
+    policy.update(get_config_value(config, ['container', 'restart_policy'], {}))
+    supervisor.add('galaxy', lambda: read_pidfile(AMP_ROOT / "galaxy/galaxy.pid"),
+                   [AMP_ROOT / "amp_bootstrap/amp_control.py", "start", "galaxy"], policy['galaxy'])
+    supervisor.add('tomcat', find_tomcat,
+                   [AMP_ROOT / "amp_bootstrap/amp_control.py", "start", "tomcat"], policy['tomcat'])
+    if config['rest']['db_host'] == 'localhost':
+        supervisor.add('postgres', lambda: read_pidfile(DATA_ROOT / "postgres/postmaster.pid"),
+                       ['runuser', '--user', 'postgres', '--', '/usr/bin/pg_ctl', '-D', f'{DATA_ROOT}/postgres',
+                        '-l', f'{DATA_ROOT}/postgres/logfile', 'start'], policy['postgres'])
+    supervisor.run()
+
+
+def read_pidfile(pidfile):
+    "Return the pid from the first line of a pid file, or None"
+    try:
+        with open(pidfile) as f:
+            return int(f.readline().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def find_tomcat():
+    "Tomcat doesn't have a PID file by default, so look around in /proc for it"
+    for pdir in Path("/proc").iterdir():
+        if pdir.name.isdigit():
+            try:
+                cmdline = (pdir / "cmdline").read_bytes()
+            except OSError:
+                continue
+            if b'org.apache.catalina.startup.Bootstrap' in cmdline:
+                return int(pdir.name)
+    return None
+
+
+class Supervisor:
+    """Watch the AMP services and react as soon as one exits.  
+
+       We're init in the container, so the daemonized services are reparented
+       to us:  a SIGCHLD wakes us up and we reap everything that's exited.  
+       Services are also watched with a pidfd (where the kernel supports it) 
+       so they're noticed even if they aren't our children.  Without pidfds
+       the services' /proc entries are checked every poll_period seconds."""
+    def __init__(self, max_restarts=DEFAULT_MAX_RESTARTS, poll_period=10):
+        self.services = {}
+        self.max_restarts = max_restarts
+        self.poll_period = poll_period
+
+    def add(self, name, find_pid, start_cmd, policy='exit'):
+        "Add a service to watch.  find_pid is called to locate the service's process"
+        if policy not in ('exit', 'restart', 'ignore'):
+            raise ValueError(f"Unknown restart policy for {name}: {policy}")
+        self.services[name] = {'find_pid': find_pid, 'start_cmd': start_cmd, 'policy': policy,
+                               'restarts': 0, 'pid': None, 'pidfd': None}
+
+    def run(self):
+        "Supervise the services until one dies and the policy says to exit"
+        wakeup_r, wakeup_w = os.pipe()
+        os.set_blocking(wakeup_r, False)
+        os.set_blocking(wakeup_w, False)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        signal.set_wakeup_fd(wakeup_w)
+        self.poller = select.poll()
+        self.poller.register(wakeup_r, select.POLLIN)
+
+        for name in list(self.services):
+            if not self._watch(name):
+                logging.error(f"Failed to find a running {name}")
+                if self.services[name]['policy'] != 'ignore':
+                    return
+                self.services.pop(name)
+
+        try:
+            while self.services:
+                timeout = None if all([x['pidfd'] is not None for x in self.services.values()]) else self.poll_period * 1000
+                ready = {fd for fd, _ in self.poller.poll(timeout)}
+                if wakeup_r in ready:
+                    try:
+                        while os.read(wakeup_r, 512):
+                            pass
+                    except BlockingIOError:
+                        pass
+                reaped = self._reap()
+
+                for name in list(self.services):
+                    svc = self.services[name]
+                    if svc['pidfd'] is not None:
+                        dead = svc['pidfd'] in ready or svc['pid'] in reaped
+                    else:
+                        dead = svc['pid'] in reaped or not Path(f"/proc/{svc['pid']}").exists()
+                    if dead and not self._service_died(name):
+                        return
+        finally:
+            signal.set_wakeup_fd(-1)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            for svc in self.services.values():
+                self._unwatch(svc)
+            os.close(wakeup_r)
+            os.close(wakeup_w)
+
+    def _watch(self, name):
+        "Find the service's pid and start watching it.  Returns False if it isn't running"
+        svc = self.services[name]
+        svc['pid'] = svc['find_pid']()
+        if svc['pid'] is None or not Path(f"/proc/{svc['pid']}").exists():
+            return False
+        logging.debug(f"Watching {name} with PID {svc['pid']}")
+        if hasattr(os, 'pidfd_open'):
+            try:
+                svc['pidfd'] = os.pidfd_open(svc['pid'])
+                self.poller.register(svc['pidfd'], select.POLLIN)
+            except ProcessLookupError:
+                return False
+            except OSError as e:
+                if e.errno != errno.ENOSYS:
+                    raise
+                logging.debug("Kernel doesn't support pidfd, falling back to polling")
+        return True
+
+    def _unwatch(self, svc):
+        if svc['pidfd'] is not None:
+            self.poller.unregister(svc['pidfd'])
+            os.close(svc['pidfd'])
+            svc['pidfd'] = None
+
+    def _reap(self):
+        "We're init, so reap any children that come our way.  Returns the set of reaped pids"
+        reaped = set()
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
                 break
-
-        # Tomcat doesn't have a PID file by default, so
-        # just look around in /proc for a tomcat
-        for pdir in Path("/proc").iterdir():
-            if pdir.is_dir() and pdir.name[0] in '1234567890':
-                cmdline = (pdir / "cmdline").read_text()
-                if 'org.apache.catalina.startup.Bootstrap' in cmdline:
-                    break
-        else:
-            # we never found that command line.
-            logging.error("Failed to find a running tomcat")
-            break
-
-        # Postgres's pidfile is in /srv/amp-data/postgres/postmaster.pid
-        with open(DATA_ROOT / "postgres/postmaster.pid") as f:
-            pid = f.readline().strip()
-            if not Path(f"/proc/{pid}").exists():
-                logging.error(f"Postgres with PID {pid} has died")
-                break      
-
-
-
+            if pid == 0:
+                break
+            logging.debug(f"Reaped pid {pid}: {status}")
+            reaped.add(pid)
+        return reaped
+
+    def _service_died(self, name):
+        "Apply the restart policy to a dead service.  Returns False if the supervisor should exit"
+        svc = self.services[name]
+        self._unwatch(svc)
+        logging.error(f"{name} with PID {svc['pid']} has died")
+        if svc['policy'] == 'ignore':
+            logging.warning(f"No longer watching {name}")
+            self.services.pop(name)
+            return True
+        if svc['policy'] == 'exit':
+            return False
+        while svc['restarts'] < self.max_restarts:
+            svc['restarts'] += 1
+            logging.info(f"Restarting {name} (attempt {svc['restarts']} of {self.max_restarts})")
+            p = subprocess.run(svc['start_cmd'])
+            if p.returncode == 0 and self._watch(name):
+                logging.info(f"{name} restarted with PID {svc['pid']}")
+                return True
+        logging.error(f"{name} could not be restarted")
+        return False
 
 
 def gen_garbage(length=10):
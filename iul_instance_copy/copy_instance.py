@@ -6,6 +6,19 @@ from pathlib import Path
 import shutil
 import subprocess
 import yaml
+import os
+import errno
+import fcntl
+import threading
+import time
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+# ioctl to clone a file's extents (reflink) on btrfs/xfs
+FICLONE = 0x40049409
+
+# database entries that are populated by galaxy at runtime that we don't care about
+SKIP_DB_ENTRIES = ("dependencies", "tmp")
 
 def main():
     parser = argparse.ArgumentParser()
@@ -14,11 +27,17 @@ def main():
     parser.add_argument("rest_dir", help="Location of REST installation")
     parser.add_argument("galaxy_dir", help="Location of Galaxy installation")
     parser.add_argument("managed_dir", help="Location of the Managed instance to populate")
+    parser.add_argument("--threads", type=int, default=8, help="Number of copy threads (default 8)")
+    parser.add_argument("--journal", help="Checkpoint journal for resuming an interrupted copy (default: managed_dir/copy_instance.journal)")
+    parser.add_argument("--plan", default=False, action="store_true", help="Report what would be copied and estimate the time, without writing anything")
     args = parser.parse_args()
     logging.basicConfig(format="%(asctime)s [%(levelname)-8s] (%(filename)s:%(lineno)d)  %(message)s",
                         level=logging.DEBUG if args.debug else logging.INFO)
 
     try:
+        if args.plan:
+            plan_instance(Path(args.ui_dir), Path(args.galaxy_dir), args.threads)
+            return
         
         srcyaml = Path(args.managed_dir, "amp_bootstrap/amp.yaml")
         if srcyaml.exists():
@@ -34,7 +53,9 @@ def main():
         migrate_rest(amp_config, Path(args.rest_dir), Path(args.managed_dir))
 
         logging.info("Migrating Galaxy Service")
-        migrate_galaxy(amp_config, Path(args.galaxy_dir), Path(args.managed_dir))
+        journal = Path(args.journal) if args.journal else Path(args.managed_dir, "copy_instance.journal")
+        with CopyEngine(journal, args.threads) as engine:
+            migrate_galaxy(amp_config, Path(args.galaxy_dir), Path(args.managed_dir), engine)
 
         logging.info("Configuration file:\n" + yaml.safe_dump(amp_config, default_flow_style=False))
 
@@ -72,7 +93,7 @@ def migrate_rest(amp_config: dict, rest_dir: Path, managed_dir: Path):
     "Migrate an ad hoc rest instance to the managed instance, updating the config"
     
 
-def migrate_galaxy(amp_config: dict, galaxy_dir: Path, managed_dir: Path):
+def migrate_galaxy(amp_config: dict, galaxy_dir: Path, managed_dir: Path, engine):
     "Migrate an ad hoc galaxy instance to the managed instance, updating the config"
     # the database directory is really the bulk of the state we want to keep.
     # but, there's stuff in there we don't want.
@@ -81,60 +102,38 @@ def migrate_galaxy(amp_config: dict, galaxy_dir: Path, managed_dir: Path):
     db_dest = managed_dir / "galaxy/database"
     media_dir = managed_dir / 'data/media'
     
-    def copy_db_tree(entry: Path, dest_root: Path):
-        # recursively copy a tree doing the right thing
-        # when we hit symlinks and whatnot.
-        logging.debug(f"Copy {entry} -> {dest_root}")
-        for f in entry.iterdir():
-            dst = dest_root / f.name
-            if f.is_file():
-                if f.name.endswith(".pyc"):
-                    # no compiled python files
-                    continue
-                shutil.copyfile(f, dst)
-                dst.chmod(f.stat().st_mode)                
-            elif f.is_dir():                
-                dst.mkdir(exist_ok=True, parents=True, mode=f.stat().st_mode)
-                copy_db_tree(f, dst)
-            elif f.is_symlink():
-                link = f.readlink()
-                logging.debug(f"Symlink {f} => {link}")
-                # Something with 'media' in the path has a chance of making sense.  
-                # There are broken links in the database directory on the
-                # instances I've looked at. Otherwise, ignore it.
-                if 'media' in link.parts:
-                    p = list(link.parts)
-                    while p[0] != 'media':
-                        p.pop(0)
-                    p.pop(0)  # get rid of media.
-                    link_data = Path(media_dir, *p)
-                else:
-                    # link to /dev/null since there's really nowhere for it to go 
-                    # but at least if someone asks for it they'll get a 0-length file
-                    link_data = Path("/dev/null")
-                    
-                link_data.parent.mkdir(parents=True, exist_ok=True)
-                link_name = dest_root / f.name
-                link_name.parent.mkdir(parents=True, exist_ok=True)
-                if link_name.exists() or link_name.is_symlink():
-                    link_name.unlink()
-                link_name.symlink_to(link_data)
-                logging.debug(f"-->  {link_name} -> {link_data}")
-                    
-                break
+    skip_pyc = lambda x: x.endswith(".pyc")  # no compiled python files
 
-    
+    def copy_symlink(f: Path, link_name: Path):
+        link = Path(os.readlink(f))
+        logging.debug(f"Symlink {f} => {link}")
+        if 'media' not in link.parts and f.exists():
+            # a working link to anything other than media is copied as data
+            if f.is_dir():
+                engine.copy_tree(f, link_name, copy_symlink, skip=skip_pyc)
+            elif not skip_pyc(f.name):
+                engine.copy_file(f, link_name)
+            return
+        link_data = media_link(link, media_dir)
+        link_data.parent.mkdir(parents=True, exist_ok=True)
+        link_name.parent.mkdir(parents=True, exist_ok=True)
+        if link_name.exists() or link_name.is_symlink():
+            link_name.unlink()
+        link_name.symlink_to(link_data)
+        logging.debug(f"-->  {link_name} -> {link_data}")
+
+    db_dest.mkdir(parents=True, exist_ok=True)
     for e in db_source.iterdir():
-        if e.name in ("dependencies", "tmp"):
-            # this is runtime stuff that's populated by
-            # galaxy that we don't care about
+        if e.name in SKIP_DB_ENTRIES:
             continue
         
         logging.debug(f"Copying database entry {e.name}")
         if e.is_file():
-            shutil.copyfile(e, db_dest / e.name)
+            engine.copy_file(e, db_dest / e.name)
         elif e.is_dir():        
-            copy_db_tree(e, db_dest / e.name)
+            engine.copy_tree(e, db_dest / e.name, copy_symlink, skip=skip_pyc)
+    engine.wait()
+    engine.report()
         
     # for configuration, there's really only a few bits that we care about, since
     # most of the other configuration is either install-specific stuff or boilerplate.
@@ -154,6 +153,288 @@ def migrate_galaxy(amp_config: dict, galaxy_dir: Path, managed_dir: Path):
 
 
 
+def plan_instance(ui_dir: Path, galaxy_dir: Path, threads: int, sample_seconds=5):
+    "Scan the source instance and report what would be copied, without writing anything"
+    db_source = galaxy_dir / "galaxy/database"
+    entries = [e for e in sorted(db_source.iterdir()) if e.name not in SKIP_DB_ENTRIES]
+    with ThreadPoolExecutor(threads) as pool:
+        ui_scan = pool.submit(scan_symlinks, ui_dir / 'htdocs/symlink')
+        scans = dict(zip([e.name for e in entries], pool.map(scan_tree, entries)))
+        ui = ui_scan.result()
+
+    logging.info(f"UI symlinks: {ui['symlinks']} to rewrite, {ui['other']} other entries ignored")
+    total = {'files': 0, 'bytes': 0, 'dirs': 0, 'symlinks': 0, 'media_symlinks': 0, 'skipped': 0}
+    logging.info(f"{'Database entry':<30} {'files':>10} {'MB':>12} {'dirs':>8} {'symlinks':>9} {'media':>8} {'skipped':>8}")
+    for name, scan in scans.items():
+        logging.info(f"{name:<30} {scan['files']:>10} {scan['bytes'] / 1048576:>12.1f} {scan['dirs']:>8} " +
+                     f"{scan['symlinks']:>9} {scan['media_symlinks']:>8} {scan['skipped']:>8}")
+        for k in total:
+            total[k] += scan[k]
+    logging.info(f"{'Total':<30} {total['files']:>10} {total['bytes'] / 1048576:>12.1f} {total['dirs']:>8} " +
+                 f"{total['symlinks']:>9} {total['media_symlinks']:>8} {total['skipped']:>8}")
+
+    # read a sample of the files the same way the copy would, to get an idea
+    # of how fast the source can deliver them.
+    if not total['files']:
+        return
+    sample = []
+    for scan in scans.values():
+        # take from each entry in proportion to its number of files, so the
+        # sample is spread evenly over all of the files
+        count = min(len(scan['sample']), -(-1000 * scan['files'] // total['files']))
+        sample.extend(random.sample(scan['sample'], count))
+    random.shuffle(sample)
+    deadline = time.monotonic() + sample_seconds
+    def read_file(file):
+        if time.monotonic() > deadline:
+            return None
+        try:
+            with open(file, "rb") as f:
+                while f.read(1024 * 1024):
+                    pass
+            return os.stat(file).st_size
+        except OSError as e:
+            # unreadable, or gone since the scan.  The copy will report it.
+            logging.debug(f"Skipping sample {file}: {e}")
+            return None
+    start = time.monotonic()
+    with ThreadPoolExecutor(threads) as pool:
+        sizes = [x for x in pool.map(read_file, sample) if x is not None]
+    elapsed = max(time.monotonic() - start, 0.001)
+    files_rate = len(sizes) / elapsed
+    logging.info(f"Sampled {len(sizes)} files, {sum(sizes) / 1048576:0.1f} MB in {elapsed:0.1f}s " +
+                 f"({files_rate:0.1f} files/s, {sum(sizes) / 1048576 / elapsed:0.1f} MB/s)")
+    # the sample is spread evenly over the files, so the time scales with the number of files
+    estimate = total['files'] / files_rate if files_rate else 0
+    logging.info(f"Estimated copy time with {threads} threads: {estimate / 3600:0.1f} hours ({estimate:0.0f}s)" +
+                 " (the source may be cached, so this is a lower bound)")
+
+
+def scan_symlinks(symlink_dir: Path) -> dict:
+    "Count the UI symlinks that would be rewritten"
+    results = {'symlinks': 0, 'other': 0}
+    if symlink_dir.exists():
+        with os.scandir(symlink_dir) as it:
+            for entry in it:
+                results['symlinks' if entry.is_symlink() else 'other'] += 1
+    return results
+
+
+def scan_tree(entry: Path, sample_size=1000) -> dict:
+    "Gather the statistics for a database entry, with a random sample of its files"
+    results = {'files': 0, 'bytes': 0, 'dirs': 0, 'symlinks': 0, 'media_symlinks': 0, 'skipped': 0, 'sample': []}
+    rand = random.Random(entry.name)
+
+    def add_file(path, size):
+        results['files'] += 1
+        results['bytes'] += size
+        # reservoir sample so every file has the same chance of being picked
+        if len(results['sample']) < sample_size:
+            results['sample'].append(path)
+        else:
+            i = rand.randrange(results['files'])
+            if i < sample_size:
+                results['sample'][i] = path
+
+    if entry.is_file():
+        add_file(str(entry), entry.stat().st_size)
+        return results
+
+    stack = [str(entry)]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for e in it:
+                if e.is_symlink():
+                    # the same as copy_symlink:  working links to anything
+                    # but media are copied as data, and the rest are links
+                    if 'media' in Path(os.readlink(e.path)).parts:
+                        results['symlinks'] += 1
+                        results['media_symlinks'] += 1
+                    elif not os.path.exists(e.path):
+                        results['symlinks'] += 1
+                    elif os.path.isdir(e.path):
+                        results['dirs'] += 1
+                        stack.append(e.path)
+                    elif e.name.endswith(".pyc"):
+                        results['skipped'] += 1
+                    else:
+                        add_file(e.path, os.stat(e.path).st_size)
+                elif e.is_dir():
+                    results['dirs'] += 1
+                    stack.append(e.path)
+                elif e.is_file():
+                    if e.name.endswith(".pyc"):
+                        results['skipped'] += 1
+                    else:
+                        add_file(e.path, e.stat().st_size)
+    return results
+
+
+def media_link(link: Path, media_dir: Path) -> Path:
+    "Get the new destination for a symlink in the database directory"
+    # Something with 'media' in the path has a chance of making sense.  
+    # There are broken links in the database directory on the
+    # instances I've looked at. Otherwise, ignore it.  (Working links to
+    # anything else are copied as data rather than coming here)
+    if 'media' in link.parts:
+        p = list(link.parts)
+        while p[0] != 'media':
+            p.pop(0)
+        p.pop(0)  # get rid of media.
+        return Path(media_dir, *p)
+    else:
+        # link to /dev/null since there's really nowhere for it to go 
+        # but at least if someone asks for it they'll get a 0-length file
+        return Path("/dev/null")
+
+
+class CopyEngine:
+    """Copy files and directory trees using a pool of threads.  Every copied
+       file is recorded in a journal, so if the copy is interrupted it will
+       pick up where it left off the next time.  At most max_pending copies
+       are queued at once, so a huge tree doesn't fill memory with futures."""
+    def __init__(self, journal_file: Path, threads=8, progress_period=30, max_pending=None):
+        self.journal_file = Path(journal_file)
+        self.threads = threads
+        self.progress_period = progress_period
+        self.lock = threading.Lock()
+        self.stats = {'files': 0, 'bytes': 0, 'skipped': 0, 'errors': 0}
+        self.use_reflink = True
+        self.use_copy_file_range = hasattr(os, 'copy_file_range')
+        self.done = {}
+        self.pending = threading.BoundedSemaphore(max_pending or threads * 64)
+
+    def __enter__(self):
+        # load the journal from a previous run
+        if self.journal_file.exists():
+            with open(self.journal_file) as f:
+                for line in f:
+                    parts = line.rstrip('\n').split('\t')
+                    if len(parts) == 3:
+                        self.done[parts[0]] = (int(parts[1]), int(parts[2]))
+            logging.info(f"Resuming copy: {len(self.done)} files were already copied")
+        self.journal = open(self.journal_file, "a")
+        self.pool = ThreadPoolExecutor(self.threads)
+        self.futures = []
+        self.start = self.last_progress = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        # if we're bailing out (including ^C) don't run the queued copies, 
+        # the journal will let the next run pick them up.
+        self.pool.shutdown(cancel_futures=exc_type is not None)
+        self.journal.close()
+
+    def copy_tree(self, src: Path, dst: Path, symlink_handler, skip=None):
+        "Copy a directory tree, calling symlink_handler(src, dst) for symlinks"
+        stack = [(str(src), str(dst))]
+        while stack:
+            sdir, ddir = stack.pop()
+            os.makedirs(ddir, mode=os.stat(sdir).st_mode & 0o7777, exist_ok=True)
+            with os.scandir(sdir) as it:
+                for entry in it:
+                    dpath = os.path.join(ddir, entry.name)
+                    if entry.is_symlink():
+                        symlink_handler(Path(entry.path), Path(dpath))
+                    elif entry.is_dir():
+                        stack.append((entry.path, dpath))
+                    elif entry.is_file():
+                        if skip and skip(entry.name):
+                            continue
+                        self._submit(entry.path, dpath, entry.stat())
+
+    def copy_file(self, src: Path, dst: Path):
+        "Copy a single file"
+        self._submit(str(src), str(dst), os.stat(src))
+
+    def wait(self):
+        "Wait for all of the outstanding copies to finish"
+        for f in self.futures:
+            f.result()
+        self.futures = []
+        self.journal.flush()
+
+    def report(self):
+        "Log the copy statistics"
+        elapsed = max(time.monotonic() - self.start, 0.001)
+        logging.info(f"Copied {self.stats['files']} files, {self.stats['bytes'] / 1048576:0.1f} MB in {elapsed:0.1f}s " +
+                     f"({self.stats['files'] / elapsed:0.1f} files/s, {self.stats['bytes'] / 1048576 / elapsed:0.1f} MB/s), " +
+                     f"{self.stats['skipped']} already copied, {self.stats['errors']} errors")
+
+    def _submit(self, src, dst, st):
+        if self.done.get(src) == (st.st_size, st.st_mtime_ns) and os.path.exists(dst):
+            with self.lock:
+                self.stats['skipped'] += 1
+            return
+        self.pending.acquire()
+        future = self.pool.submit(self._copy, src, dst, st)
+        future.add_done_callback(lambda x: self.pending.release())
+        self.futures.append(future)
+        if len(self.futures) > 10000:
+            # don't let the list of futures grow without bound
+            self.futures = [f for f in self.futures if not f.done()]
+
+    def _copy(self, src, dst, st):
+        try:
+            with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+                self._copy_data(fsrc, fdst, st.st_size)
+            os.chmod(dst, st.st_mode & 0o7777)
+        except Exception as e:
+            logging.error(f"Cannot copy {src} to {dst}: {e}")
+            with self.lock:
+                self.stats['errors'] += 1
+            return
+        with self.lock:
+            self.journal.write(f"{src}\t{st.st_size}\t{st.st_mtime_ns}\n")
+            self.stats['files'] += 1
+            self.stats['bytes'] += st.st_size
+            now = time.monotonic()
+            if now - self.last_progress > self.progress_period:
+                self.last_progress = now
+                self.journal.flush()
+                self.report()
+
+    def _copy_data(self, fsrc, fdst, size):
+        "Copy the data using the fastest method the filesystem supports"
+        infd, outfd = fsrc.fileno(), fdst.fileno()
+        if self.use_reflink:
+            try:
+                fcntl.ioctl(outfd, FICLONE, infd)
+                return
+            except OSError:
+                # don't try it again if the filesystem doesn't do it.
+                self.use_reflink = False
+
+        if self.use_copy_file_range:
+            try:
+                copied = 0
+                while copied < size:
+                    n = os.copy_file_range(infd, outfd, size - copied)
+                    if n == 0:
+                        break
+                    copied += n
+                return
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+                self.use_copy_file_range = False
+                fsrc.seek(0)
+                fdst.seek(0)
+                fdst.truncate()
+
+        # sendfile works for any regular file on linux, and if not, do it the old way
+        try:
+            copied = 0
+            while copied < size:
+                n = os.sendfile(outfd, infd, copied, size - copied)
+                if n == 0:
+                    break
+                copied += n
+        except OSError:
+            fsrc.seek(0)
+            fdst.seek(0)
+            fdst.truncate()
+            shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
 
 
 if __name__ == "__main__":
@@ -1,7 +1,14 @@
 #!/bin/env python3
+import amp.gpu
 from amp.gpu import get_gpus, has_gpu, ExclusiveGPU
 import logging
 from pathlib import Path
+import multiprocessing
+import os
+import signal
+import tempfile
+import threading
+import time
 
 # test the functions
 logging.basicConfig(level=logging.DEBUG)
@@ -9,19 +16,152 @@ print("get gpus", get_gpus())
 print("has any gpu", has_gpu())
 print("has a nvidia gpu", has_gpu('nvidia'))
 print("has an amd gpu", has_gpu('amd'))
-with ExclusiveGPU('nvidia') as g:
-    print(f"Got an exclusive lock on {g.name}")
-    lockfile = Path(g.lockfile)
-    print("lockfile exists", lockfile.exists())
-    print("Attempting an exclusive lock (nested, 20s timeout)")
+if has_gpu('nvidia'):
+    with ExclusiveGPU('nvidia') as g:
+        print(f"Got an exclusive lock on {g.name}")
+        entry = g.queue.entry
+        print("queue entry exists", entry.exists())
+        assert entry.exists()
+        print("Attempting an exclusive lock on the same device (nested, 20s timeout)")
+        try:
+            with ExclusiveGPU('nvidia', device=g.name, timeout=20) as g1:
+                print(f"Uh oh -- got an exclusive lock on the same device? {g1.name}")
+        except TimeoutError:
+            print("Got timeout error, which is expected")
+        except Exception as e:
+            print("Got an exception with nested lock")
+            logging.exception(e)
+
+    print("Released main lock")
+    print(f"Checking queue entry existence from main lock: {entry}", entry.exists())
+    assert not entry.exists()
+
+
+# The rest of the tests use fake devices so they can run without a GPU
+fake_dev = tempfile.TemporaryDirectory()
+amp.gpu.LOCK_DIR = Path(fake_dev.name)
+devices = []
+for i in range(2):
+    devices.append(Path(fake_dev.name, f"nvidia{i}"))
+    devices[-1].touch()
+
+print("Discovery against a fake /dev and /sys")
+amp.gpu.DEVICE_DIR = Path(fake_dev.name, "dev")
+amp.gpu.SYS_DIR = Path(fake_dev.name, "sys")
+for name in ("nvidia0", "nvidia1", "nvidia10", "nvidia2", "nvidiactl", "nvidia-uvm", "dri/renderD128", "dri/renderD129"):
+    (amp.gpu.DEVICE_DIR / name).parent.mkdir(parents=True, exist_ok=True)
+    (amp.gpu.DEVICE_DIR / name).touch()
+for node, vendor in (("renderD128", "0x1002"), ("renderD129", "0x8086")):
+    (amp.gpu.SYS_DIR / "class/drm" / node / "device").mkdir(parents=True)
+    (amp.gpu.SYS_DIR / "class/drm" / node / "device/vendor").write_text(vendor + "\n")
+# the nvidia probe needs nvidia-smi on the path
+(Path(fake_dev.name) / "nvidia-smi").touch(mode=0o755)
+os.environ['PATH'] = fake_dev.name + os.pathsep + os.environ['PATH']
+gpus = get_gpus(refresh=True)
+print("Fake gpus", gpus)
+assert [Path(x).name for x in gpus['nvidia']] == ['nvidia0', 'nvidia1', 'nvidia2', 'nvidia10']
+assert [Path(x).name for x in gpus['amd']] == ['renderD128'] and [Path(x).name for x in gpus['intel']] == ['renderD129']
+assert has_gpu()
+# an iGPU alone isn't a compute GPU
+amp.gpu.register_probe('nvidia', lambda: [])
+assert has_gpu('intel') and not has_gpu()
+amp.gpu.register_probe('nvidia', amp.gpu.probe_nvidia)
+start = time.time()
+for i in range(1000):
+    has_gpu('nvidia')
+print(f"Cached has_gpu: {(time.time() - start) * 1000:0.2f}us per call")
+
+print("Multi-GPU: each lock should get a different device")
+with ExclusiveGPU('nvidia', devices=devices) as g0:
+    with ExclusiveGPU('nvidia', devices=devices) as g1:
+        print(f"Got {g0.name} (index {g0.index}) and {g1.name} (index {g1.index})")
+        assert g0.name != g1.name
+        print("Environment", g1.environment())
+        try:
+            with ExclusiveGPU('nvidia', devices=devices, timeout=1):
+                print("Uh oh -- got a lock when all of the devices are busy")
+        except TimeoutError:
+            print("Got timeout error, which is expected")
+        with ExclusiveGPU('nvidia', devices=devices, slots={str(devices[1]): 2}) as g2:
+            print(f"With two slots on {devices[1]}, got {g2.name} slot {g2.slot}")
+            assert g2.name == devices[1] and g2.slot == 1
+
+
+# measure how long it takes for the lock to be handed from one process to
+# the next one in the queue.
+def hold_gpu(hold, results):
+    with ExclusiveGPU('nvidia', devices=devices[0:1]) as g:
+        results.put(('acquired', os.getpid(), time.time()))
+        time.sleep(hold)
+        results.put(('released', os.getpid(), time.time()))
+
+results = multiprocessing.Queue()
+procs = [multiprocessing.Process(target=hold_gpu, args=(0.5, results)) for x in range(4)]
+for p in procs:
+    p.start()
+    time.sleep(0.1)
+for p in procs:
+    p.join()
+events = sorted([results.get() for x in range(len(procs) * 2)], key=lambda x: x[2])
+print("Lock order", [x[1] for x in events if x[0] == 'acquired'], "start order", [p.pid for p in procs])
+handoffs = [events[i + 1][2] - events[i][2] for i in range(1, len(events) - 1, 2)]
+print("Status", amp.gpu.gpu_status())
+print(f"Hand-off latency: max {max(handoffs) * 1000:0.2f}ms, average {sum(handoffs) / len(handoffs) * 1000:0.2f}ms")
+
+print("Queue files are usable by other users, and the caller's timers are left alone")
+os.umask(0o022)
+queue = amp.gpu.GPUQueue(Path(fake_dev.name, "perm.queue"))
+assert queue.acquire(time.time()) is not None
+assert (queue.queue_dir / "sequence").stat().st_mode & 0o777 == 0o666
+# a leftover entry we aren't allowed to remove is skipped
+stale = queue.queue_dir / "000000000000.1.lock"
+stale.touch()
+original_unlink = Path.unlink
+def unlink(self, *args):
+    if self == stale:
+        raise PermissionError("not ours")
+    original_unlink(self, *args)
+Path.unlink = unlink
+queue.release()
+signal.setitimer(signal.ITIMER_REAL, 1000)
+waiter = amp.gpu.GPUQueue(queue.queue_dir)
+assert waiter.acquire(time.time() + 5) is not None, "stale entry should have been skipped"
+waiter.release()
+Path.unlink = original_unlink
+assert signal.getitimer(signal.ITIMER_REAL)[0] > 900
+signal.setitimer(signal.ITIMER_REAL, 0)
+
+print("When every device is busy, the waiter gets whichever frees up first")
+with ExclusiveGPU('nvidia', devices=devices) as g0:
+    g1 = ExclusiveGPU('nvidia', devices=devices).__enter__()
+    got = []
+    waiter = threading.Thread(target=lambda: got.append(ExclusiveGPU('nvidia', devices=devices, timeout=10).__enter__()))
+    waiter.start()
+    time.sleep(0.5)
+    g1.__exit__(None, None, None)
+    waiter.join()
+    print(f"Released {g1.name} while holding {g0.name}, waiter got {got[0].name}")
+    assert got[0].name == g1.name
+    got[0].__exit__(None, None, None)
+
+print("Waiting blocks rather than polling")
+with ExclusiveGPU('nvidia', devices=devices) as g0, ExclusiveGPU('nvidia', devices=devices) as g1:
+    start = time.time()
+    cpu = time.process_time()
     try:
-        with ExclusiveGPU('nvidia', timeout=20) as g1:
-            print(f"Uh oh -- got an exclusive lock on the same device? {g1.name}")
+        with ExclusiveGPU('nvidia', devices=devices, timeout=2, period=0.5):
+            assert False, "all of the devices are busy"
     except TimeoutError:
-        print("Got timeout error, which is expected")
-    except Exception as e:
-        print("Got an exception with nested lock")
-        logging.exception(e)
+        pass
+    cpu = time.process_time() - cpu
+    print(f"Waited {time.time() - start:0.2f}s for {len(devices)} devices using {cpu * 1000:0.1f}ms of CPU")
+    assert 2 <= time.time() - start < 2.5 and cpu < 0.05
 
-print("Released main lock")
-print(f"Checking lockfile existance from main lock: {g.lockfile}", lockfile.exists())
\ No newline at end of file
+print("CUDA indexes follow the PCI bus order, not the /dev/nvidiaN minor numbers")
+amp.gpu.PROC_DIR = Path(fake_dev.name, "proc")
+for bus, minor in (("0000:81:00.0", 0), ("0000:03:00.0", 1)):
+    (amp.gpu.PROC_DIR / "driver/nvidia/gpus" / bus).mkdir(parents=True)
+    (amp.gpu.PROC_DIR / "driver/nvidia/gpus" / bus / "information").write_text(f"Model: Fake\nDevice Minor: {minor}\n")
+assert amp.gpu.cuda_index(devices[0]) == 1 and amp.gpu.cuda_index(devices[1]) == 0
+assert amp.gpu.cuda_index("/dev/nvidia7") == 7
+assert (queue.queue_dir / "stats").stat().st_mode & 0o777 == 0o666
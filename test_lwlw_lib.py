@@ -0,0 +1,260 @@
+#!/bin/env python3
+from amp.jobstore import JobStore
+from amp.lwlw import LWLW, AsyncLWLW, ThreadedLWLW, LWLWRunner, FixedPolling, BackoffPolling, _Poller
+import asyncio
+import logging
+import multiprocessing
+from pathlib import Path
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+
+
+class FakeJob(LWLW):
+    """A local stand-in for a remote job.  The job finishes duration seconds
+       after it is submitted with the given rc.  If retry_hint is set, each 
+       check suggests it as the retry-after"""
+    def __init__(self, duration=1, rc=LWLW.OK, retry_hint=None):
+        self.duration = duration
+        self.rc = rc
+        self.retry_hint = retry_hint
+        self.finish_time = None
+        self.calls = {'exists': 0, 'submit': 0, 'check': 0, 'cleanup': 0}
+
+    def exists(self):
+        self.calls['exists'] += 1
+        return self.finish_time is not None
+
+    def submit(self):
+        self.calls['submit'] += 1
+        self.finish_time = time.time() + self.duration
+        return self.check()
+
+    def check(self):
+        self.calls['check'] += 1
+        if time.time() < self.finish_time:
+            self.retry_after = self.retry_hint
+            return LWLW.WAIT
+        return self.rc
+
+    def cleanup(self):
+        self.calls['cleanup'] += 1
+        self.finish_time = None
+
+
+class FakeAsyncJob(AsyncLWLW):
+    "An asyncio version of FakeJob, which tracks how many are running at once"
+    running = 0
+    most_running = 0
+
+    def __init__(self, duration=1, rc=LWLW.OK):
+        self.duration = duration
+        self.rc = rc
+        self.finish_time = None
+        self.calls = {'exists': 0, 'submit': 0, 'check': 0, 'cleanup': 0}
+
+    async def exists(self):
+        self.calls['exists'] += 1
+        return self.finish_time is not None
+
+    async def submit(self):
+        self.calls['submit'] += 1
+        FakeAsyncJob.running += 1
+        FakeAsyncJob.most_running = max(FakeAsyncJob.running, FakeAsyncJob.most_running)
+        self.finish_time = time.time() + self.duration
+        return await self.check()
+
+    async def check(self):
+        self.calls['check'] += 1
+        if self.rc is None:
+            raise ValueError("the remote service broke")
+        return LWLW.WAIT if time.time() < self.finish_time else self.rc
+
+    async def cleanup(self):
+        self.calls['cleanup'] += 1
+        FakeAsyncJob.running -= 1
+        self.finish_time = None
+
+
+class StoredJob(LWLW):
+    """A job which keeps its state in the job store rather than in the 
+       object, so a new object (as in a new process) can pick it up.  The
+       remote service finishes the job duration seconds after submission"""
+    def __init__(self, key, store, duration=0.2):
+        self.job_key = key
+        self.job_store = store
+        self.duration = duration
+        self.calls = {'submit': 0, 'check': 0}
+
+    def submit(self):
+        self.calls['submit'] += 1
+        self.remote_id = f"remote-{time.time() + self.duration}"
+        return LWLW.WAIT
+
+    def check(self):
+        self.calls['check'] += 1
+        return LWLW.OK if time.time() >= float(self.remote_id.split('-')[1]) else LWLW.WAIT
+
+
+class AsyncStoredJob(AsyncLWLW):
+    def __init__(self, key, store):
+        self.job_key = key
+        self.job_store = store
+
+    async def submit(self):
+        self.remote_id = "remote"
+        return LWLW.WAIT
+
+    async def check(self):
+        return LWLW.OK
+
+
+def write_jobs(path, prefix, count):
+    "Record count jobs in the store, as another process would"
+    store = JobStore(path)
+    for i in range(count):
+        store.submitted(f"{prefix}-{i}", f"r{i}", "Writer")
+        store.checked(f"{prefix}-{i}", LWLW.OK if i % 2 else LWLW.WAIT)
+
+
+logging.basicConfig(level=logging.INFO)
+random.seed(1)
+
+print("Backoff delays grow by the factor up to the maximum, within the jitter")
+backoff = BackoffPolling(initial=1, factor=2, maximum=10, jitter=0.2)
+for checks, expected in ((0, 1), (1, 1), (2, 2), (3, 4), (4, 8), (5, 10), (20, 10)):
+    delays = [backoff.delay(checks, 0) for x in range(200)]
+    assert all(expected * 0.8 <= x <= expected * 1.2 for x in delays), (checks, min(delays), max(delays))
+    assert max(delays) - min(delays) > expected * 0.2, "delays should be jittered"
+assert BackoffPolling(jitter=0).delay(3, 0) == 1 * 1.5 ** 2
+assert FixedPolling(7).delay(100, 1000) == 7
+
+print("The poller honors retry_after and the deadline")
+job = FakeJob()
+poller = _Poller(job, FixedPolling(5), None)
+job.retry_after = 0.25
+assert poller.next_delay() == 0.25 and job.retry_after is None
+assert poller.next_delay() == 5
+poller = _Poller(job, FixedPolling(5), 0.5)
+assert poller.next_delay() <= 0.5
+time.sleep(0.5)
+assert poller.next_delay() is None
+
+print("Synchronous runs poll until the job reaches a terminal state")
+for rc in (LWLW.OK, LWLW.ERROR):
+    job = FakeJob(duration=0.3, rc=rc)
+    metrics = []
+    start = time.time()
+    assert job.run(lwlw=False, polling=FixedPolling(0.05), metrics=metrics.append) == rc
+    assert 0.3 <= time.time() - start < 1
+    assert job.calls['submit'] == 1 and job.calls['cleanup'] == 1 and job.calls['check'] > 2
+    assert metrics[0]['rc'] == rc and metrics[0]['checks'] == job.calls['check'] - 1 and not metrics[0]['timed_out']
+    assert metrics[0]['latency'] >= 0.3
+
+# the retry_after hint overrides the polling strategy
+job = FakeJob(duration=0.3, retry_hint=0.1)
+assert job.run(lwlw=False, polling=FixedPolling(60)) == LWLW.OK
+assert job.calls['check'] <= 5
+
+# a job which doesn't finish by the deadline is an error
+job = FakeJob(duration=60)
+metrics = []
+start = time.time()
+assert job.run(lwlw=False, polling=BackoffPolling(initial=0.05), deadline=0.5, metrics=metrics.append) == LWLW.ERROR
+assert time.time() - start < 1 and metrics[0]['timed_out'] and job.calls['cleanup'] == 1
+
+print("LWLW runs submit once and then check on each invocation")
+job = FakeJob(duration=0.2)
+assert job.run() == LWLW.WAIT and job.calls['submit'] == 1
+time.sleep(0.2)
+assert job.run() == LWLW.OK and job.calls['submit'] == 1 and job.calls['cleanup'] == 1
+
+print("Async jobs follow the same protocol")
+job = FakeAsyncJob(duration=0.2)
+metrics = []
+assert asyncio.run(job.run(lwlw=False, polling=FixedPolling(0.05), metrics=metrics.append)) == LWLW.OK
+assert job.calls['submit'] == 1 and job.calls['cleanup'] == 1 and metrics[0]['checks'] == job.calls['check'] - 1
+job = FakeAsyncJob(duration=0.2)
+assert asyncio.run(job.run()) == LWLW.WAIT
+time.sleep(0.2)
+assert asyncio.run(job.run()) == LWLW.OK and job.calls['submit'] == 1
+
+print("Synchronous jobs can be run from the event loop in threads")
+job = FakeJob(duration=0.2, retry_hint=0.05)
+assert asyncio.run(ThreadedLWLW(job).run(lwlw=False, polling=FixedPolling(60))) == LWLW.OK
+assert job.calls['submit'] == 1 and job.calls['cleanup'] == 1 and job.calls['check'] >= 3
+
+print("The runner drives many jobs at once, up to its concurrency")
+jobs = [FakeAsyncJob(duration=0.5) for x in range(40)] + [FakeJob(duration=0.5) for x in range(40)]
+jobs += [FakeAsyncJob(duration=0.1, rc=LWLW.ERROR), FakeAsyncJob(rc=None)]
+start = time.time()
+rcs = LWLWRunner(concurrency=50, threads=8).run(jobs, polling=FixedPolling(0.05))
+elapsed = time.time() - start
+print(f"{len(jobs)} jobs of 0.5s in {elapsed:0.2f}s, at most {FakeAsyncJob.most_running} async jobs at once")
+assert rcs == [LWLW.OK] * 80 + [LWLW.ERROR, LWLW.ERROR]
+assert elapsed < 3 and FakeAsyncJob.most_running <= 50
+assert all(x.calls['cleanup'] == 1 for x in jobs[:80])
+FakeAsyncJob.running = FakeAsyncJob.most_running = 0
+assert LWLWRunner(concurrency=10).run([FakeAsyncJob(duration=0.1) for x in range(30)], polling=FixedPolling(0.02)) == [LWLW.OK] * 30
+assert FakeAsyncJob.most_running == 10
+
+print("Jobs in the job store are picked up again after a restart")
+work = tempfile.TemporaryDirectory()
+db = Path(work.name, "jobs.db")
+job = StoredJob("job-1", JobStore(db))
+assert job.run() == LWLW.WAIT and job.calls['submit'] == 1
+stored = JobStore(db).get("job-1")
+assert stored['remote_id'] == job.remote_id and stored['status'] == LWLW.WAIT
+# a new process, with a new store and a new job object
+time.sleep(0.2)
+store = JobStore(db)
+job = StoredJob("job-1", store)
+removes = []
+original_remove = store.remove
+store.remove = lambda key: (removes.append(key), original_remove(key))
+assert job.run() == LWLW.OK and job.calls == {'submit': 0, 'check': 1}
+assert store.get("job-1") is None and removes == ["job-1"], "the job should be forgotten once"
+# the synchronous protocol records its checks too
+job = StoredJob("job-2", store, duration=0.1)
+assert job.run(lwlw=False, polling=FixedPolling(0.02), post_cleanup=False) == LWLW.OK
+assert store.get("job-2")['status'] == LWLW.OK and store.get("job-2")['checks'] == job.calls['check']
+
+print("Many processes and threads can write to the store at once")
+procs = [multiprocessing.Process(target=write_jobs, args=(db, f"p{x}", 200)) for x in range(4)]
+threads = [threading.Thread(target=write_jobs, args=(db, f"t{x}", 200)) for x in range(4)]
+start = time.time()
+for x in procs + threads:
+    x.start()
+for x in procs + threads:
+    x.join()
+assert all(x.exitcode == 0 for x in procs)
+print(f"Wrote 3200 records from 8 writers in {time.time() - start:0.2f}s")
+assert len(store.jobs(mgm="Writer")) == 1600 and len(store.jobs(status=LWLW.WAIT, mgm="Writer")) == 800
+
+print("Async jobs don't block the event loop while the store is locked")
+async def locked_run():
+    job = AsyncStoredJob("async-1", JobStore(db))
+    # another process holding a write lock on the database
+    locker = sqlite3.connect(str(db), timeout=60)
+    locker.execute("begin immediate")
+    lags = []
+    async def ticker():
+        while not done.is_set():
+            before = time.time()
+            await asyncio.sleep(0.01)
+            lags.append(time.time() - before - 0.01)
+    done = asyncio.Event()
+    tick = asyncio.create_task(ticker())
+    run = asyncio.create_task(job.run())
+    await asyncio.sleep(0.5)
+    locker.rollback()
+    rc = await run
+    done.set()
+    await tick
+    locker.close()
+    return rc, max(lags)
+rc, lag = asyncio.run(locked_run())
+print(f"Longest event loop stall while the store was locked: {lag * 1000:0.1f}ms")
+assert rc == LWLW.WAIT and lag < 0.1
@@ -0,0 +1,218 @@
+#!/bin/env python3
+from amp.fileutils import read_json_file, write_json_file
+from amp.nerutils import chunked_ner, chunk_text, clean_type, NamedEntity, populate_amp_entities, process_amp_entities
+from amp.schema.entity_extraction import EntityExtraction
+from amp.schema.speech_to_text import SpeechToText, SpeechToTextResult, SpeechToTextWord
+import logging
+from pathlib import Path
+import random
+import re
+import tempfile
+import time
+
+# A trivial stand-in for a real NER:  runs of capitalized words are names,
+# and numbers are quantities.
+NAME_PATTERN = re.compile(r"[A-Z][a-z]+(?: [A-Z][a-z]+)*|\d+")
+
+class RegexEntity:
+    def __init__(self, m):
+        self.label_ = "QUANTITY" if m.group(0).isdigit() else "PERSON"
+        self.text = m.group(0)
+        self.start_char = m.start()
+        self.end_char = m.end()
+
+def regex_ner(text):
+    return [RegexEntity(m) for m in NAME_PATTERN.finditer(text)]
+
+def aws_regex_ner(text):
+    return [{'Type': "PERSON", 'Text': m.group(0), 'BeginOffset': m.start() + 1, 'EndOffset': m.end() + 1, 'Score': 0.9}
+            for m in NAME_PATTERN.finditer(text)]
+
+
+logging.basicConfig(level=logging.INFO)
+random.seed(1)
+vocabulary = ["the", "said", "went", "to", "of", "and", "New York City", "Mary Ann Smith", "Indiana", "42", "1977"]
+sentences = []
+for i in range(20000):
+    sentence = " ".join(random.choice(vocabulary) for x in range(random.randint(3, 15)))
+    sentences.append(sentence[0].upper() + sentence[1:] + random.choice([".", "?", "!", ","]))
+text = " ".join(sentences)
+
+chunks = chunk_text(text, 5000, 200)
+print(f"{len(text)} characters in {len(chunks)} chunks")
+assert chunks[0][0] == 0 and chunks[-1][1] == len(text)
+for (s0, e0, _), (s1, e1, _) in zip(chunks, chunks[1:]):
+    assert s1 < e0 and e1 > e0, "chunks should overlap and move forward"
+
+start = time.time()
+whole = [(e.start_char, e.end_char, e.label_, e.text) for e in regex_ner(text)]
+print(f"Unchunked: {len(whole)} entities in {time.time() - start:0.2f}s")
+for processes in (1, 4):
+    for max_chars in (1000, 5000):
+        start = time.time()
+        found = chunked_ner(text, regex_ner, max_chars=max_chars, processes=processes)
+        print(f"Chunked {max_chars} characters, {processes} processes: {len(found)} entities in {time.time() - start:0.2f}s")
+        assert [(e.start_char, e.end_char, e.label_, e.text) for e in found] == whole
+        assert all(text[e.start_char:e.end_char] == e.text for e in found)
+
+found = chunked_ner(text, aws_regex_ner, max_chars=1000, processes=2)
+assert [(e['BeginOffset'] - 1, e['EndOffset'] - 1) for e in found] == [x[0:2] for x in whole]
+print("AWS-style entities remapped correctly")
+
+# A model which sees the overlap between chunks differently from each side:  if its input starts mid-sentence, names
+# before the first sentence end lose their first word and get a different label, and numbers are found at random.
+# Each part of the text should still get its entities from one chunk only, without overlapping near-duplicates.
+class ContextNer:
+    def __init__(self, seed):
+        self.random = random.Random(seed)
+
+    def __call__(self, text):
+        found = []
+        m = re.search(r"[.!?] ", text)
+        context = 0 if text[0].isupper() else (m.end() if m else len(text))
+        for e in regex_ner(text):
+            if e.label_ == "QUANTITY" and self.random.random() < 0.5:
+                continue
+            if e.start_char < context and " " in e.text:
+                cut = e.text.index(" ") + 1
+                e.text, e.start_char, e.label_ = e.text[cut:], e.start_char + cut, "ORG"
+            found.append(e)
+        return found
+
+for max_chars in (500, 1000, 5000):
+    found = chunked_ner(text, ContextNer(max_chars), max_chars=max_chars)
+    spans = [(e.start_char, e.end_char) for e in found]
+    assert all(b0 < b1 and e0 <= b1 for (b0, e0), (b1, e1) in zip(spans, spans[1:])), "entities should not overlap"
+    assert all(text[e.start_char:e.end_char] == e.text for e in found)
+    people = [x for x in whole if x[2] == "PERSON"]
+    found_people = {(e.start_char, e.end_char) for e in found if e.label_ != "QUANTITY"}
+    # a name is found whole unless the chunk owning it started just before it
+    assert len(found_people) == len(people) and len(found_people & {x[0:2] for x in people}) > 0.95 * len(people)
+print("A context-dependent NER gives one entity per name")
+
+# the chunked entities can be populated into the AMP entities as usual
+words = [SpeechToTextWord("pronunciation", w, None, i * 0.5, i * 0.5 + 0.4) for i, w in enumerate(sentences[0].split(" "))]
+transcript = SpeechToText(None, SpeechToTextResult(words, sentences[0]))
+transcript.results.compute_offset()
+entities = EntityExtraction()
+populate_amp_entities(transcript, chunked_ner(sentences[0], regex_ner, max_chars=1000), entities, [])
+print("Populated", [(e.text, e.start, e.end) for e in entities.entities])
+
+# populate_amp_entities reproduces the old linear search on entities which start at a word, and also fills in the end
+# times.  The old one gave up at the first entity it couldn't match (one starting mid-word, or a second one at the same
+# offset), so only that prefix is compared when there is one.
+def old_populate_amp_entities(amp_transcript_obj, ner_entities_list, amp_entities_obj, ignore_types_list):
+    words = amp_transcript_obj.results.words
+    lenw = len(words)
+    last = -1
+    for entity in ner_entities_list:
+        try:
+            if isinstance(entity, dict):
+                type = entity["Type"]
+                text = entity["Text"]
+                beginOffset = entity["BeginOffset"] - 1
+                endOffset = entity["EndOffset"] - 1
+                scoreType = "relevance"
+                scoreValue = entity["Score"]
+            else:
+                type = entity.label_
+                text = entity.text
+                beginOffset = entity.start_char
+                endOffset = entity.end_char
+                scoreType = None
+                scoreValue = None
+            if clean_type(type) in ignore_types_list:
+                continue
+            for i in range(last+1, lenw):
+                if words[i].offset == beginOffset:
+                    last = i
+                    break
+            else:
+                last = lenw
+            if last == lenw:
+                break
+            else:
+                amp_entities_obj.addEntity(type, text, beginOffset, endOffset, words[last].start, None, scoreType, scoreValue)
+        except Exception:
+            pass
+
+def entity_tuple(e):
+    return (e.type, e.text, e.beginOffset, e.endOffset, e.start, e.score and (e.score.type, e.score.value))
+
+class ErrorCounter(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.tracebacks = 0
+    def emit(self, record):
+        if record.exc_info is not None:
+            self.tracebacks += 1
+
+errors = ErrorCounter()
+logging.getLogger().addHandler(errors)
+compared = prefixes = 0
+for n in range(2000):
+    sentence = sentences[n]
+    words = []
+    for j, w in enumerate(re.findall(r"\w+|[^\w\s]", sentence)):
+        words.append(SpeechToTextWord("punctuation" if not w[0].isalnum() else "pronunciation", w, None, j * 0.5, j * 0.5 + 0.4))
+    transcript = SpeechToText(None, SpeechToTextResult(words, sentence))
+    transcript.results.compute_offset()
+    # entities of one to three words, sometimes starting mid-word or repeating the previous offset, and some missing a field
+    ner_entities = []
+    j = random.randrange(2)
+    while j < len(words):
+        last = min(j + random.randrange(3), len(words) - 1)
+        begin, end = words[j].offset, words[last].offset + len(words[last].text)
+        kind = random.random()
+        if kind < 0.03 and len(words[j].text) > 1:
+            begin += 1
+        elif kind < 0.05 and ner_entities:
+            begin = ner_entities[-1]['BeginOffset'] - 1
+        entity = {'Type': random.choice(["PERSON", "LOCATION", "DATE"]), 'Text': sentence[begin:end],
+                  'BeginOffset': begin + 1, 'EndOffset': end + 1, 'Score': random.random()}
+        if kind > 0.98:
+            del entity['Score']
+        ner_entities.append(entity)
+        j = last + 1 + random.randrange(3)
+    if n % 2:
+        # the same as spaCy-style entities
+        ner_entities = [NamedEntity(x['Type'], x['Text'], x['BeginOffset'] - 1, x['EndOffset'] - 1) if 'Score' in x else x
+                        for x in ner_entities]
+    old, new = EntityExtraction(), EntityExtraction()
+    logging.disable(logging.CRITICAL)
+    old_populate_amp_entities(transcript, ner_entities, old, ["DATE"])
+    logging.disable(logging.NOTSET)
+    populate_amp_entities(transcript, ner_entities, new, ["DATE"])
+    expected = [entity_tuple(e) for e in old.entities]
+    assert [entity_tuple(e) for e in new.entities[:len(expected)]] == expected, sentence
+    prefixes += len(new.entities) > len(expected)
+    compared += len(expected)
+    for e in new.entities:
+        covered = [w for w in words if e.beginOffset <= w.offset + len(w.text) - 1 and w.offset < e.endOffset]
+        assert e.end == covered[-1].end and e.start == covered[0].start
+logging.getLogger().removeHandler(errors)
+print(f"Populated the same {compared} entities as the old populate_amp_entities, and more in {prefixes} transcripts where it gave up")
+assert errors.tracebacks > 0, "entities raising exceptions should be logged with their tracebacks"
+
+# a batch of jobs in one process:  transcripts given as files, dicts, and objects,
+# an empty transcript, and one which can't be read
+work = tempfile.TemporaryDirectory()
+jobs = []
+for i in range(200):
+    sentence = sentences[i] if i % 50 else ""
+    words = [SpeechToTextWord("pronunciation", w, None, j * 0.5, j * 0.5 + 0.4) for j, w in enumerate(sentence.split(" ")) if w]
+    transcript = SpeechToText(None, SpeechToTextResult(words, sentence))
+    transcript.results.compute_offset()
+    if i % 3 == 0:
+        transcript = Path(work.name, f"transcript{i}.json")
+        write_json_file(SpeechToText(None, SpeechToTextResult(words, sentence)), transcript)
+    jobs.append((transcript, Path(work.name, f"entities{i}.json"), "QUANTITY, date"))
+jobs.append((Path(work.name, "missing.json"), Path(work.name, "missing_entities.json"), ""))
+start = time.time()
+results = process_amp_entities(jobs, regex_ner)
+print(f"Batch of {len(jobs)} jobs in {time.time() - start:0.2f}s")
+assert [x.error is not None for x in results] == [False] * (len(jobs) - 1) + [True]
+assert len([x for x in results[:-1] if x.empty]) == 4
+assert all(e.type != "QUANTITY" for x in results for e in x.entities.entities)
+assert read_json_file(jobs[3][1])['media']['filename'] == str(jobs[3][0])
+print("Batch stats", results[1].stats)
@@ -0,0 +1,162 @@
+#!/bin/env python3
+# Tests and benchmarks for the AMP REST client, against a keep-alive stand-in
+# for the AMP REST service.  The optional argument is the number of units for
+# the benchmark.
+from amp.rest import AmpRest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import http.client
+import base64
+import json
+import sys
+import threading
+import time
+from urllib.parse import urlsplit, parse_qs, quote
+from urllib.request import Request, urlopen
+
+SIZE = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+
+class StandIn(BaseHTTPRequestHandler):
+    "Just enough of the AMP REST service for the client"
+    protocol_version = "HTTP/1.1"
+    # the headers and body are written separately, like a real server with
+    # TCP_NODELAY, rather than waiting on the client's delayed ACKs
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        name = parse_qs(url.query)['name'][0]
+        with self.server.lock:
+            units = [self.server.units[name]] if name in self.server.units else []
+        self.reply({'_embedded': {'units': units}})
+
+    def do_POST(self):
+        data = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        with self.server.lock:
+            self.server.posts += 1
+        if self.path == "/rest/account/authenticate":
+            exp = base64.urlsafe_b64encode(json.dumps({'exp': int(time.time()) + 3600}).encode()).decode().rstrip('=')
+            return self.reply({'token': f"header.{exp}.signature"})
+        with self.server.lock:
+            unit = {'name': data['name'], '_links': {'self': {'href': f"/rest/units/{len(self.server.units)}"}}}
+            self.server.units[data['name']] = unit
+            mode = self.server.mode
+        if mode == 'drop':
+            # the unit is created, but the connection drops before the response
+            self.close_connection = True
+        elif mode == 'truncate':
+            self.send_response(201)
+            self.send_header('Content-Length', '1000')
+            self.end_headers()
+            self.wfile.write(b'{"name"')
+            self.close_connection = True
+        else:
+            self.reply(unit, 201)
+
+    def reply(self, data, status=200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if self.server.mode == 'idle':
+            # close the connection as though it sat idle too long, without telling the client
+            self.close_connection = True
+
+
+server = ThreadingHTTPServer(('127.0.0.1', 0), StandIn)
+server.daemon_threads = True
+server.lock = threading.Lock()
+server.units = {}
+server.posts = 0
+server.mode = None
+threading.Thread(target=server.serve_forever, daemon=True).start()
+url_base = f"http://127.0.0.1:{server.server_address[1]}"
+
+def reset(mode=None):
+    server.units.clear()
+    server.posts = 0
+    server.mode = mode
+
+
+print("Requests on pooled connections the server has closed are retried")
+reset('idle')
+with AmpRest(url_base, "admin", "secret") as client:
+    for i in range(20):
+        assert client.ensure_unit(f"unit{i}")
+        assert client.find_unit(f"unit{i}")['name'] == f"unit{i}"
+assert len(server.units) == 20
+
+print("A POST on a new connection which drops before the response isn't resent")
+reset('drop')
+client = AmpRest(url_base, "admin", "secret")
+client.token()
+client.close()
+posts = server.posts
+try:
+    client.create_unit("once")
+    assert False, "the dropped connection should raise"
+except (http.client.RemoteDisconnected, ConnectionResetError):
+    pass
+assert server.posts == posts + 1 and list(server.units) == ["once"]
+
+print("A POST whose response was cut off isn't resent, even on a pooled connection")
+reset('truncate')
+client = AmpRest(url_base, "admin", "secret")
+client.token()
+posts = server.posts
+try:
+    client.create_unit("once")
+    assert False, "the truncated response should raise"
+except http.client.IncompleteRead:
+    pass
+assert server.posts == posts + 1 and list(server.units) == ["once"]
+client.close()
+
+
+# The per-request urlopen pattern bootstrap_rest_unit used before AmpRest,
+# authenticating for each unit
+def old_ensure_unit(name):
+    req = Request(url_base + "/rest/account/authenticate",
+                  data=bytes(json.dumps({'username': "admin", 'password': "secret"}), encoding='utf-8'),
+                  headers={'Content-Type': 'application/json'},
+                  method="POST")
+    with urlopen(req) as res:
+        token = json.loads(res.read())['token']
+    req = Request(url_base + "/rest/units/search/findByName?name=" + quote(name),
+                  headers={'Authorization': f"Bearer {token}"})
+    with urlopen(req) as res:
+        rdata = json.loads(res.read())
+    if len(rdata['_embedded']['units']) == 0:
+        req = Request(url_base + "/rest/units",
+                      headers={'Authorization': f"Bearer {token}", 'Content-Type': 'application/json'},
+                      data=bytes(json.dumps({'name': name}), encoding="utf-8"),
+                      method="POST")
+        with urlopen(req) as res:
+            res.read()
+
+print(f"Benchmark: ensuring {SIZE} units")
+reset()
+names = [f"unit{i}" for i in range(SIZE)]
+start = time.time()
+for name in names:
+    old_ensure_unit(name)
+print(f"  urlopen per request  {time.time() - start:0.2f}s")
+reset()
+start = time.time()
+with AmpRest(url_base, "admin", "secret") as client:
+    assert client.ensure_units(names) == {x: True for x in names}
+    assert client.ensure_units(names) == {x: False for x in names}
+print(f"  AmpRest, twice       {time.time() - start:0.2f}s")
+reset()
+start = time.time()
+with AmpRest(url_base, "admin", "secret") as client:
+    for name in names:
+        client.ensure_unit(name)
+print(f"  AmpRest, one thread  {time.time() - start:0.2f}s")
+assert sorted(server.units) == sorted(names)
+server.shutdown()
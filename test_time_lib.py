@@ -0,0 +1,171 @@
+#!/bin/env python3
+# Tests and benchmarks for the time conversions.  The optional argument is
+# the number of values for the benchmarks.
+from amp.timeutils import timestamp2hhmmss, TimestampFormatter, timestamps2hhmmss, hhmmss2timestamp, hhmmss2timestamps
+from amp.timeutils import secondToFrame, frameToSecond, secondsToFrames, framesToSeconds
+import random
+import sys
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+SIZE = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+
+
+# The formatting from before the rounding fix, for comparison
+def old_timestamp2hhmmss(timestamp):
+    hours = int(timestamp / 3600)
+    timestamp -= hours * 3600
+    minutes = int(timestamp / 60)
+    seconds = timestamp - minutes * 60
+    return f"{hours:02d}:{minutes:02d}:{seconds:06.3f}"
+
+
+random.seed(1)
+
+print("timestamp2hhmmss rounds to the nearest millisecond, halves up, before splitting the fields")
+pinned = {0: "00:00:00.000",
+          -1: "00:00:00.000",
+          0.0004999: "00:00:00.000",
+          0.0005: "00:00:00.001",
+          1.0005: "00:00:01.001",
+          1.5: "00:00:01.500",
+          59.9994: "00:00:59.999",
+          59.9996: "00:01:00.000",
+          3599.9995: "01:00:00.000",
+          29920.5255: "08:18:40.526",
+          86399.999: "23:59:59.999",
+          360000.25: "100:00:00.250"}
+format_many = TimestampFormatter(cache_size=2)
+for value, expected in pinned.items():
+    assert timestamp2hhmmss(value) == expected, (value, timestamp2hhmmss(value))
+    assert format_many(value) == expected
+assert timestamps2hhmmss(list(pinned)) == list(pinned.values())
+if numpy is not None:
+    assert timestamps2hhmmss(numpy.array(list(pinned), dtype=float)) == list(pinned.values())
+# everything else is the same as the old formatting
+for i in range(100000):
+    value = random.uniform(0, 100000)
+    if abs(value * 1000 - int(value * 1000) - 0.5) > 0.01:
+        assert timestamp2hhmmss(value) == old_timestamp2hhmmss(value), value
+
+print("The batch parsing gives the same results as hhmmss2timestamp")
+values = [timestamp2hhmmss(random.uniform(0, 100000)) for x in range(10000)]
+values += ["12.5", "1:02.25", "01:02:03", "1:2:3.4", "100:00:00.250", "00:01:02.3456789"]
+assert hhmmss2timestamps(values) == [hhmmss2timestamp(x) for x in values]
+for bad in ("1:2:3:4", "xx:00:00.000", "00:00:0x.000"):
+    try:
+        hhmmss2timestamps([bad])
+        assert False, bad
+    except ValueError:
+        pass
+
+print("The batch frame conversions match the scalar ones")
+seconds = [random.uniform(0, 10000) for x in range(10000)]
+assert secondsToFrames(seconds, 29.97) == [secondToFrame(x, 29.97) for x in seconds]
+frames = list(range(10000))
+assert framesToSeconds(frames, 29.97) == [frameToSecond(x, 29.97) for x in frames]
+if numpy is not None:
+    assert secondsToFrames(numpy.array(seconds), 29.97).tolist() == [secondToFrame(x, 29.97) for x in seconds]
+    assert framesToSeconds(numpy.array(frames), 29.97).tolist() == [frameToSecond(x, 29.97) for x in frames]
+
+print(f"Benchmark: {SIZE} random values (0-40000s)")
+values = [random.uniform(0, 40000) for x in range(SIZE)]
+start = time.time()
+old = [old_timestamp2hhmmss(x) for x in values]
+print(f"  format, old scalar   {time.time() - start:0.2f}s")
+start = time.time()
+new = [timestamp2hhmmss(x) for x in values]
+print(f"  format, scalar       {time.time() - start:0.2f}s")
+start = time.time()
+assert timestamps2hhmmss(values) == new
+print(f"  format, batch        {time.time() - start:0.2f}s")
+print(f"  {sum(a != b for a, b in zip(old, new))} of {SIZE} formatted values differ from the old formatting")
+start = time.time()
+parsed = [hhmmss2timestamp(x) for x in new]
+print(f"  parse, scalar        {time.time() - start:0.2f}s")
+start = time.time()
+assert hhmmss2timestamps(new) == parsed
+print(f"  parse, batch         {time.time() - start:0.2f}s")
+start = time.time()
+frames = [secondToFrame(x, 29.97) for x in values]
+print(f"  to frames, scalar    {time.time() - start:0.2f}s")
+start = time.time()
+secondsToFrames(values, 29.97)
+print(f"  to frames, batch     {time.time() - start:0.2f}s")
+if numpy is not None:
+    array = numpy.array(values)
+    start = time.time()
+    secondsToFrames(array, 29.97)
+    print(f"  to frames, NumPy     {time.time() - start:0.3f}s")
+
+print("time_convertor gives the same results and exceptions as the strptime version")
+from amp.time_convertor import convertToSeconds, convertColumnToSeconds
+from datetime import datetime
+
+def old_convertToTime(timestamp, format):
+    try:
+        timeobj = datetime.strptime(timestamp, format)
+    except:
+        timestamp = timestamp + '.0'
+        timeobj = datetime.strptime(timestamp, format)
+    return timeobj
+
+def old_convertToSeconds(timestamp, format='%H:%M:%S.%f'):
+    if ':' in timestamp:
+        timeobj = old_convertToTime(timestamp, format)
+        zerotime = old_convertToTime('0:00:00.000', format)
+        timeinseconds = float((timeobj - zerotime).total_seconds())
+    else:
+        timeinseconds = float(timestamp)
+    return timeinseconds
+
+def outcome(convert, timestamp, *args):
+    try:
+        return convert(timestamp, *args)
+    except Exception as e:
+        return type(e)
+
+def random_timestamp():
+    digits = "0123456789" * 5 + "١٢٣߁०"
+    hours = random.choice([str(random.randint(0, 24)), f"{random.randint(0, 23):02d}", "٠1", "1٢"])
+    fields = [hours, f"{random.randint(0, 61):02d}", random.choice([f"{random.randint(0, 61):02d}", str(random.randint(0, 9))])]
+    timestamp = ":".join(fields[random.randint(0, 1):])
+    kind = random.random()
+    if kind < 0.6:
+        timestamp += "." + "".join(random.choice(digits) for x in range(random.randint(1, 8)))
+    elif kind < 0.7:
+        timestamp += "."
+    elif kind < 0.8:
+        timestamp = random.choice([" ", ""]) + timestamp + random.choice([" ", "\n", "x", ""])
+    elif kind < 0.9:
+        timestamp = str(random.uniform(0, 1000))
+    return timestamp
+
+fixtures = [random_timestamp() for x in range(20000)]
+fixtures += ["01:02:03.١٢", "٠1:02:03.12", "01:02:03", "1:2:3", "24:00:00.0", "00:60:00.0", "00:00:60.0", "00:00:61",
+             "23:59:59.999999", "23:59:59.9999999", "", "abc", "1:02:03.-5", "+1:02:03.5", "1:02:03.5e1"]
+for timestamp in fixtures:
+    expected = outcome(old_convertToSeconds, timestamp)
+    assert outcome(convertToSeconds, timestamp) == expected, (timestamp, expected)
+    assert outcome(convertColumnToSeconds, [timestamp]) in (expected, [expected]), timestamp
+    for format in ('%H:%M:%S', '%M:%S.%f'):
+        assert outcome(convertToSeconds, timestamp, format) == outcome(old_convertToSeconds, timestamp, format), timestamp
+good = [x for x in fixtures if not isinstance(outcome(old_convertToSeconds, x), type)]
+print(f"  {len(good)} of {len(fixtures)} fixtures convert, the rest raise the same exceptions")
+assert convertColumnToSeconds(good) == [old_convertToSeconds(x) for x in good]
+
+print(f"Benchmark: {SIZE // 5} timestamps through time_convertor")
+rows = [timestamp2hhmmss(random.uniform(0, 80000)) for x in range(SIZE // 5)]
+start = time.time()
+old = [old_convertToSeconds(x) for x in rows]
+print(f"  strptime             {time.time() - start:0.2f}s")
+start = time.time()
+assert [convertToSeconds(x) for x in rows] == old
+print(f"  convertToSeconds     {time.time() - start:0.2f}s")
+start = time.time()
+assert convertColumnToSeconds(rows) == old
+print(f"  convertColumnToSeconds {time.time() - start:0.2f}s")
@@ -0,0 +1,328 @@
+#!/bin/env python3
+# Tests and benchmarks for the VTT generation.  The optional argument is the
+# number of cues/words for the benchmarks.
+from amp.vtt_helper import gen_vtt, iter_vtt, write_vtt, VTTWriter, alignwords
+from amp.vtt_helper import words2phrases, iter_phrases, splitphrase, write_phrases
+import copy
+import io
+import logging
+import random
+import sys
+import time
+
+SIZE = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+
+# The implementations from before the streaming rewrite, for comparison
+def old_timestamp2hhmmss(timestamp):
+    hours = int(timestamp / 3600)
+    timestamp -= hours * 3600
+    minutes = int(timestamp / 60)
+    seconds = timestamp - minutes * 60
+    return f"{hours:02d}:{minutes:02d}:{seconds:06.3f}"
+
+def old_gen_vtt(subtitles):
+    result = "WEBVTT\n\n"
+    for s in subtitles:
+        result += f"{old_timestamp2hhmmss(s['start'])} --> {old_timestamp2hhmmss(s['end'])}\n"        
+        speaker = s.get('speaker', None)
+        if speaker:
+            result += f"<v {speaker}>"
+        result += f"{s['text']}\n\n"
+    return result
+
+def old_alignwords(words):
+    med_duration = 0.2
+    last_end = 0
+    for i, w in enumerate(words):
+        if w['end'] - w['start'] == 0:
+            # find the next word with a valid duration.
+            nduration = 0
+            for j, x in enumerate(words[i:]):
+                if x['end'] - x['start'] > 0.02:
+                    nduration = (x['start'] - last_end) / j
+                    break
+            else:
+                nduration = med_duration
+
+            w['end'] = w['start'] + nduration
+            for j, x in enumerate(words[i + 1:]):
+                if x['start'] == w['start']:                    
+                    x['end'] = x['start'] = w['end']
+        last_end = w['end']
+
+
+def old_words2phrases(words, phrase_gap=1.5, max_duration=3):
+    phrases = []
+    buffer = []
+    last_end = None
+    last_speaker = None
+    for word in words:
+        speaker = word.get('speaker', None)
+        if speaker != last_speaker:
+            if not buffer:
+                buffer.append(word)
+            else:
+                phrases.append({'start': buffer[0]['start'], 'end': buffer[-1]['end'],
+                                'phrase': buffer, 'speaker': last_speaker})
+                buffer = [word]
+        else:
+            if last_end == None or (word['start'] - last_end) < phrase_gap:
+                buffer.append(word)
+            else:
+                phrases.append({'start': buffer[0]['start'], 'end': buffer[-1]['end'],
+                                'phrase': buffer, 'speaker': last_speaker})
+                buffer = [word]
+        last_end = word['end']
+        last_speaker = speaker
+    if buffer:
+        phrases.append({'start': buffer[0]['start'], 'end': buffer[-1]['end'],
+                        'phrase': buffer, 'speaker': last_speaker})
+    results = []
+    for p in phrases:
+        results.extend([{'start': x['start'], 'end': x['end'], 'text': old_renderwords(x['phrase']),
+                         'speaker': x['speaker']} for x in old_splitphrase(p, max_duration)])
+    return results
+
+def old_renderwords(words):
+    text = ""    
+    for w in [x['word'] for x in words]:
+        if not text:
+            text = w
+        else:
+            if w[0] in '-%,':
+                text += w
+            else:
+                text += " " + w
+    return text
+
+def old_splitphrase(phrase, max_duration):
+    results = []
+    start = duration = 0
+    buffer = []
+    for word in phrase['phrase']:
+        if not buffer:
+            buffer.append(word)
+            start = word['start']
+            duration = word['end'] - word['start']
+        else:
+            duration = word['end'] - start
+            buffer.append(word)
+        if duration > max_duration:
+            if buffer[-1]['word'][-1] in '.,?!':
+                results.append(buffer)
+                buffer = []
+            else:
+                for i in range(1, len(buffer) - 1):
+                    if buffer[-i]['word'][-1] in '.,?!':
+                        results.append(buffer[0 : -i + 1])
+                        buffer = buffer[-(i - 1):]
+                        duration = buffer[-1]['end'] - buffer[0]['start']
+                        start = buffer[0]['start']
+                        break
+                else:
+                    results.append(buffer)
+                    buffer = []
+    if buffer:
+        results.append(buffer)
+    return [{'start': r[0]['start'], 'end': r[-1]['end'], 'speaker': phrase['speaker'], 'phrase': r} for r in results]
+
+
+def random_words(count, zero_fraction=0.3, shuffle=False):
+    """Generate words with quantized times so there are duplicate starts, 
+    runs of zero and near-zero duration words, punctuation, and speakers"""
+    words = []
+    t = 0
+    speaker = "A"
+    for i in range(count):
+        kind = random.random()
+        if kind < zero_fraction:
+            duration = 0
+        elif kind < zero_fraction + 0.1:
+            duration = 0.01
+        else:
+            duration = random.choice([0.1, 0.2, 0.25, 0.5, 1])
+        if random.random() < 0.7:
+            t += random.choice([0, 0, 0.1, 0.25, 0.5, 2])
+        if random.random() < 0.05:
+            speaker = random.choice(["A", "B", None])
+        words.append({'start': t, 'end': t + duration, 'speaker': speaker,
+                      'word': random.choice(["the", "word", "-ish", "%", ",", "end.", "what?", "yes!", "so,", "x"])})
+        t += duration * random.random()
+    if shuffle:
+        random.shuffle(words)
+    return words
+
+
+logging.basicConfig(level=logging.INFO)
+random.seed(1)
+
+print("VTT output is pinned, including the rounding")
+# Timestamps are rounded to the nearest millisecond, with halves rounded up,
+# before they're split into fields.  The old formatting rounded the seconds
+# field after subtracting the hours and minutes, so half milliseconds went 
+# either way depending on the float error and 59.9996 became 00:00:60.000
+cues = [{'start': 0, 'end': 1.5, 'text': "Hello"},
+        {'start': 29920.5255, 'end': 29921.0005, 'text': "half milliseconds round up", 'speaker': "Mary"},
+        {'start': 59.9996, 'end': 3599.9995, 'text': "no sixtieth second", 'speaker': None},
+        {'start': 360000.25, 'end': 360001.0004999, 'text': "100 hours"}]
+expected = ("WEBVTT\n\n"
+            "00:00:00.000 --> 00:00:01.500\nHello\n\n"
+            "08:18:40.526 --> 08:18:41.001\n<v Mary>half milliseconds round up\n\n"
+            "00:01:00.000 --> 01:00:00.000\nno sixtieth second\n\n"
+            "100:00:00.250 --> 100:00:01.000\n100 hours\n\n")
+assert gen_vtt(cues) == expected
+assert "".join(iter_vtt(cues, batch=1)) == expected
+out = io.StringIO()
+assert write_vtt(cues, out) == 4 and out.getvalue() == expected
+assert gen_vtt([]) == "WEBVTT\n\n" and "".join(iter_vtt([])) == "WEBVTT\n\n"
+# the old output only differs in the rounding
+assert old_gen_vtt(cues[0:1]) == gen_vtt(cues[0:1])
+assert old_gen_vtt(cues) != expected
+
+out = io.StringIO()
+writer = VTTWriter(out, notes=["made by\n\ntest_vtt_lib"], styles=["::cue { color: yellow }"])
+writer.write_cue(cues[0])
+writer.note("between cues")
+try:
+    writer.style("::cue { color: red }")
+    assert False, "STYLE after a cue should fail"
+except ValueError:
+    pass
+assert out.getvalue() == ("WEBVTT\n\nSTYLE\n::cue { color: yellow }\n\nNOTE made by\ntest_vtt_lib\n\n"
+                          "00:00:00.000 --> 00:00:01.500\nHello\n\nNOTE between cues\n\n")
+
+print(f"Benchmark: {SIZE} cues")
+cues = []
+t = 0
+for i in range(SIZE):
+    t += random.uniform(0, 2)
+    cues.append({'start': t, 'end': t + random.uniform(0.5, 3), 'text': "some words " * random.randint(1, 8),
+                 'speaker': random.choice([None, "Mary", "Bob"])})
+start = time.time()
+old = old_gen_vtt(cues)
+print(f"  old gen_vtt          {time.time() - start:0.2f}s")
+start = time.time()
+new = gen_vtt(cues)
+print(f"  new gen_vtt          {time.time() - start:0.2f}s")
+start = time.time()
+write_vtt(cues, io.StringIO())
+print(f"  write_vtt            {time.time() - start:0.2f}s")
+old_lines = old.splitlines()
+new_lines = new.splitlines()
+assert len(old_lines) == len(new_lines)
+print(f"  {sum(a != b for a, b in zip(old_lines, new_lines))} of {SIZE} timing lines round differently")
+
+print("alignwords matches the old implementation")
+for i in range(3000):
+    words = random_words(random.randint(0, 60), zero_fraction=random.choice([0.1, 0.3, 0.7]), shuffle=i % 5 == 0)
+    old = copy.deepcopy(words)
+    old_alignwords(old)
+    alignwords(words)
+    assert words == old, i
+
+print("Benchmark: alignwords, 30% zero duration words")
+for count in (10000, SIZE, 1000000):
+    words = random_words(count)
+    if count <= 10000:
+        old = copy.deepcopy(words)
+        start = time.time()
+        old_alignwords(old)
+        print(f"  {count:>8} words: old {time.time() - start:0.2f}s")
+    start = time.time()
+    alignwords(words)
+    print(f"  {count:>8} words: new {time.time() - start:0.2f}s")
+    if count <= 10000:
+        assert words == old
+
+print("words2phrases matches the old implementation, including the punctuation splits")
+splits = 0
+for i in range(3000):
+    words = random_words(random.randint(0, 80), zero_fraction=0.1)
+    alignwords(words)
+    phrase_gap = random.choice([0.5, 1.5, 3])
+    max_duration = random.choice([1, 3, 5])
+    old = old_words2phrases(copy.deepcopy(words), phrase_gap, max_duration)
+    assert words2phrases(words, phrase_gap, max_duration) == old, i
+    assert list(iter_phrases(iter(words), phrase_gap, max_duration)) == old, i
+    phrase = {'speaker': "A", 'phrase': words}
+    if words:
+        assert splitphrase(phrase, max_duration) == old_splitphrase(copy.deepcopy(phrase), max_duration), i
+    splits += len(old) - len(words2phrases(words, phrase_gap, 10 ** 9))
+    out = io.StringIO()
+    assert write_phrases(words, out, phrase_gap, max_duration) == len(old)
+    assert out.getvalue() == gen_vtt(old)
+print(f"  {splits} phrases came from splitting overlong phrases")
+assert splits > 1000
+
+print(f"Benchmark: {SIZE} words to VTT")
+words = random_words(SIZE, zero_fraction=0)
+start = time.time()
+old_gen_vtt(old_words2phrases(words))
+print(f"  old words2phrases + gen_vtt  {time.time() - start:0.2f}s")
+start = time.time()
+write_phrases(iter(words), io.StringIO())
+print(f"  write_phrases                {time.time() - start:0.2f}s")
+
+print("WordTable gives the same results as the word dict functions, with and without NumPy")
+import amp.wordtable
+from amp.wordtable import WordTable
+has_numpy = amp.wordtable.numpy is not None
+for use_numpy in ((True, False) if has_numpy else (False,)):
+    saved = amp.wordtable.numpy
+    if not use_numpy:
+        amp.wordtable.numpy = None
+    for i in range(1000):
+        words = random_words(random.randint(0, 80), zero_fraction=random.choice([0, 0.1, 0.3]))
+        table = WordTable.from_words(words)
+        assert table.to_words() == [{k: v for k, v in w.items() if k != 'speaker' or v is not None} for w in words]
+        alignwords(words)
+        table.align()
+        assert table.to_words() == [{k: v for k, v in w.items() if k != 'speaker' or v is not None} for w in words], i
+        phrase_gap = random.choice([0.5, 1.5, 3])
+        max_duration = random.choice([1, 3, 5])
+        assert list(table.phrases(phrase_gap, max_duration)) == words2phrases(words, phrase_gap, max_duration), i
+        out = io.StringIO()
+        table.write_vtt(out, phrase_gap, max_duration)
+        assert out.getvalue() == gen_vtt(words2phrases(words, phrase_gap, max_duration))
+    amp.wordtable.numpy = saved
+
+# more speakers than a 16-bit id can hold
+words = [{'start': i, 'end': i + 0.5, 'word': "hi", 'speaker': f"speaker {i}"} for i in range(40000)]
+table = WordTable.from_words(words)
+assert table.speaker_name(39999) == "speaker 39999" and len(list(table.phrases())) == 40000
+
+# AMP transcript JSON and SpeechToText objects round trip
+from amp.schema.speech_to_text import SpeechToText
+data = {'media': {'filename': "x.wav", 'duration': 10},
+        'results': {'transcript': "Hello there.", 
+                    'words': [{'type': "pronunciation", 'text': "Hello", 'offset': 0, 'start': 0.5, 'end': 1.0,
+                               'score': {'type': "confidence", 'value': 0.9}},
+                              {'type': "pronunciation", 'text': "there.", 'offset': 6}]}}
+table = WordTable.from_speech_to_text(data)
+assert table.to_json_words() == data['results']['words']
+stt = SpeechToText.from_json(data)
+table = WordTable.from_speech_to_text(stt)
+assert table.to_json_words() == data['results']['words']
+assert [w.text for w in table.to_speech_to_text().results.words] == ["Hello", "there."]
+
+print(f"Benchmark: WordTable with 1M words ({'with' if has_numpy else 'without'} NumPy)")
+words = random_words(1000000, zero_fraction=0)
+start = time.time()
+table = WordTable.from_words(words)
+print(f"  from_words                       {time.time() - start:0.2f}s")
+for label, zero in (("no zero duration words", 0), ("30% zero duration words", 0.3)):
+    words = random_words(1000000, zero_fraction=zero)
+    table = WordTable.from_words(words)
+    start = time.time()
+    alignwords(words)
+    dict_time = time.time() - start
+    start = time.time()
+    table.align()
+    print(f"  align, {label}: dicts {dict_time:0.2f}s, table {time.time() - start:0.2f}s")
+    start = time.time()
+    expected = words2phrases(words)
+    dict_time = time.time() - start
+    start = time.time()
+    assert list(table.phrases()) == expected
+    print(f"  phrases, {label}: dicts {dict_time:0.2f}s, table {time.time() - start:0.2f}s")